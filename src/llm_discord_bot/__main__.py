@@ -1,8 +1,7 @@
 import os
 from dotenv import load_dotenv
 from llm_discord_bot.bot import Bot
-from llm_discord_bot.llmrag import LlmRag
-from huggingface_hub import login
+from llm_discord_bot.client import LocalLlmClient, RemoteLlmClient
 
 
 def main():
@@ -11,16 +10,16 @@ def main():
     config_file = os.getenv("CONFIG_FILE")
     discord_token = os.getenv("DISCORD_TOKEN")
     huggingface_token = os.getenv("HUGGINGFACE_TOKEN")
+    server_url = os.getenv("LLM_SERVER_URL")
     if discord_token is None:
         raise EnvironmentError("Could not find environment variable for `DISCORD_TOKEN`, exiting")
-    elif huggingface_token is None:
+    elif huggingface_token is None and server_url is None:
         raise EnvironmentError("Could not find environment variable for `HUGGINGFACE_TOKEN`, exiting")
 
-    # login to huggingface
-    login(token=huggingface_token)
-
-    # initialize the llm + rag model than run the discord bot
-    bot = Bot(llm=LlmRag(llm_model_name=os.getenv("MODEL")), config_file=config_file)
+    # the llm + rag model runs in a separate `ldbot-server` process, or is loaded here in the background
+    # while the bot already connects to discord
+    llm = RemoteLlmClient(server_url) if server_url is not None else LocalLlmClient()
+    bot = Bot(llm=llm, config_file=config_file)
     bot.run(os.getenv("DISCORD_TOKEN"))
 
 
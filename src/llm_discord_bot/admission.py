@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from typing import List
+
+from llm_discord_bot.constants import ADMISSION_DEGRADE_SHARE, ADMISSION_SERVICE_SMOOTHING
+from llm_discord_bot.metrics import metrics
+
+logger = logging.getLogger("ADMISSION")
+
+ADMITTED, DEGRADED = "admitted", "degraded"
+USER_LIMIT, QUEUE_FULL, OVERLOADED = "user_limit", "queue_full", "overloaded"
+
+
+class Ticket:
+    """A reply waiting for, or holding, one of the admission queue's slots"""
+
+    def __init__(self, channel_id: int, user_id: int, decision: str, position: int = 0):
+        """
+        :param channel_id: Discord channel the reply goes to
+        :param user_id: Discord user who asked
+        :param decision: `admitted` or `degraded`, or why the reply was shed
+        :param position: Number of replies served before this one, 0 if it runs straight away
+        """
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.decision = decision
+        self.position = position
+        self.enqueued = time.perf_counter()
+        self.granted: float | None = None
+        self.released = False
+        self._future: asyncio.Future | None = None
+
+    @property
+    def shed(self) -> bool:
+        return self.decision not in (ADMITTED, DEGRADED)
+
+    @property
+    def degraded(self) -> bool:
+        return self.decision == DEGRADED
+
+    async def wait(self):
+        """Wait for a slot, replies that waited longer than expected are degraded once they get one"""
+        if self._future is not None:
+            await self._future
+
+
+class AdmissionQueue:
+    """
+    Limits how many replies are generated at once, the others wait in a bounded queue.
+
+    Waiting replies are served round robin over channels and, within a channel, over users, so one user or a busy
+    channel cannot starve the others. Each user can hold only a few replies at a time. The wait of a new reply is
+    estimated from how long replies recently held their slot: past `degrade_share` of `slo` it is generated in a cheaper
+    mode, past `slo` it is turned away.
+    """
+
+    def __init__(self, max_active: int, max_queued: int, max_per_user: int, slo: float, degrade_share: float = ADMISSION_DEGRADE_SHARE):
+        """
+        :param max_active: Replies generated at the same time
+        :param max_queued: Replies waiting for a slot, more are turned away
+        :param max_per_user: Replies one user can have waiting or generating
+        :param slo: Seconds a reply should wait for its slot at most
+        :param degrade_share: Share of `slo` an estimated wait can reach before replies are degraded
+        """
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.slo = slo
+        self.degrade_share = degrade_share
+        self.active = 0
+        self.queued = 0
+        self.service_time: float | None = None  # smoothed seconds a reply holds its slot
+        self._channels: OrderedDict[int, OrderedDict[int, deque[Ticket]]] = OrderedDict()
+        self._held = Counter()
+
+    def estimated_wait(self, position: int) -> float:
+        """Seconds until the reply at `position` gets a slot"""
+        if position <= 0 or self.service_time is None:
+            return 0.0
+        return position * self.service_time / self.max_active
+
+    def request(self, channel_id: int, user_id: int) -> Ticket:
+        """
+        Ask for a slot for a reply, has to be called from the event loop and the ticket released once the reply is done
+
+        :param channel_id: Discord channel the reply goes to
+        :param user_id: Discord user who asked
+        :return: Ticket to wait on, or a shed one saying why the reply was turned away
+        """
+        if self._held[user_id] >= self.max_per_user:
+            return self._shed(channel_id, user_id, USER_LIMIT)
+        if self.active < self.max_active and not self.queued:
+            ticket = Ticket(channel_id, user_id, ADMITTED)
+            self._grant(ticket)
+        else:
+            if self.queued >= self.max_queued:
+                return self._shed(channel_id, user_id, QUEUE_FULL)
+            ticket = Ticket(channel_id, user_id, ADMITTED)
+            self._enqueue(ticket)
+            ticket.position = self._order().index(ticket) + 1
+            wait = self.estimated_wait(ticket.position)
+            if wait > self.slo:
+                self._dequeue(ticket)
+                return self._shed(channel_id, user_id, OVERLOADED)
+            if wait > self.slo * self.degrade_share:
+                ticket.decision = DEGRADED
+            ticket._future = asyncio.get_running_loop().create_future()
+        self._held[user_id] += 1
+        if ticket.degraded:
+            metrics.inc("replies_degraded")
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """Give back the slot of a finished reply, or take a reply that is no longer wanted out of the queue"""
+        if ticket.shed or ticket.released:
+            return
+        ticket.released = True
+        self._held[ticket.user_id] -= 1
+        if self._held[ticket.user_id] <= 0:
+            del self._held[ticket.user_id]
+        if ticket.granted is None:
+            self._dequeue(ticket)
+            return
+        self.active -= 1
+        held = time.perf_counter() - ticket.granted
+        self.service_time = held if self.service_time is None else self.service_time + ADMISSION_SERVICE_SMOOTHING * (held - self.service_time)
+        self._dispatch()
+
+    def _shed(self, channel_id: int, user_id: int, reason: str) -> Ticket:
+        logger.info(f"Shedding reply to user {user_id} in channel {channel_id}: {reason}")
+        metrics.inc("replies_shed", reason=reason)
+        return Ticket(channel_id, user_id, reason)
+
+    def _grant(self, ticket: Ticket):
+        self.active += 1
+        ticket.granted = time.perf_counter()
+        wait = ticket.granted - ticket.enqueued
+        metrics.observe("admission_wait", wait)
+        if wait > self.slo * self.degrade_share and not ticket.degraded:
+            ticket.decision = DEGRADED
+            metrics.inc("replies_degraded")
+        if ticket._future is not None and not ticket._future.done():
+            ticket._future.set_result(None)
+
+    def _enqueue(self, ticket: Ticket):
+        users = self._channels.setdefault(ticket.channel_id, OrderedDict())
+        users.setdefault(ticket.user_id, deque()).append(ticket)
+        self.queued += 1
+
+    def _dequeue(self, ticket: Ticket):
+        users = self._channels[ticket.channel_id]
+        users[ticket.user_id].remove(ticket)
+        if not users[ticket.user_id]:
+            del users[ticket.user_id]
+        if not users:
+            del self._channels[ticket.channel_id]
+        self.queued -= 1
+
+    def _next(self) -> Ticket:
+        """Oldest ticket of the next user of the next channel, both move to the back of their rotation"""
+        channel_id, users = next(iter(self._channels.items()))
+        user_id, tickets = next(iter(users.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self._channels.move_to_end(channel_id)
+        else:
+            del self._channels[channel_id]
+        self.queued -= 1
+        return ticket
+
+    def _order(self) -> List[Ticket]:
+        """Queued tickets in the order `_next` will serve them"""
+        channels = deque(deque(deque(tickets) for tickets in users.values()) for users in self._channels.values())
+        order = []
+        while channels:
+            users = channels.popleft()
+            tickets = users.popleft()
+            order.append(tickets.popleft())
+            if tickets:
+                users.append(tickets)
+            if users:
+                channels.append(users)
+        return order
+
+    def _dispatch(self):
+        while self.active < self.max_active and self.queued:
+            self._grant(self._next())
@@ -0,0 +1,296 @@
+import logging
+import os
+import time
+from sys import platform
+from typing import List, Optional
+
+from torch import bfloat16, cuda, no_grad, tensor
+from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers.generation.streamers import BaseStreamer
+
+from llm_discord_bot.constants import PROMPT, RAG_PROMPT
+from llm_discord_bot.metrics import metrics
+from llm_discord_bot.prefix_cache import PrefixCache
+from llm_discord_bot.scheduler import TokenCallback
+
+logger = logging.getLogger("BACKENDS")
+
+# default model of each backend when `MODEL` is not set
+DEFAULT_MODELS = {
+    "transformers": "meta-llama/Llama-3.2-3B-Instruct",
+    "llamacpp": "bartowski/Llama-3.2-3B-Instruct-GGUF",
+}
+MAX_NEW_TOKENS = 500
+TEMPERATURE = 0.2
+REPETITION_PENALTY = 1.1
+
+
+class GenerationBackend:
+    """
+    Runs the llm for `LlmRag`. Every backend renders the shared chat prompts with its model's chat template,
+    so `prompt` and `rag_prompt` are format strings with `{identity}`, `{context}` and `{query}` fields whatever
+    the backend.
+    """
+
+    name = ""
+    max_batch_size = 1  # prompts generated together, the scheduler never hands over more
+    prompt: str
+    rag_prompt: str
+
+    def generate(
+        self, prompts: List[str], callbacks: List[Optional[TokenCallback]], max_new_tokens: Optional[List[Optional[int]]] = None
+    ) -> List[str]:
+        """
+        Generate one answer per prompt
+
+        :param prompts: Fully formatted prompts
+        :param callbacks: Per prompt callback receiving text as it is generated, None if the prompt is not streamed
+        :param max_new_tokens: Per prompt limit of the answer's length in tokens, `MAX_NEW_TOKENS` where None or not given
+        """
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens in `text` according to the llm's tokenizer"""
+        raise NotImplementedError
+
+    def register_prefix(self, prefix: str):
+        """Called with the fixed start of a prompt about to be generated, backends that cache prefixes compute it once"""
+
+
+def observe_generation(t_start: float, first_token_at: float | None):
+    """Record the prefill, up to the first generated token, and the decoding after it of a finished generation"""
+    t_end = time.perf_counter()
+    if first_token_at is None:  # nothing was generated
+        metrics.observe("prefill", t_end - t_start)
+        return
+    metrics.observe("prefill", first_token_at - t_start)
+    metrics.observe("decode", t_end - first_token_at)
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Decodes each row of a batched generation incrementally and hands the new text to that row's callback.
+    Also notes when the first token was generated, which ends the prefill, whether or not any row is streamed.
+    """
+
+    def __init__(self, tokenizer, callbacks: List[Optional[TokenCallback]], limits: List[int]):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.limits = limits  # rows stop streaming once they reach their limit, the batch runs until the longest one
+        self.streaming = any(callback is not None for callback in callbacks)
+        self.tokens: List[List[int]] = [[] for _ in callbacks]
+        self.printed: List[int] = [0 for _ in callbacks]
+        self.prompt_seen = False
+        self.first_token_at: float | None = None
+
+    def put(self, value):
+        if not self.prompt_seen:  # generate first passes the prompt ids, which are not part of the answer
+            self.prompt_seen = True
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if not self.streaming:
+            return
+        for row, token in enumerate(value.reshape(len(self.callbacks), -1).tolist()):
+            if self.callbacks[row] is None or len(self.tokens[row]) >= self.limits[row]:
+                continue
+            self.tokens[row].extend(token)
+            self._emit(row, final=False)
+
+    def end(self):
+        for row, callback in enumerate(self.callbacks):
+            if callback is not None:
+                self._emit(row, final=True)
+
+    def _emit(self, row: int, final: bool):
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        if not final and text.endswith("\ufffd"):  # wait for the rest of a multibyte character
+            return
+        if len(text) > self.printed[row]:
+            self.callbacks[row](text[self.printed[row] :])
+            self.printed[row] = len(text)
+
+
+class TransformersBackend(GenerationBackend):
+    """Huggingface transformers model, 4-bit quantized with bitsandbytes on CUDA, generating batches of prompts together"""
+
+    name = "transformers"
+
+    def __init__(self, model_name: str, max_batch_size: int = 8):
+        """
+        Quantize model, load it, and apply default and rag chat templates
+
+        :param model_name: Huggingface name of the model
+        :param max_batch_size: Maximum number of prompts generated together
+        """
+        self.max_batch_size = max_batch_size
+        logger.info("Initializing bitsandbytesconfig...")
+        if platform == "darwin" or not cuda.is_available():
+            # bitsandbytes not yet supported for mac, and its 4-bit kernels need CUDA
+            # https://github.com/bitsandbytes-foundation/bitsandbytes/issues/252
+            bnb_config = None
+        else:
+            from transformers import BitsAndBytesConfig
+
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=bfloat16,
+            )
+
+        logger.info(f"Loading model from {model_name=}")
+        model = AutoModelForCausalLM.from_pretrained(model_name, quantization_config=bnb_config)
+        logger.info(f"Loading tokenizer from {model_name=}")
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token  # required to batch prompts of different lengths
+        tokenizer.padding_side = "left"
+        self.rag_prompt = tokenizer.apply_chat_template(RAG_PROMPT, tokenize=False, add_generation_prompt=True)
+        self.prompt = tokenizer.apply_chat_template(PROMPT, tokenize=False, add_generation_prompt=True)
+
+        self.generation_kwargs = dict(do_sample=True, max_new_tokens=MAX_NEW_TOKENS, temperature=TEMPERATURE, repetition_penalty=REPETITION_PENALTY)
+        self.llm = pipeline(task="text-generation", model=model, tokenizer=tokenizer, return_full_text=False, **self.generation_kwargs)
+        self.prefix_cache = PrefixCache(self.llm.model, self.llm.tokenizer)
+
+    def register_prefix(self, prefix: str):
+        self.prefix_cache.register(prefix)
+
+    def generate(
+        self, prompts: List[str], callbacks: List[Optional[TokenCallback]], max_new_tokens: Optional[List[Optional[int]]] = None
+    ) -> List[str]:
+        """
+        Run the llm over a batch of prompts. Prompts sharing a cached prefix are generated together, reusing the
+        prefix's keys/values so only their own part is encoded.
+
+        :param prompts: Fully formatted prompts
+        :param callbacks: Per prompt callback receiving text as it is generated, None if the prompt is not streamed
+        :param max_new_tokens: Per prompt limit of the answer's length in tokens, `MAX_NEW_TOKENS` where None or not given
+        """
+        limits = [limit or MAX_NEW_TOKENS for limit in (max_new_tokens or [None] * len(prompts))]
+        encoded = [self.llm.tokenizer.encode(prompt, add_special_tokens=False) for prompt in prompts]
+        groups: dict[str | None, List[int]] = {}
+        for i, (prompt, ids) in enumerate(zip(prompts, encoded)):
+            groups.setdefault(self.prefix_cache.match(prompt, ids), []).append(i)
+
+        answers = [""] * len(prompts)
+        for prefix, indices in groups.items():
+            group_answers = self._generate_group([encoded[i] for i in indices], [callbacks[i] for i in indices], [limits[i] for i in indices], prefix)
+            for i, answer in zip(indices, group_answers):
+                answers[i] = answer
+        return answers
+
+    def _generate_group(self, encoded: List[List[int]], callbacks: List[Optional[TokenCallback]], limits: List[int], prefix: str | None) -> List[str]:
+        """
+        Generate prompts starting with the same prefix in one batch
+
+        :param encoded: Token ids of the fully formatted prompts
+        :param callbacks: Per prompt callback receiving text as it is generated, None if the prompt is not streamed
+        :param limits: Per prompt limit of the answer's length in tokens
+        :param prefix: Cached prefix shared by all prompts, None to encode the prompts from scratch
+        """
+        tokenizer, model = self.llm.tokenizer, self.llm.model
+        generate_kwargs = dict(self.generation_kwargs, max_new_tokens=max(limits))
+        prefix_ids = []
+        if prefix is not None:
+            prefix_ids, generate_kwargs["past_key_values"] = self.prefix_cache.get(prefix, len(encoded))
+            encoded = [ids[len(prefix_ids) :] for ids in encoded]
+        streamer = generate_kwargs["streamer"] = BatchStreamer(tokenizer, callbacks, limits)
+
+        # padding goes between the shared prefix and each prompt's own part, positions are derived from the attention mask
+        width = max(len(ids) for ids in encoded)
+        input_ids = [prefix_ids + [tokenizer.pad_token_id] * (width - len(ids)) + ids for ids in encoded]
+        attention_mask = [[1] * len(prefix_ids) + [0] * (width - len(ids)) + [1] * len(ids) for ids in encoded]
+        t_start = time.perf_counter()
+        with no_grad():
+            output = model.generate(
+                input_ids=tensor(input_ids, device=model.device),
+                attention_mask=tensor(attention_mask, device=model.device),
+                pad_token_id=tokenizer.pad_token_id,
+                **generate_kwargs,
+            )
+        observe_generation(t_start, streamer.first_token_at)
+        return tokenizer.batch_decode([row[:limit] for row, limit in zip(output[:, len(input_ids[0]) :], limits)], skip_special_tokens=True)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.llm.tokenizer.encode(text, add_special_tokens=False))
+
+
+class LlamaCppBackend(GenerationBackend):
+    """
+    GGUF model run by llama.cpp, int4/int8 quantized with multi-threaded CPU matmuls.
+
+    Prompts are generated one after another. llama.cpp keeps the tokens it evaluated for the previous prompt and
+    only evaluates where the next one differs, so the shared template and identity are not encoded again.
+    """
+
+    name = "llamacpp"
+
+    def __init__(self, model_name: str, model_file: str | None = None, n_threads: int | None = None, n_ctx: int = 4096):
+        """
+        :param model_name: Path of a GGUF file, or a Huggingface repo holding GGUF files
+        :param model_file: Filename or glob of the GGUF file to download from the repo, defaults to the Q4_K_M quantization
+        :param n_threads: CPU threads used for generation, all cores if None
+        :param n_ctx: Context window in tokens
+        """
+        from llama_cpp import Llama  # optional dependency, only needed for this backend
+        from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+        threads = n_threads or os.cpu_count()
+        kwargs = dict(n_ctx=n_ctx, n_threads=threads, n_threads_batch=threads, verbose=False)
+        logger.info(f"Loading GGUF model from {model_name=} with {threads} threads")
+        if os.path.isfile(model_name):
+            self.llm = Llama(model_path=model_name, **kwargs)
+        else:
+            self.llm = Llama.from_pretrained(repo_id=model_name, filename=model_file or "*Q4_K_M.gguf", **kwargs)
+
+        template = self.llm.metadata.get("tokenizer.chat_template")
+        if template is None:
+            raise ValueError(f"{model_name} does not contain a chat template")
+        self.bos = self._token_text(self.llm.token_bos())
+        formatter = Jinja2ChatFormatter(template=template, eos_token=self._token_text(self.llm.token_eos()), bos_token=self.bos)
+        self.rag_prompt = formatter(messages=RAG_PROMPT).prompt
+        self.prompt = formatter(messages=PROMPT).prompt
+
+    def _token_text(self, token: int) -> str:
+        return self.llm.detokenize([token], special=True).decode("utf-8", errors="ignore") if token >= 0 else ""
+
+    def _tokenize(self, text: str, add_bos: bool) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+    def generate(
+        self, prompts: List[str], callbacks: List[Optional[TokenCallback]], max_new_tokens: Optional[List[Optional[int]]] = None
+    ) -> List[str]:
+        answers = []
+        for prompt, callback, limit in zip(prompts, callbacks, max_new_tokens or [None] * len(prompts)):
+            tokens = self._tokenize(prompt, add_bos=not (self.bos and prompt.startswith(self.bos)))  # the template may add it already
+            answer, t_start, first_token_at = "", time.perf_counter(), None
+            for chunk in self.llm.create_completion(
+                tokens, max_tokens=limit or MAX_NEW_TOKENS, temperature=TEMPERATURE, repeat_penalty=REPETITION_PENALTY, stream=True
+            ):
+                first_token_at = first_token_at or time.perf_counter()
+                text = chunk["choices"][0]["text"]
+                answer += text
+                if callback is not None and text:
+                    callback(text)
+            observe_generation(t_start, first_token_at)
+            answers.append(answer)
+        return answers
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._tokenize(text, add_bos=False))
+
+
+def load_backend(backend: str, model_name: str, max_batch_size: int = 8) -> GenerationBackend:
+    """
+    Load the generation backend named `backend`
+
+    :param backend: `transformers` or `llamacpp`
+    :param model_name: Huggingface name of the model, or for llamacpp a GGUF file or repo
+    :param max_batch_size: Maximum number of prompts generated together, if the backend batches at all
+    """
+    if backend == "transformers":
+        return TransformersBackend(model_name, max_batch_size=max_batch_size)
+    if backend == "llamacpp":
+        return LlamaCppBackend(model_name, model_file=os.getenv("GGUF_FILE"), n_threads=int(os.getenv("LLM_THREADS") or 0) or None)
+    raise ValueError(f"Unknown llm backend `{backend}`, valid backends are {tuple(DEFAULT_MODELS)}")
@@ -0,0 +1,403 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from llm_discord_bot.constants import MMR_LAMBDA, SPLIT_BATCH_DOCS, SPLIT_PROCESSES
+
+logger = logging.getLogger("BENCHMARK")
+
+SCHEMA_VERSION = 1
+BENCHMARKS = ("split", "embed", "index", "search", "generate")
+# small enough to run on a laptop CPU, they have to be in the Huggingface cache since the suite runs offline
+EMBEDDING_MODEL = "thenlper/gte-small"
+LLM_MODELS = {"transformers": "HuggingFaceTB/SmolLM2-135M-Instruct"}
+
+
+class Results:
+    """Named measurements of one run, each with its unit and whether higher or lower is better"""
+
+    def __init__(self):
+        self.metrics: dict[str, dict] = {}
+
+    def add(self, name: str, value: float, unit: str, better: str):
+        """
+        :param name: Dotted name, unique within a run and stable between runs, e.g. `search.flat.n10000.p95_ms`
+        :param value: Measured value
+        :param unit: Unit of the value
+        :param better: `higher` or `lower`
+        """
+        self.metrics[name] = {"value": round(float(value), 4), "unit": unit, "better": better}
+        logger.info(f"{name} = {value:.4g} {unit}")
+
+
+def median_time(fn: Callable[[], object], repeat: int) -> float:
+    """Median wall time of `repeat` calls of `fn` in seconds"""
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t_start)
+    return float(np.median(times))
+
+
+def latencies(fn: Callable[[int], object], n: int) -> np.ndarray:
+    """Wall time of `fn(i)` for i in range(n) in milliseconds"""
+    times = np.empty(n)
+    for i in range(n):
+        t_start = time.perf_counter()
+        fn(i)
+        times[i] = (time.perf_counter() - t_start) * 1000
+    return times
+
+
+def add_percentiles(results: Results, name: str, times: np.ndarray):
+    for p in (50, 95, 99):
+        results.add(f"{name}.p{p}_ms", np.percentile(times, p), "ms", "lower")
+
+
+# region corpora
+def synthetic_words(count: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(count)]
+
+
+def synthetic_corpus(docs: int, doc_bytes: int, seed: int = 0) -> List[Document]:
+    """
+    Markdown-like documents of random words, the same for the same arguments so runs stay comparable
+
+    :param docs: Number of documents
+    :param doc_bytes: Approximate size of each document
+    :param seed: Seed of the word choice
+    """
+    rng = random.Random(seed)
+    words = synthetic_words(5000, seed)
+    corpus = []
+    for i in range(docs):
+        parts, size = [f"# Document {i}\n"], 0
+        while size < doc_bytes:
+            if rng.random() < 0.1:
+                part = f"\n## Section {len(parts)}\n"
+            else:
+                part = " ".join(rng.choices(words, k=rng.randint(20, 120))) + ".\n\n"
+            parts.append(part)
+            size += len(part)
+        corpus.append(Document(page_content="".join(parts), metadata={"title": f"doc-{i}", "source": f"source-{i % 10}"}))
+    return corpus
+
+
+def synthetic_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Unit vectors drawn around a few hundred centres, so neighbourhoods look more like real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, n // 100), dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, len(centres), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class VectorsOnly(Embeddings):
+    """Stands in for the embedding model of stores that are only searched by vector"""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError("index benchmarks search by vector")
+
+    def embed_query(self, text: str) -> List[float]:
+        raise NotImplementedError("index benchmarks search by vector")
+
+
+# endregion
+
+
+# region benchmarks
+def bench_split(results: Results, args: argparse.Namespace, corpus: List[Document]):
+    """Documents split per second in the ingestion thread and with the worker pool"""
+    from llm_discord_bot.splitting import DocumentSplitter
+
+    size = sum(len(doc.page_content.encode("utf-8")) for doc in corpus) / 1e6
+    batches = [corpus[i : i + SPLIT_BATCH_DOCS] for i in range(0, len(corpus), SPLIT_BATCH_DOCS)]
+    for processes in sorted({1, args.split_processes}):
+        splitter = DocumentSplitter(args.embedding_model, chunk_size=512, processes=processes)
+        try:
+            # load the tokenizers, of the workers too, outside the measurement
+            list(splitter.split_batches((i, batch[:1]) for i, batch in enumerate(batches[:processes])))
+            chunks = sum(len(chunks) for _, chunks in splitter.split_batches(enumerate(batches)))
+            seconds = median_time(lambda: list(splitter.split_batches(enumerate(batches))), args.repeat)
+        finally:
+            splitter.close()
+        results.add(f"split.p{processes}.mb_per_s", size / seconds, "mB/s", "higher")
+        results.add(f"split.p{processes}.chunks_per_s", chunks / seconds, "chunks/s", "higher")
+
+
+def bench_embed(results: Results, args: argparse.Namespace, corpus: List[Document]):
+    """Chunks embedded per second and query embedding latency"""
+    from llm_discord_bot.embeddings import EmbeddingEngine
+    from llm_discord_bot.splitting import split_documents
+
+    texts = [doc.page_content for doc in split_documents(args.embedding_model, 512, corpus)][: args.embed_chunks]
+    engine = EmbeddingEngine(model_name=args.embedding_model, device="cpu", processes=args.embedding_processes)
+    try:
+        engine.embed_documents(texts[:8])  # warm up
+        seconds = median_time(lambda: engine.embed_documents(texts), args.repeat)
+        results.add("embed.documents.chunks_per_s", len(texts) / seconds, "chunks/s", "higher")
+        queries = [" ".join(text.split()[:12]) for text in texts[: args.queries]]
+        add_percentiles(results, "embed.query", latencies(lambda i: engine.embed_query(queries[i % len(queries)]), args.queries))
+    finally:
+        engine.close()
+
+
+def _store(vectors: np.ndarray, offset: int = 0):
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    texts = [f"chunk {offset + i}" for i in range(len(vectors))]
+    return FAISS.from_embeddings(
+        list(zip(texts, vectors.tolist())),
+        VectorsOnly(),
+        metadatas=[{"title": f"source-{(offset + i) % 10}", "source": f"source-{(offset + i) % 10}"} for i in range(len(vectors))],
+        distance_strategy=DistanceStrategy.COSINE,
+    )
+
+
+def _engine(path: Path, index_type: str):
+    from llm_discord_bot.index_engine import IndexConfig, IndexEngine
+
+    path.mkdir(parents=True, exist_ok=True)
+    engine = IndexEngine(path)
+    engine.config = IndexConfig(index_type=index_type, min_train_size=0)  # the benchmark picks the type, not the environment
+    return engine
+
+
+def bench_index(results: Results, args: argparse.Namespace, work_dir: Path):
+    """Time to build a store from embeddings, write it as a segment, load it, merge into it and build approximate indexes"""
+    from llm_discord_bot.segments import SegmentStore
+
+    for n in args.sizes:
+        vectors = synthetic_vectors(n + n // 10, args.dim)
+        results.add(f"index.n{n}.build_s", median_time(lambda: _store(vectors[:n]), args.repeat), "s", "lower")
+        store, extra = _store(vectors[:n]), _store(vectors[n:], offset=n)
+        path = work_dir / f"index-{n}"
+        segments = SegmentStore(path, VectorsOnly())
+        results.add(f"index.n{n}.save_s", median_time(lambda: segments.append(store), 1), "s", "lower")
+        results.add(f"index.n{n}.load_s", median_time(lambda: SegmentStore(path, VectorsOnly()).load(), args.repeat), "s", "lower")
+        results.add(f"index.n{n}.load_mmap_s", median_time(lambda: SegmentStore(path, VectorsOnly(), mmap=True).load(), args.repeat), "s", "lower")
+        for index_type in args.index_types:
+            engine = _engine(path / index_type, index_type)
+            loaded = SegmentStore(path, VectorsOnly()).load()
+            if index_type != "flat":
+                results.add(f"index.{index_type}.n{n}.prepare_s", median_time(lambda: engine.prepare(loaded), 1), "s", "lower")
+            results.add(f"index.{index_type}.n{n}.merge_s", median_time(lambda: engine.add(loaded, extra), 1), "s", "lower")
+
+
+def bench_search(results: Results, args: argparse.Namespace, work_dir: Path):
+    """Similarity and MMR search latency percentiles and recall against exact search, per index type and corpus size"""
+    for n in args.sizes:
+        vectors = synthetic_vectors(n, args.dim)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.integers(0, n, args.queries)] + 0.1 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        exact = np.argsort(-(queries @ vectors.T), axis=1)[:, : args.k]
+        for index_type in args.index_types:
+            store = _engine(work_dir / f"search-{n}-{index_type}", index_type).prepare(_store(vectors))
+            name = f"search.{index_type}.n{n}"
+            found = []
+            times = latencies(lambda i: found.append(store.similarity_search_with_score_by_vector(queries[i].tolist(), k=args.k)), args.queries)
+            add_percentiles(results, name, times)
+            results.add(f"{name}.qps", 1000 / times.mean(), "queries/s", "higher")
+            hits = [len({int(doc.page_content.split()[1]) for doc, _ in docs} & set(exact[i].tolist())) for i, docs in enumerate(found)]
+            results.add(f"{name}.recall_at_{args.k}", np.mean(hits) / args.k, "fraction", "higher")
+            mmr = latencies(
+                lambda i: store.max_marginal_relevance_search_by_vector(queries[i].tolist(), k=10, fetch_k=30, lambda_mult=MMR_LAMBDA), args.queries
+            )
+            add_percentiles(results, f"{name}.mmr", mmr)
+
+
+def bench_generate(results: Results, args: argparse.Namespace, corpus: List[Document]):
+    """Prefill and decode throughput of single prompts, and total throughput of a batch, with and without retrieved context"""
+    from llm_discord_bot.backends import load_backend
+
+    backend = load_backend(args.backend, args.llm, max_batch_size=args.batch_size)
+    if args.backend == "transformers":
+        from transformers import set_seed
+
+        set_seed(0)  # sampled answers, the seed keeps their lengths the same between runs
+    identity = "You are a helpful assistant"
+    words = synthetic_words(200, seed=1)
+    prompts = {
+        "short": [backend.prompt.format(identity=identity, query=f"What does {w} mean?", context="") for w in words[: args.prompts]],
+        "rag": [
+            backend.rag_prompt.format(identity=identity, query=f"What does {w} mean?", context=corpus[i % len(corpus)].page_content[:6000])
+            for i, w in enumerate(words[: args.prompts])
+        ],
+    }
+    backend.generate(prompts["short"][:1], [None])  # warm up
+    for kind, batch in prompts.items():
+        prefill, decode, first_token = [], [], []
+        for prompt in batch:
+            first = []
+            t_start = time.perf_counter()
+            answer = backend.generate([prompt], [lambda text: first or first.append(time.perf_counter())])[0]
+            t_end = time.perf_counter()
+            if not first:
+                continue
+            generated = backend.count_tokens(answer)
+            prefill.append(backend.count_tokens(prompt) / (first[0] - t_start))
+            first_token.append((first[0] - t_start) * 1000)
+            if generated > 1 and t_end > first[0]:
+                decode.append((generated - 1) / (t_end - first[0]))
+        if prefill:
+            results.add(f"generate.{kind}.prefill_tokens_per_s", np.median(prefill), "tokens/s", "higher")
+            results.add(f"generate.{kind}.first_token_ms", np.median(first_token), "ms", "lower")
+        if decode:
+            results.add(f"generate.{kind}.decode_tokens_per_s", np.median(decode), "tokens/s", "higher")
+        if backend.max_batch_size > 1:
+            batch = batch[: backend.max_batch_size]
+            t_start = time.perf_counter()
+            answers = backend.generate(batch, [None] * len(batch))
+            tokens = sum(backend.count_tokens(answer) for answer in answers)
+            results.add(f"generate.{kind}.batch{len(batch)}_tokens_per_s", tokens / (time.perf_counter() - t_start), "tokens/s", "higher")
+
+
+# endregion
+
+
+def environment() -> dict:
+    """Where the run happened, results are only comparable on the same machine"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Print the change of every metric present in both runs
+
+    :param current: Results of this run
+    :param baseline: Results of an earlier run
+    :param threshold: Relative change in the bad direction that counts as a regression, e.g. 0.1 for 10%
+    :return: Names of the regressed metrics
+    """
+    if baseline.get("schema") != current["schema"]:
+        logger.warning(f"Baseline has schema {baseline.get('schema')}, this run {current['schema']}")
+    if baseline.get("environment", {}).get("machine") != current["environment"]["machine"]:
+        logger.warning("Baseline was measured on another machine, differences may not mean much")
+    regressions = []
+    for name, metric in current["metrics"].items():
+        old = baseline.get("metrics", {}).get(name)
+        if old is None or not old["value"]:
+            continue
+        change = metric["value"] / old["value"] - 1
+        worse = -change if metric["better"] == "higher" else change
+        flag = "REGRESSION" if worse > threshold else ("improved" if -worse > threshold else "")
+        if flag == "REGRESSION":
+            regressions.append(name)
+        print(f"{name:<52} {old['value']:>12.4g} -> {metric['value']:>12.4g} {metric['unit']:<10} {change:+8.1%} {flag}")
+    return regressions
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="ldbot-bench", description="Offline benchmarks of ingestion, retrieval and generation")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"Comma separated benchmarks to run, any of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression, exits with 1 if any")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Corpus sizes in chunks of the index and search benchmarks")
+    parser.add_argument("--index-types", default="flat,hnsw,ivf_flat", help="Index types of the index and search benchmarks")
+    parser.add_argument("--dim", type=int, default=384, help="Dimension of the synthetic vectors, 384 like gte-small")
+    parser.add_argument("--k", type=int, default=5, help="Number of documents retrieved per search")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries per latency measurement")
+    parser.add_argument("--docs", type=int, default=2000, help="Number of documents of the synthetic corpus")
+    parser.add_argument("--doc-bytes", type=int, default=2000, help="Size of each synthetic document")
+    parser.add_argument("--embed-chunks", type=int, default=1024, help="Number of chunks embedded per measurement")
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL)
+    parser.add_argument("--embedding-processes", type=int, default=1)
+    parser.add_argument("--split-processes", type=int, default=SPLIT_PROCESSES)
+    parser.add_argument("--backend", default="transformers", help="Generation backend, transformers or llamacpp")
+    parser.add_argument("--llm", help="Model of the generation backend, a small transformers model by default, a GGUF file for llamacpp")
+    parser.add_argument("--prompts", type=int, default=4, help="Number of prompts per generation measurement")
+    parser.add_argument("--batch-size", type=int, default=4, help="Batch size of the batched generation measurement")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of each timing, the median is reported")
+    parser.add_argument("--online", action="store_true", help="Allow downloading models that are not cached yet")
+    args = parser.parse_args(argv)
+    args.only = [name for name in args.only.split(",") if name]
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.index_types = args.index_types.split(",")
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks {sorted(unknown)}")
+    args.llm = args.llm or LLM_MODELS.get(args.backend)
+    if "generate" in args.only and args.llm is None:
+        parser.error(f"--llm is required for the {args.backend} backend")
+    return args
+
+
+def main(argv: List[str] | None = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if not args.online:  # set before anything imports the Huggingface libraries
+        os.environ["HF_HUB_OFFLINE"] = "1"
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    results = Results()
+    corpus = synthetic_corpus(args.docs, args.doc_bytes) if {"split", "embed", "generate"} & set(args.only) else []
+    with tempfile.TemporaryDirectory(prefix="ldbot-bench-") as work_dir:
+        for name in args.only:
+            logger.info(f"Running {name} benchmark")
+            t_start = time.perf_counter()
+            if name == "split":
+                bench_split(results, args, corpus)
+            elif name == "embed":
+                bench_embed(results, args, corpus)
+            elif name == "index":
+                bench_index(results, args, Path(work_dir))
+            elif name == "search":
+                bench_search(results, args, Path(work_dir))
+            else:
+                bench_generate(results, args, corpus)
+            logger.info(f"Finished {name} benchmark in {time.perf_counter() - t_start:.1f}s")
+
+    config = {key: (str(value) if isinstance(value, Path) else value) for key, value in vars(args).items() if key not in ("output", "compare")}
+    run = {
+        "schema": SCHEMA_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "config": config,
+        "metrics": results.metrics,
+    }
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=4)
+        logger.info(f"Wrote results to {args.output}")
+    else:
+        json.dump(run, sys.stdout, indent=4)
+        print()
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(run, json.load(f), args.threshold)
+        if regressions:
+            logger.warning(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,11 @@
 import asyncio
 import os
 import json
-from pathlib import Path
+import time
 from platform import python_version, system, release
 
-from discord import Intents, Message, Embed, Object
+from discord import Intents, Message, Embed, Guild, Object, RawMessageUpdateEvent, RawMessageDeleteEvent
+from discord.abc import Messageable
 from discord import __version__ as __discord_version__
 from discord.ext import commands
 from discord.ext.commands import Context
@@ -12,12 +13,17 @@ from dotenv import load_dotenv
 
 import logging
 
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.documents import Document
-from transformers import pipeline
 
-from llm_discord_bot.constants import DEFAULT_CONFIG
-from llm_discord_bot.utils import filter_mentions, split_message, remove_id
+from llm_discord_bot.admission import OVERLOADED, QUEUE_FULL, USER_LIMIT, AdmissionQueue, Ticket
+from llm_discord_bot.client import LlmClient
+from llm_discord_bot.constants import DEFAULT_CONFIG, METRICS_HOST
+from llm_discord_bot.history import ChannelHistory
+from llm_discord_bot.ingestion import DONE
+from llm_discord_bot.metrics import metrics, serve_metrics
+from llm_discord_bot.pdf import PdfExtractor
+from llm_discord_bot.streaming import StreamingReply
+from llm_discord_bot.utils import filter_mentions, namespace_name, split_message, remove_id
 
 logger = logging.getLogger("BOT")
 
@@ -25,12 +31,20 @@ load_dotenv()
 intents = Intents.default()
 intents.message_content = True
 
+# replies to mentions the admission queue turned away
+SHED_REPLIES = {
+    USER_LIMIT: "I'm still working on your other questions, please ask again once I've answered them",
+    QUEUE_FULL: "Too many questions are waiting for an answer right now, please ask again in a minute",
+    OVERLOADED: "I'm too busy to answer in time right now, please ask again in a minute",
+}
+
 
 class Bot(commands.Bot):
-    def __init__(self, llm, config_file):
+    def __init__(self, llm: LlmClient, config_file):
         self.prefix: str = "!"
         self.rag: bool = False
-        self.llm: pipeline = llm
+        self.llm: LlmClient = llm
+        self.llm_ready = False  # the models stay loaded once they are, so their status is not asked again
         self.llm_config: json = None
         self.guild: Object = Object(id=os.getenv("DISCORD_GUILD_ID"))
 
@@ -40,6 +54,21 @@ class Bot(commands.Bot):
             help_command=None,
         )
         self.load_config(config_file)
+        self.llm.on_finished = self._ingest_finished
+        self.history = ChannelHistory(
+            lines=self.llm_config["history_lines"], max_channels=self.llm_config.get("history_channels", DEFAULT_CONFIG["history_channels"])
+        )
+        self.pdf_extractor = PdfExtractor(processes=self.llm_config.get("pdf_processes", DEFAULT_CONFIG["pdf_processes"]))
+        self.admission = AdmissionQueue(
+            max_active=self.llm_config.get("max_active_replies", DEFAULT_CONFIG["max_active_replies"]),
+            max_queued=self.llm_config.get("max_queued_replies", DEFAULT_CONFIG["max_queued_replies"]),
+            max_per_user=self.llm_config.get("max_replies_per_user", DEFAULT_CONFIG["max_replies_per_user"]),
+            slo=self.llm_config.get("reply_queue_slo", DEFAULT_CONFIG["reply_queue_slo"]),
+        )
+        metrics.gauge("replies_active", lambda: self.admission.active)
+        metrics.gauge("replies_queued", lambda: self.admission.queued)
+        self.log_prompts = os.getenv("LOG_PROMPTS", "").lower() in ("1", "true", "yes")
+        self.metrics_runner = None
 
     @staticmethod
     async def on_command_completion(context: Context) -> None:
@@ -86,6 +115,9 @@ class Bot(commands.Bot):
         logger.info(f"discord.py API version: {__discord_version__}")
         logger.info(f"Python version: {python_version()}")
         logger.info(f"Running on: {system()} {release()} ({os.name})")
+        self.llm.start()  # models load in the background while the bot connects
+        if os.getenv("METRICS_PORT"):
+            self.metrics_runner = await serve_metrics(os.getenv("METRICS_HOST", METRICS_HOST), int(os.getenv("METRICS_PORT")))
         await self.load_cogs()
         try:
             synced = await self.tree.sync(guild=self.guild)
@@ -93,20 +125,63 @@ class Bot(commands.Bot):
         except Exception as e:
             logger.error(f"Error syncing commands: {e}")
 
-    async def _respond(self, message: Message, history_text: str):
+    async def close(self) -> None:
+        await self.llm.close()
+        self.pdf_extractor.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+
+    def namespace(self, guild: Guild | None, channel: Messageable) -> str:
+        """
+        Knowledge base used in a channel, shared by the whole guild unless `channel_namespaces` is configured
+
+        :param guild: Discord guild, None for direct messages
+        :param channel: Discord channel
+        """
+        per_channel = self.llm_config.get("channel_namespaces", DEFAULT_CONFIG["channel_namespaces"])
+        if guild is None:
+            return namespace_name(None, channel.id)
+        return namespace_name(guild.id, channel.id if per_channel else None)
+
+    async def _respond(self, message: Message, history_text: str, degraded: bool = False):
         """
         Private function that generates a response from the llm
 
         :param message: Discord message object
         :param history_text: The discord channel history for context
+        :param degraded: Answer in the cheaper mode used under load, without retrieval and with fewer tokens
         """
+        t_start = time.perf_counter()
         async with message.channel.typing():
             prompt = remove_id(message.content)
-            bot_response, docs = await asyncio.to_thread(
-                self.llm.response, query=prompt, context=history_text, identity=self.llm_config["identity"], rag=self.rag
+            kwargs = dict(
+                query=prompt,
+                context=history_text,
+                identity=self.llm_config["identity"],
+                rag=self.rag and not degraded,
+                namespace=self.namespace(message.guild, message.channel),
+                max_new_tokens=self.llm_config.get("degraded_max_tokens", DEFAULT_CONFIG["degraded_max_tokens"]) if degraded else None,
             )
-            filtered_bot_response = filter_mentions(bot_response)
-            if docs:
+            if self.llm_config.get("stream_responses", DEFAULT_CONFIG["stream_responses"]):
+                stream, docs = await self.llm.astream_response(**kwargs)
+                reply = StreamingReply(message.channel, self.llm_config.get("stream_edit_interval", DEFAULT_CONFIG["stream_edit_interval"]))
+                async for text in stream:
+                    if not reply.text and reply.message is None:
+                        metrics.observe("first_reply", time.perf_counter() - t_start)
+                    with metrics.timer("discord_send"):
+                        await reply.write(text)
+                with metrics.timer("discord_send"):
+                    await reply.close()
+            else:
+                bot_response, docs = await self.llm.aresponse(**kwargs)
+                metrics.observe("first_reply", time.perf_counter() - t_start)
+                with metrics.timer("discord_send"):
+                    for chunk in split_message(filter_mentions(bot_response)):
+                        await message.channel.send(chunk)
+            metrics.observe("reply", time.perf_counter() - t_start)
+
+            if docs and self.log_prompts:
                 for i, doc in enumerate(docs):
                     data = None
                     if isinstance(doc, Document):
@@ -118,9 +193,55 @@ class Bot(commands.Bot):
                     if data:
                         logger.info(f"Source Number {i}:\n\n{data}")
 
-            message_chunks = split_message(filtered_bot_response)
-            for chunk in message_chunks:
-                await message.channel.send(chunk)
+    def _ingest_finished(self, job: dict):
+        """
+        Called by the llm client once a job is done, reports the result in the channel the job came from
+
+        :param job: Summary of the finished ingestion job
+        """
+        channel = self.get_channel(job["channel_id"]) if job["channel_id"] is not None else None
+        if channel is None:
+            return
+        if job["status"] == DONE:
+            text = f"Processed `{job['name']}` and merged into database in {round(job['finished'] - job['started'], 1)} seconds"
+            if job.get("deduplicated"):
+                text += f", skipped {job['deduplicated']} chunks that were already stored"
+        else:
+            text = f"I had an error when trying to merge `{job['name']}` into the database; {job['error']}"
+        asyncio.run_coroutine_threadsafe(channel.send(embed=Embed(description=text, color=0xD75BF4)), self.loop)
+
+    async def _history_text(self, message: Message) -> str:
+        """
+        Channel history preceding `message`, fetched from discord only if the channel's buffer is cold
+
+        :param message: Discord message object
+        """
+        lines = self.history.get(message.channel.id)
+        if lines is None:
+            logger.info(f"Fetching history of channel {message.channel.id}")
+            with metrics.timer("history_fetch"):
+                fetched = [history async for history in message.channel.history(limit=self.llm_config["history_lines"], before=message)]
+            fetched.reverse()
+            self.history.seed(message.channel.id, [(history.id, history.author.name, history.content) for history in fetched])
+            lines = self.history.get(message.channel.id)
+        return "\n".join(lines)
+
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        """
+        Triggers upon any message edited in the guild, keeps the buffered history up to date
+
+        :param payload: Raw edit event, also received for messages outside the client's cache
+        """
+        if "content" in payload.data:
+            self.history.edit(payload.channel_id, payload.message_id, payload.data["content"])
+
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
+        """
+        Triggers upon any message deleted in the guild, keeps the buffered history up to date
+
+        :param payload: Raw delete event, also received for messages outside the client's cache
+        """
+        self.history.delete(payload.channel_id, payload.message_id)
 
     async def on_message(self, message: Message):
         """
@@ -128,59 +249,79 @@ class Bot(commands.Bot):
 
         :param message: A discord Message object
         """
+        mentioned = message.author != self.user and self.user.mentioned_in(message)
+        history_text = await self._history_text(message) if mentioned else ""
+        self.history.append(message.channel.id, message.id, message.author.name, message.content)
+
         # never reply to yourself
         if message.author == self.user:
             return
 
-        # grab channel history
-        history_list = []
-        channel_history = [user async for user in message.channel.history(limit=self.llm_config["history_lines"] + 1)]
-        for history in channel_history:
-            if remove_id(history.content) != remove_id(message.content):
-                history_list.append(history.author.name + ": " + remove_id(history.content))
-        history_list.reverse()
-        history_text = "\n".join(history_list)
-
-        # process text or PDF attachments
-        # would have been cleaner to reside in llmrag but the code is async
-        if message.attachments is not None:
+        # queue text or PDF attachments for the background ingestion worker
+        # would have been cleaner to reside in llmrag but reading attachments is async
+        if message.attachments:
             for attachment in message.attachments:
+                content_type = attachment.content_type or ""
                 logger.info(f"Found attachment {attachment.filename}, adding to rag database")
-                if "text" in attachment.content_type:
+                if "text" in content_type:
                     try:
                         file_content = await attachment.read()
-                        file_string = file_content.decode("utf-8")
-                        self.llm.merge_to_db(attachment.filename, attachment.size, [Document(page_content=file_string, metadata={"title": attachment.filename})])
+                        docs = [Document(page_content=file_content.decode("utf-8"), metadata={"title": attachment.filename})]
                     except UnicodeDecodeError:
                         logger.warning(f"Cannot decode {attachment.filename} as UTF-8, filetype {attachment.content_type} may be unknown")
-                elif attachment.content_type == "application/pdf":
-                    filepath = Path("tmp")
+                        continue
+                elif content_type == "application/pdf":
                     try:
-                        await attachment.save(fp=filepath)
-                        loader = PyPDFLoader(filepath)
-                        docs = await loader.aload()
-                        for doc in docs:
-                            doc.metadata = {"title": attachment.filename}
-                        self.llm.merge_to_db(attachment.filename, attachment.size, docs)
+                        docs = await self.pdf_extractor.extract(attachment)
                     except Exception as e:
                         logger.error(f"Parsing {attachment.filename} resulted in {e}")
                         await message.channel.send(f"I had an error when trying the read the PDF: {attachment.filename}; {e}")
-                        break
-                    try:
-                        os.remove(filepath)
-                    except FileNotFoundError:
-                        pass
+                        continue
                 else:
                     await message.channel.send(
                         f"I couldn't recognize the file format you attached: {attachment.content_type}.\n"
                         f"I currently support content types of `text` and `pdf`."
                     )
-                    return
-                await message.channel.send(f"Processed `{attachment.filename}` and merged into database")
-                return
-        if self.user.mentioned_in(message):
+                    continue
+                job = await self.llm.submit_documents(
+                    self.namespace(message.guild, message.channel), attachment.filename, attachment.size, docs, channel_id=message.channel.id
+                )
+                await message.channel.send(
+                    f"Queued `{attachment.filename}` for merging into the database as job {job['job_id']}, see `/jobs` for progress"
+                )
+            return
+        if mentioned:
             logger.info(f"Direct message received from author={message.author.name}, generating response...")
-            await self._respond(message, history_text)
+            metrics.inc("mentions")
+            ticket = self.admission.request(message.channel.id, message.author.id)
+            if ticket.shed:
+                await message.channel.send(SHED_REPLIES[ticket.decision])
+                return
+            try:
+                if not self.llm_ready:
+                    status = await self.llm.status()
+                    if status["error"] is not None:
+                        await message.channel.send(f"I couldn't load my models, so I can't answer: {status['error']}")
+                        return
+                    self.llm_ready = status["ready"]
+                if not self.llm_ready:
+                    await message.channel.send("I'm still warming up, I'll answer as soon as my models are loaded")
+                elif ticket.position:
+                    await message.channel.send(self._queue_notice(ticket))
+                await ticket.wait()
+                await self._respond(message, history_text, degraded=ticket.degraded)
+            finally:
+                self.admission.release(ticket)
+
+    def _queue_notice(self, ticket: Ticket) -> str:
+        """Tells a user who has to wait where their question is in the queue"""
+        text = f"You're number {ticket.position} in line"
+        wait = self.admission.estimated_wait(ticket.position)
+        if wait >= 1:
+            text += f", I'll get to your question in about {round(wait)} seconds"
+        if ticket.degraded:
+            text += ". I'm busy, so the answer will be short and without looking anything up"
+        return text
 
     async def on_command_error(self, context: Context, error: commands) -> None:
         """
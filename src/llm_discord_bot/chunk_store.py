@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import shutil
+from bisect import bisect_right
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+CHUNKS_FILE = "chunks.jsonl"
+OFFSETS_FILE = "offsets.npy"
+
+
+def _encode(doc_id: str, doc: Document) -> bytes:
+    return json.dumps({"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _commit(path: Path, offsets: List[int]):
+    """Move the written chunks into place, the offsets file is written last and marks the chunks as complete"""
+    with open(path / (CHUNKS_FILE + ".tmp"), "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(path / (CHUNKS_FILE + ".tmp"), path / CHUNKS_FILE)
+    with open(path / (OFFSETS_FILE + ".tmp"), "wb") as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path / (OFFSETS_FILE + ".tmp"), path / OFFSETS_FILE)
+
+
+def range_positions(ranges: List[List[int]]) -> np.ndarray:
+    """Positions covered by [start, end) ranges"""
+    if not ranges:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in ranges])
+
+
+def position_ranges(positions: np.ndarray) -> List[List[int]]:
+    """Sorted, unique positions as [start, end) ranges"""
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts, ends = positions[np.r_[0, breaks]], positions[np.r_[breaks - 1, len(positions) - 1]] + 1
+    return [[int(start), int(end)] for start, end in zip(starts, ends)]
+
+
+def _copy_range(source, target, start: int, end: int):
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0 and (data := source.read(min(remaining, 1 << 20))):
+        target.write(data)
+        remaining -= len(data)
+
+
+def has_chunks(path: Path) -> bool:
+    return (path / OFFSETS_FILE).exists()
+
+
+def write_chunks(path: Path, documents: Iterable[tuple[str, Document]]):
+    """
+    Write documents as one JSON line each, together with the byte offset of every line
+
+    :param path: Segment directory
+    :param documents: (docstore id, document) pairs in vector order
+    """
+    offsets = [0]
+    with open(path / (CHUNKS_FILE + ".tmp"), "wb") as f:
+        for doc_id, doc in documents:
+            f.write(_encode(doc_id, doc))
+            offsets.append(f.tell())
+    _commit(path, offsets)
+
+
+def concat_chunks(path: Path, sources: List[Path], keep: List[np.ndarray] | None = None):
+    """
+    Concatenate the chunks of several segments without decoding them
+
+    :param path: Segment directory to write to
+    :param sources: Segment directories, in vector order
+    :param keep: Boolean mask of the chunks to copy from each segment, all chunks are copied if None
+    """
+    offsets = [0]
+    with open(path / (CHUNKS_FILE + ".tmp"), "wb") as f:
+        for i, source in enumerate(sources):
+            source_offsets = np.load(source / OFFSETS_FILE)
+            lengths = np.diff(source_offsets)
+            with open(source / CHUNKS_FILE, "rb") as chunks:
+                if keep is None or keep[i].all():
+                    shutil.copyfileobj(chunks, f)
+                else:  # copy the runs of kept chunks, skipping deleted ones
+                    for start, end in position_ranges(np.flatnonzero(keep[i])):
+                        _copy_range(chunks, f, int(source_offsets[start]), int(source_offsets[end]))
+                    lengths = lengths[keep[i]]
+            offsets.extend((offsets[-1] + np.cumsum(lengths)).tolist())
+    _commit(path, offsets)
+
+
+def read_chunks(path: Path) -> List[Document]:
+    """All documents of a segment, in vector order"""
+    with open(path / CHUNKS_FILE, "r", encoding="utf-8") as f:
+        return [Document(**json.loads(line)) for line in f]
+
+
+class ChunkFile:
+    """Memory mapped chunks of one segment, a document is only decoded when it is looked up"""
+
+    def __init__(self, path: Path):
+        """
+        :param path: Segment directory
+        """
+        self.offsets = np.load(path / OFFSETS_FILE, mmap_mode="r")
+        self._data = None
+        if len(self.offsets) > 1:
+            with open(path / CHUNKS_FILE, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def read(self, position: int) -> Document:
+        return Document(**json.loads(self._data[self.offsets[position] : self.offsets[position + 1]]))
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """
+    Docstore reading the chunks of memory mapped segments from disk.
+
+    Vectors loaded from the segments are keyed by their position, see `PositionIds`. Documents added after loading
+    are kept in memory under their id until the next start, when they are read from their own segment.
+    """
+
+    def __init__(self, files: List[ChunkFile]):
+        """
+        :param files: Chunks of each segment, in vector order
+        """
+        self.files = files
+        self._starts = np.cumsum([0] + [len(file) for file in files]).tolist()
+        self._added: Dict[str, Document] = {}
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def search(self, search: int | str) -> Document | str:
+        if isinstance(search, str):
+            return self._added.get(search, f"ID {search} not found.")
+        if not 0 <= search < self._starts[-1]:
+            return f"Position {search} not found."
+        file_no = bisect_right(self._starts, search) - 1
+        return self.files[file_no].read(search - self._starts[file_no])
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        self._added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        for doc_id in ids:
+            self._added.pop(doc_id, None)
+
+
+class PositionIds(MutableMapping):
+    """`index_to_docstore_id` of a `ChunkStore`, maps the vectors loaded from disk to their position and later ones to their id"""
+
+    def __init__(self, length: int):
+        """
+        :param length: Number of vectors loaded from disk
+        """
+        self.length = length
+        self._ids: Dict[int, str] = {}
+
+    def __getitem__(self, i) -> int | str:
+        i = int(i)
+        if i in self._ids:
+            return self._ids[i]
+        if 0 <= i < self.length:
+            return i
+        raise KeyError(i)
+
+    def __setitem__(self, i, doc_id: str):
+        self._ids[int(i)] = doc_id
+
+    def __delitem__(self, i):
+        del self._ids[int(i)]
+
+    def __iter__(self) -> Iterator[int]:
+        yield from range(self.length)
+        yield from self._ids
+
+    def __len__(self) -> int:
+        return self.length + len(self._ids)
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, Optional
+
+import aiohttp
+from langchain_core.documents import Document
+
+from llm_discord_bot.constants import JOB_POLL_INTERVAL, PROFILE_DIR
+from llm_discord_bot.ingestion import DONE, FAILED
+from llm_discord_bot.profiling import Profiler
+
+logger = logging.getLogger("LLM_CLIENT")
+
+JobCallback = Callable[[dict], None]
+
+
+def encode_documents(docs: List[Document] | str | None) -> List[dict] | str | None:
+    """Retrieved documents as JSON, error messages and None are passed through"""
+    if not isinstance(docs, list):
+        return docs
+    return [{"page_content": doc.page_content, "metadata": doc.metadata, "id": doc.id} for doc in docs]
+
+
+def decode_documents(docs: List[dict] | str | None) -> List[Document] | str | None:
+    if not isinstance(docs, list):
+        return docs
+    return [Document(**doc) for doc in docs]
+
+
+def load_llmrag():
+    """Log in to Huggingface and load the llm + rag model, the heavy imports are only done here"""
+    from huggingface_hub import login
+    from llm_discord_bot.llmrag import LlmRag
+
+    login(token=os.getenv("HUGGINGFACE_TOKEN"))
+    return LlmRag(llm_model_name=os.getenv("MODEL"))
+
+
+class LocalLlmClient:
+    """
+    Runs the llm in this process, blocking calls are moved off the event loop.
+
+    The models are loaded in a background thread once `start` is called, requests made before then wait until
+    loading has finished. Has the same interface as `RemoteLlmClient`, so the bot does not care where the model lives.
+    """
+
+    def __init__(self, load_llm: Callable[[], object] = load_llmrag):
+        """
+        :param load_llm: Creates the LlmRag instance, called in a background thread
+        """
+        self._load_llm = load_llm
+        self.llm = None
+        self.on_finished: Optional[JobCallback] = None
+        self._loading: asyncio.Task | None = None
+        self._started: float | None = None
+        self._load_time: float | None = None
+        self.profiler = Profiler(Path(os.getenv("PROFILE_DIR") or Path.home() / PROFILE_DIR))
+
+    def start(self):
+        """Start loading the models in the background, must be called from the event loop"""
+        if self._loading is None:
+            self._started = time.monotonic()
+            self._loading = asyncio.create_task(asyncio.to_thread(self._load))
+
+    def _load(self):
+        llm = self._load_llm()
+        llm.ingest_queue.on_finished = self._job_finished
+        self._load_time = time.monotonic() - self._started
+        logger.info(f"Models loaded in {self._load_time:.1f}s")
+        self.llm = llm
+
+    async def _ready(self):
+        self.start()
+        await asyncio.shield(self._loading)
+
+    async def status(self) -> dict:
+        """Whether the models are loaded yet, or the error loading them failed with, never waits for them"""
+        error = None
+        if self._loading is None:
+            stage = "not started"
+        elif not self._loading.done():
+            stage = "loading models"
+        elif self._loading.exception() is not None:
+            error = str(self._loading.exception()) or type(self._loading.exception()).__name__
+            stage = f"failed: {error}"
+        else:
+            stage = "ready"
+        seconds = self._load_time if self._load_time is not None else time.monotonic() - (self._started or time.monotonic())
+        return {"ready": self.llm is not None, "error": error, "stage": stage, "seconds": round(seconds, 1)}
+
+    def _job_finished(self, job):
+        if self.on_finished is not None:
+            self.on_finished(job.summary())
+
+    async def aresponse(self, **kwargs) -> tuple[str, List[Document] | None]:
+        await self._ready()
+        return await self.llm.aresponse(**kwargs)
+
+    async def astream_response(self, **kwargs) -> tuple[AsyncIterator[str], List[Document] | None]:
+        await self._ready()
+        return await self.llm.astream_response(**kwargs)
+
+    async def info(self) -> dict:
+        await self._ready()
+        return self.llm.info()
+
+    async def database_entries(self, namespace: str) -> dict:
+        await self._ready()
+        return await asyncio.to_thread(self.llm.database_entries, namespace)  # loads the namespace if needed
+
+    async def drop_database(self, namespace: str):
+        await self._ready()
+        await asyncio.to_thread(self.llm.drop_database, namespace)
+
+    async def remove_source(self, namespace: str, source: str) -> int | None:
+        await self._ready()
+        return await asyncio.to_thread(self.llm.remove_source, namespace, source)
+
+    async def submit_documents(self, namespace: str, name: str, size: float, documents: List[Document], channel_id: int | None = None) -> dict:
+        await self._ready()
+        job = await asyncio.to_thread(self.llm.ingest_queue.submit_documents, namespace, name, size, documents, channel_id=channel_id)
+        return job.summary()
+
+    async def submit_dataset(self, namespace: str, dataset: str, split: str, column: str, channel_id: int | None = None) -> dict:
+        await self._ready()
+        job = await asyncio.to_thread(self.llm.ingest_queue.submit_dataset, namespace, dataset, split, column, channel_id=channel_id)
+        return job.summary()
+
+    async def is_pending(self, namespace: str, name: str | None = None) -> bool:
+        await self._ready()
+        return self.llm.ingest_queue.is_pending(namespace, name)
+
+    async def jobs(self, namespace: str | None = None) -> tuple[List[dict], dict]:
+        """Ingestion jobs and their statistics, only those of `namespace` if given"""
+        await self._ready()
+        jobs = [job.summary() for job in self.llm.ingest_queue.jobs()]
+        if namespace is not None:
+            jobs = [job for job in jobs if (job["namespace"] or self.llm.default_namespace) == namespace]
+        return jobs, self.llm.ingest_queue.stats(namespace)
+
+    async def stats(self) -> dict | None:
+        """Metrics of the llm, None since they are recorded in this process alongside the bot's"""
+        return None
+
+    async def profile(self, seconds: float, torch_ops: bool = False) -> dict | None:
+        """
+        Profile this process, see `Profiler.capture`
+
+        :param seconds: Length of the capture
+        :param torch_ops: Also record the torch operators of the next generation
+        :return: Summary of the profile, None if one is already running
+        """
+        if torch_ops:
+            await self._ready()
+        return await self.profiler.capture(seconds, scheduler=self.llm.scheduler if torch_ops else None)
+
+    async def stop_profile(self) -> bool:
+        return self.profiler.stop()
+
+    async def close(self):
+        if self.llm is not None:
+            await asyncio.to_thread(self.llm.close)
+
+
+class RemoteLlmClient:
+    """
+    Talks to an inference server started with `ldbot-server`, see `server.py`.
+
+    Several bot processes can share one server, each is told about the ingestion jobs it submitted by polling
+    the server's job list.
+    """
+
+    def __init__(self, url: str, poll_interval: float = JOB_POLL_INTERVAL):
+        """
+        :param url: Base url of the inference server, e.g. http://127.0.0.1:8765
+        :param poll_interval: Seconds between checks on submitted ingestion jobs
+        """
+        self.url = url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.on_finished: Optional[JobCallback] = None
+        self._session: aiohttp.ClientSession | None = None
+        self._tracked: set[int] = set()
+        self._poller: asyncio.Task | None = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily, a session has to be created inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=10))
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs):
+        async with self._get_session().request(method, self.url + path, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def aresponse(self, **kwargs) -> tuple[str, List[Document] | None]:
+        result = await self._request("POST", "/response", json=kwargs)
+        return result["answer"], decode_documents(result["docs"])
+
+    async def astream_response(self, **kwargs) -> tuple[AsyncIterator[str], List[Document] | None]:
+        response = await self._get_session().post(self.url + "/stream", json=kwargs)
+        try:
+            response.raise_for_status()
+            docs = decode_documents(json.loads(await response.content.readline())["docs"])
+        except Exception:
+            response.release()
+            raise
+
+        async def stream():
+            async with response:
+                async for line in response.content:
+                    if line.strip():
+                        yield json.loads(line)["text"]
+
+        return stream(), docs
+
+    def start(self):
+        pass
+
+    async def status(self) -> dict:
+        return await self._request("GET", "/status")
+
+    async def info(self) -> dict:
+        return await self._request("GET", "/info")
+
+    async def stats(self) -> dict | None:
+        """Metrics recorded by the server process"""
+        return await self._request("GET", "/stats")
+
+    async def profile(self, seconds: float, torch_ops: bool = False) -> dict | None:
+        """Profile the server process, the files are written on the server's machine"""
+        return (await self._request("POST", "/profile", json={"seconds": seconds, "torch": torch_ops}))["profile"]
+
+    async def stop_profile(self) -> bool:
+        return (await self._request("POST", "/profile/stop"))["stopped"]
+
+    async def database_entries(self, namespace: str) -> dict:
+        return await self._request("GET", "/entries", params={"namespace": namespace})
+
+    async def drop_database(self, namespace: str):
+        await self._request("POST", "/wipe", json={"namespace": namespace})
+
+    async def remove_source(self, namespace: str, source: str) -> int | None:
+        return (await self._request("POST", "/remove", json={"namespace": namespace, "source": source}))["removed"]
+
+    async def submit_documents(self, namespace: str, name: str, size: float, documents: List[Document], channel_id: int | None = None) -> dict:
+        payload = {"namespace": namespace, "name": name, "size": size, "documents": encode_documents(documents), "channel_id": channel_id}
+        return self._track(await self._request("POST", "/ingest/documents", json=payload))
+
+    async def submit_dataset(self, namespace: str, dataset: str, split: str, column: str, channel_id: int | None = None) -> dict:
+        payload = {"namespace": namespace, "dataset": dataset, "split": split, "column": column, "channel_id": channel_id}
+        return self._track(await self._request("POST", "/ingest/dataset", json=payload))
+
+    async def is_pending(self, namespace: str, name: str | None = None) -> bool:
+        params = {"namespace": namespace} if name is None else {"namespace": namespace, "name": name}
+        return (await self._request("GET", "/jobs/pending", params=params))["pending"]
+
+    async def jobs(self, namespace: str | None = None) -> tuple[List[dict], dict]:
+        result = await self._request("GET", "/jobs", params={} if namespace is None else {"namespace": namespace})
+        return result["jobs"], result["stats"]
+
+    def _track(self, job: dict) -> dict:
+        self._tracked.add(job["job_id"])
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_jobs())
+        return job
+
+    async def _poll_jobs(self):
+        """Reports finished jobs submitted by this client through `on_finished`"""
+        while self._tracked:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                jobs, _ = await self.jobs()
+            except aiohttp.ClientError as e:
+                logger.warning(f"Could not check ingestion jobs: {e}")
+                continue
+            known = {job["job_id"]: job for job in jobs}
+            for job_id in list(self._tracked):
+                job = known.get(job_id)
+                if job is None or job["status"] in (DONE, FAILED):
+                    self._tracked.discard(job_id)
+                    if job is not None and self.on_finished is not None:
+                        self.on_finished(job)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+
+LlmClient = LocalLlmClient | RemoteLlmClient
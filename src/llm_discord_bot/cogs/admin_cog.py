@@ -3,6 +3,10 @@ import os
 from discord.ext import commands
 from discord.ext.commands import Context
 from discord import Object, Embed, app_commands
+from table2ascii import table2ascii as t2a, PresetStyle, Alignment
+
+from llm_discord_bot.constants import MAX_PROFILE_SECONDS
+from llm_discord_bot.metrics import metrics
 
 
 class Admin(commands.Cog, name="admin"):
@@ -24,6 +28,97 @@ class Admin(commands.Cog, name="admin"):
         await context.send(embed=Embed(description="Quitting, see ya later...", color=0xBEBEFE))
         await self.bot.close()
 
+    @commands.hybrid_command(
+        name="stats",
+        description="Show where time goes in answering and ingesting",
+    )
+    @commands.is_owner()
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def stats(self, context: Context) -> None:
+        """
+        Show the latency of every stage of the request and ingestion pipelines, and the counters
+
+        :param context: command context
+        """
+        await context.defer()  # extends required response time
+        snapshot = metrics.snapshot()
+        remote = await self.bot.llm.stats()  # recorded by the inference server if the llm runs there
+        if remote is not None:
+            for key in snapshot:
+                snapshot[key] = remote[key] | snapshot[key]
+        body = [
+            [stage, timing["count"], *(f"{timing[field] * 1000:.1f}" for field in ("avg", "p50", "p95", "max"))]
+            for stage, timing in sorted(snapshot["stages"].items())
+        ]
+        output = t2a(
+            header=["Stage", "Count", "Avg ms", "p50 ms", "p95 ms", "Max ms"],
+            body=body or [["-", 0, "-", "-", "-", "-"]],
+            style=PresetStyle.thin_compact,
+            alignments=[Alignment.LEFT] + [Alignment.RIGHT] * 5,
+        )
+        counters = ", ".join(f"{name}: {round(value, 2):g}" for name, value in sorted((snapshot["counters"] | snapshot["gauges"]).items()))
+        await context.send(f"```\n{output}\n```{counters[:500]}")
+
+    @commands.hybrid_command(
+        name="profile",
+        description="Profile the process running the llm for some seconds and post its hotspots",
+    )
+    @commands.is_owner()
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def profile(self, context: Context, seconds: int = 30, torch: bool = False) -> None:
+        """
+        Sample every thread of the process running the llm, the event loop and the generation and ingestion workers,
+        and write the samples as a flamegraph
+
+        :param context: command context
+        :param seconds: How long to profile for, `/profilestop` ends it early
+        :param torch: Also record the torch operators of the next generation, which is slowed down by it
+        """
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            await context.send(embed=Embed(description=f"Can profile for 1 to {MAX_PROFILE_SECONDS} seconds", color=0xE02B2B))
+            return
+        await context.defer()  # extends required response time
+        result = await self.bot.llm.profile(seconds, torch)
+        if result is None:
+            await context.send(embed=Embed(description="Already profiling, end it with `/profilestop`", color=0xE02B2B))
+            return
+        output = t2a(
+            header=["Function", "Self %", "Total %"],
+            body=[[function[:60], own, total] for function, own, total in result["hotspots"]] or [["nothing ran", "-", "-"]],
+            style=PresetStyle.thin_compact,
+            alignments=[Alignment.LEFT, Alignment.RIGHT, Alignment.RIGHT],
+        )
+        threads = ", ".join(f"{thread} {busy}%" for thread, busy in list(result["threads"].items())[:6])
+        files = ", ".join(f"`{file}`" for file in result["files"])
+        await context.send(
+            f"Profiled {result['samples']} samples over {result['seconds']}s, busy threads: {threads or 'none'}\n```\n{output}\n```Written to {files}"
+        )
+        if result["operators"] is not None:
+            operators = t2a(
+                header=["Operator", "Self CPU ms", "Calls"],
+                body=[[name[:40], ms, calls] for name, ms, calls in result["operators"]],
+                style=PresetStyle.thin_compact,
+                alignments=[Alignment.LEFT, Alignment.RIGHT, Alignment.RIGHT],
+            )
+            await context.send(f"Torch operators of one generation:\n```\n{operators}\n```")
+        elif torch:
+            await context.send("No generation ran while profiling, so no operators were recorded")
+
+    @commands.hybrid_command(
+        name="profilestop",
+        description="End a running profile early",
+    )
+    @commands.is_owner()
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def profile_stop(self, context: Context) -> None:
+        """
+        End a running `/profile`, its results are posted where it was started
+
+        :param context: command context
+        """
+        stopped = await self.bot.llm.stop_profile()
+        await context.send(embed=Embed(description="Stopping the profile" if stopped else "Not profiling", color=0xBEBEFE))
+
 
 async def setup(bot) -> None:
     await bot.add_cog(Admin(bot))
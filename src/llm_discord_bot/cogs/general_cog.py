@@ -42,13 +42,39 @@ class General(commands.Cog, name="general"):
 
         :param context: command context
         """
-        embed = Embed(
-            description=f"Generating conversation with model: {self.bot.llm.llm_model_name}\n"
-            f"Generating embeddings with model: {self.bot.llm.embedding_model_name}",
-            color=0xBEBEFE,
-        )
-        embed.set_author(name="Bot Information")
-        embed.add_field(name="Rag Enabled:", value=self.bot.rag)
+        status = await self.bot.llm.status()
+        if status["error"] is not None:
+            embed = Embed(description=f"Loading the models failed after {status['seconds']}s: {status['error']}", color=0xE02B2B)
+            embed.set_author(name="Bot Information")
+            embed.add_field(name="Rag Enabled:", value=self.bot.rag)
+        elif not status["ready"]:
+            embed = Embed(description=f"Not ready yet, {status['stage']} for {status['seconds']}s", color=0xBEBEFE)
+            embed.set_author(name="Bot Information")
+            embed.add_field(name="Rag Enabled:", value=self.bot.rag)
+        else:
+            info = await self.bot.llm.info()
+            embed = Embed(
+                description=f"Generating conversation with model: {info['llm_model_name']} ({info['llm_backend']})\n"
+                f"Generating embeddings with model: {info['embedding_model_name']}",
+                color=0xBEBEFE,
+            )
+            embed.set_author(name="Bot Information")
+            embed.add_field(name="Rag Enabled:", value=self.bot.rag)
+            embed.add_field(name="Startup:", value=f"Models loaded in {status['seconds']}s")
+            stats = info["generation"]
+            embed.add_field(
+                name="Generation:",
+                value=f"{stats['tokens_per_second']} tokens/s, {stats['avg_queue_wait']}s avg queue wait, {stats['queue_depth']} queued",
+                inline=False,
+            )
+            namespaces = info["namespaces"]
+            embed.add_field(name="Databases:", value=f"{namespaces['loaded']} loaded, {round(namespaces['memory_bytes'] / 1e6, 2)} mB", inline=False)
+            if (cache := info["response_cache"]) is not None:
+                embed.add_field(
+                    name="Response Cache:",
+                    value=f"{round(cache['hit_rate'] * 100, 1)}% hit rate ({cache['hits']} hits, {cache['misses']} misses)",
+                    inline=False,
+                )
         embed.add_field(name="Python Version:", value=f"{platform.python_version()}", inline=True)
         embed.add_field(
             name="Prefix:",
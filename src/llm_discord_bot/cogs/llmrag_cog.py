@@ -1,6 +1,4 @@
 import os
-import time
-import asyncio
 import logging
 from dotenv import load_dotenv
 from discord.ext import commands
@@ -48,18 +46,66 @@ class Dataset(commands.Cog, name="llm"):
         :param column: The column we will store as a document in the DB, all other columns will be disregarded.
         """
         await context.defer()  # extends required response time
-        if dataset not in self.bot.llm.db_entries:
-            await context.send(embed=Embed(description=f"Loading {dataset=} on {split=}", color=0xD75BF4))
-            t_start = time.time()
-            errors = await asyncio.to_thread(self.bot.llm.merge_dataset_to_db, huggingface_dataset=dataset, split=split, column=column)
-            if not errors:
-                await context.send(
-                    embed=Embed(description=f"Finished Loading {dataset=} in {round(time.time() - t_start, 1)} seconds", color=0xD75BF4)
-                )
-            else:
-                await context.send(embed=Embed(description=errors))
-        else:
+        namespace = self.bot.namespace(context.guild, context.channel)
+        if dataset in await self.bot.llm.database_entries(namespace) or await self.bot.llm.is_pending(namespace, dataset):
             await context.send(embed=Embed(description=f"{dataset=} already exists in the database"))
+        else:
+            job = await self.bot.llm.submit_dataset(namespace, dataset, split, column, channel_id=context.channel.id)
+            await context.send(
+                embed=Embed(description=f"Queued {dataset=} on {split=} as job {job['job_id']}, see `/jobs` for progress", color=0xD75BF4)
+            )
+
+    @commands.hybrid_command(
+        name="remove",
+        description="Remove one dataset or file from the database used in this channel",
+    )
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def remove_source(self, context: Context, source: str) -> None:
+        """
+        Remove one dataset or file, everything else in the database is kept
+
+        :param context: command context
+        :param source: Name of the dataset or file as listed by `/dbinfo`
+        """
+        await context.defer()  # extends required response time
+        namespace = self.bot.namespace(context.guild, context.channel)
+        if await self.bot.llm.is_pending(namespace, source):
+            await context.send(embed=Embed(description=f"{source} is still being ingested, see `/jobs`"))
+            return
+        removed = await self.bot.llm.remove_source(namespace, source)
+        if removed is None:
+            await context.send(embed=Embed(description=f"{source} is not in the database"))
+        else:
+            await context.send(embed=Embed(description=f"Removed {source} ({removed} chunks)", color=0xD75BF4))
+
+    @commands.hybrid_command(
+        name="refresh",
+        description="Re-embed one HuggingFace Dataset, to update a file upload it again",
+    )
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def refresh_dataset(self, context: Context, dataset: str, split: str | None = None, column: str | None = None) -> None:
+        """
+        Re-embed one HuggingFace Dataset, its old chunks are replaced once the new version has loaded
+
+        :param context: command context
+        :param dataset: HF dataset link as listed by `/dbinfo`
+        :param split: HF dataset split, defaults to the one the dataset was added with
+        :param column: The column we will store as a document in the DB, defaults to the one the dataset was added with
+        """
+        await context.defer()  # extends required response time
+        namespace = self.bot.namespace(context.guild, context.channel)
+        entries = await self.bot.llm.database_entries(namespace)
+        if await self.bot.llm.is_pending(namespace, dataset):
+            await context.send(embed=Embed(description=f"{dataset} is already being ingested, see `/jobs`"))
+        elif dataset not in entries:
+            await context.send(embed=Embed(description=f"{dataset=} is not in the database, use `/add` to add it"))
+        else:
+            split = split or entries[dataset].get("split", "train")  # datasets added by older versions only have a size
+            column = column or entries[dataset].get("column", "text")
+            job = await self.bot.llm.submit_dataset(namespace, dataset, split, column, channel_id=context.channel.id)
+            await context.send(
+                embed=Embed(description=f"Queued refresh of {dataset=} on {split=} as job {job['job_id']}, see `/jobs` for progress", color=0xD75BF4)
+            )
 
     @commands.hybrid_command(
         name="rag",
@@ -79,7 +125,7 @@ class Dataset(commands.Cog, name="llm"):
 
     @commands.hybrid_command(
         name="wipe",
-        description="Wipe database of all datasets and documents",
+        description="Wipe the database used in this channel of all datasets and documents",
     )
     @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
     async def wipe_database(self, context: Context) -> None:
@@ -89,6 +135,10 @@ class Dataset(commands.Cog, name="llm"):
         :param context: command context
         """
         await context.defer()  # extends required response time
+        namespace = self.bot.namespace(context.guild, context.channel)
+        if await self.bot.llm.is_pending(namespace):
+            await context.send(embed=Embed(description="Files or datasets are still being ingested into the database, see `/jobs`"))
+            return
         view = ConfirmView()
         message = await context.send("Are you sure?", view=view)
         await view.wait()
@@ -96,25 +146,26 @@ class Dataset(commands.Cog, name="llm"):
 
         if view.value is None:
             await context.send(embed=Embed(description="Timed out."))
+        elif view.value and await self.bot.llm.is_pending(namespace):  # queued while confirming
+            await context.send(embed=Embed(description="Files or datasets are still being ingested into the database, see `/jobs`"))
         elif view.value:
             await context.send(embed=Embed(description="Confirmed, wiping database"))
-            await asyncio.to_thread(self.bot.llm.drop_database)
+            await self.bot.llm.drop_database(namespace)
         else:
             await context.send(embed=Embed(description="Cancelled"))
 
     @commands.hybrid_command(
         name="dbinfo",
-        description="Get the list of Huggingface datasets and their sizes in the database",
+        description="Get the list of Huggingface datasets and their sizes in the database used in this channel",
     )
     @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
     async def get_database_size(self, context: Context) -> None:
         await context.defer()  # extends required response time
         tot_size = 0
         body = []
-        if self.bot.llm.db_entries is not None:
-            for ds, size in self.bot.llm.db_entries.items():
-                tot_size += size
-                body.append([ds, f"{size} mB"])
+        for ds, entry in (await self.bot.llm.database_entries(self.bot.namespace(context.guild, context.channel))).items():
+            tot_size += entry["size"]
+            body.append([ds, f"{entry['size']} mB"])
         output = t2a(
             header=["Dataset", "Size"],
             body=body,
@@ -124,6 +175,34 @@ class Dataset(commands.Cog, name="llm"):
         )
         await context.send(f"```\n{output}\n```")
 
+    @commands.hybrid_command(
+        name="jobs",
+        description="List queued, running and recently finished ingestion jobs",
+    )
+    @app_commands.guilds(Object(id=os.getenv("DISCORD_GUILD_ID")))
+    async def list_jobs(self, context: Context) -> None:
+        """
+        List queued, running and recently finished ingestion jobs with their progress
+
+        :param context: command context
+        """
+        await context.defer()  # extends required response time
+        body = []
+        jobs, stats = await self.bot.llm.jobs(self.bot.namespace(context.guild, context.channel))
+        for job in jobs:
+            body.append([job["job_id"], job["name"][:32], job["status"], f"{round(job['progress'] * 100)}%", f"{round(job['size'] / 1e6, 2)} mB"])
+        output = t2a(
+            header=["ID", "Name", "Status", "Progress", "Size"],
+            body=body or [["-", "no jobs", "-", "-", "-"]],
+            style=PresetStyle.thin_compact,
+            alignments=[Alignment.RIGHT, Alignment.LEFT, Alignment.LEFT, Alignment.RIGHT, Alignment.RIGHT],
+        )
+        await context.send(
+            f"```\n{output}\n```"
+            f"Throughput: {round(stats['bytes_per_second'] / 1e6, 2)} mB/s, ETA: {round(stats['eta_seconds'])} seconds for "
+            f"{stats['running']} running and {stats['queued']} queued jobs"
+        )
+
 
 async def setup(bot) -> None:
     await bot.add_cog(Dataset(bot))
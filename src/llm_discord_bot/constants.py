@@ -1,5 +1,37 @@
 DATASET_LIST = "datasets.json"
+DISCORD_MESSAGE_LIMIT = 2000
 DEFAULT_INDEX = "index"
+JOBS_DIR = "jobs"
+SEGMENT_DIR = "segments"
+MANIFEST = "manifest.json"
+COMPACT_SEGMENTS = 16
+# segments with fewer chunks count as equally small when looking for similarly sized ones to compact
+COMPACT_MIN_CHUNKS = 1024
+# largest segment of a compaction is at most this many times the size of its smallest
+COMPACT_SIZE_RATIO = 2
+ANN_DIR = "ann"
+INDEX_CONFIG = "index_config.json"
+MMR_LAMBDA = 0.7
+CHECKPOINT_DIR = "checkpoints"
+DATASET_BATCH_ROWS = 1000
+DATASET_CHECKPOINT_ROWS = 20000
+EMBEDDING_BATCH_SIZE = 1024
+SPLIT_BATCH_DOCS = 256
+SPLIT_PROCESSES = 4
+INGEST_COALESCE_WINDOW = 2.0
+INGEST_COALESCE_BYTES = 50e6
+NAMESPACE_DIR = "namespaces"
+NAMESPACE_MEMORY_BYTES = 4e9
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+JOB_POLL_INTERVAL = 2.0
+METRICS_HOST = "127.0.0.1"
+PROFILE_DIR = "ldbot-profiles"
+MAX_PROFILE_SECONDS = 600
+# replies are degraded once their estimated queue wait passes this share of `reply_queue_slo`
+ADMISSION_DEGRADE_SHARE = 0.5
+# weight of the latest reply in the smoothed time a reply holds its generation slot
+ADMISSION_SERVICE_SMOOTHING = 0.2
 MARKDOWN_SEPARATORS = [
     "\n#{1,6} ",
     "```\n",
@@ -48,4 +80,14 @@ DEFAULT_CONFIG = {
     "identity": "You are a helpful assistant named llama, you are an expert in many subjects and provide carefully researched, thoughtful answers",
     "temperature": 0.7,
     "history_lines": 5,
+    "history_channels": 500,
+    "stream_responses": True,
+    "stream_edit_interval": 1.0,
+    "channel_namespaces": False,
+    "pdf_processes": 2,
+    "max_active_replies": 8,
+    "max_queued_replies": 64,
+    "max_replies_per_user": 2,
+    "reply_queue_slo": 30.0,
+    "degraded_max_tokens": 150,
 }
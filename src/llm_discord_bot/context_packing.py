@@ -0,0 +1,66 @@
+from typing import Callable, List
+
+from langchain_core.documents import Document
+
+
+def format_document(doc: Document) -> str:
+    """A retrieved document as it appears in the prompt"""
+    if hasattr(doc, "metadata") and "title" in doc.metadata:
+        return f"\n:::Document name: {doc.metadata['title']}:::\n{doc.page_content}"
+    return f"\n{doc.page_content}"
+
+
+class ContextPacker:
+    """
+    Packs channel history and retrieved documents into a fixed token budget.
+
+    Documents are taken in retrieval order, skipping exact duplicates, until `max_docs` are placed or the next one
+    does not fit. Whatever budget is left goes to the channel history, newest lines first, so history is always
+    trimmed before a document is dropped.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int = 2048):
+        """
+        :param count_tokens: Counts tokens with the llm's tokenizer
+        :param token_budget: Maximum number of tokens of history and documents in a prompt
+        """
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+
+    def pack(self, history: str, documents: List[Document] | None, max_docs: int) -> tuple[str, List[Document] | None]:
+        """
+        Build the context of a prompt
+
+        :param history: Discord channel history, one message per line
+        :param documents: Retrieved documents, most relevant first, None if RAG is not used
+        :param max_docs: Maximum number of documents placed in the context
+        :return: The context and the documents placed in it
+        """
+        budget = self.token_budget
+        documents_text, used_docs = "", None
+        if documents is not None:
+            documents_text, used_docs, seen = "\nExtracted documents:\n", [], set()
+            budget -= self.count_tokens(documents_text)
+            for doc in documents:
+                if len(used_docs) >= max_docs:
+                    break
+                if doc.page_content in seen:
+                    continue
+                text = format_document(doc)
+                tokens = self.count_tokens(text)
+                if tokens > budget:
+                    break
+                documents_text += text
+                used_docs.append(doc)
+                seen.add(doc.page_content)
+                budget -= tokens
+
+        history_lines = []
+        for line in reversed(history.split("\n") if history else []):
+            tokens = self.count_tokens(line + "\n")
+            if tokens > budget:
+                break
+            history_lines.append(line)
+            budget -= tokens
+        history_lines.reverse()
+        return "\n".join(history_lines) + documents_text, used_docs
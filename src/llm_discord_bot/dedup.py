@@ -0,0 +1,68 @@
+import hashlib
+from typing import List
+
+import numpy as np
+
+HASHES_FILE = "hashes.npy"
+
+
+def chunk_hash(text: str) -> int:
+    """64 bit content hash of a chunk, never 0 which marks removed positions"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+def chunk_hashes(texts: List[str]) -> np.ndarray:
+    return np.fromiter((chunk_hash(text) for text in texts), dtype=np.uint64, count=len(texts))
+
+
+class ChunkHashes:
+    """
+    Content hashes of the chunks in a namespace's index, by position, to skip chunks that are already stored.
+
+    Lookups binary search a sorted copy of the hashes, hashes added since it was last sorted are kept in a set
+    until there are enough of them to make re-sorting worthwhile.
+    """
+
+    def __init__(self, hashes: np.ndarray | None = None):
+        """
+        :param hashes: Hash of the chunk at each position of the loaded index
+        """
+        self.positions = np.empty(0, dtype=np.uint64) if hashes is None else hashes.astype(np.uint64)
+        self._sorted = np.empty(0, dtype=np.uint64)
+        self._recent: set[int] = set()
+        self._dirty = True
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.positions))
+
+    def _lookup_table(self) -> np.ndarray:
+        if self._dirty:
+            self._sorted = np.unique(self.positions[self.positions != 0])
+            self._recent.clear()
+            self._dirty = False
+        return self._sorted
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Boolean mask of the hashes that are already stored"""
+        table = self._lookup_table()
+        found = np.zeros(len(hashes), dtype=bool)
+        if len(table):
+            idx = np.minimum(np.searchsorted(table, hashes), len(table) - 1)
+            found = table[idx] == hashes
+        if self._recent:
+            found |= np.fromiter((int(h) in self._recent for h in hashes), dtype=bool, count=len(hashes))
+        return found
+
+    def add(self, hashes: np.ndarray):
+        """Record the hashes of chunks appended to the index"""
+        self.positions = np.concatenate([self.positions, hashes.astype(np.uint64)])
+        if not self._dirty:
+            self._recent.update(int(h) for h in hashes)
+            if len(self._recent) > max(len(self._sorted) // 4, 1024):
+                self._dirty = True
+
+    def remove(self, positions: np.ndarray):
+        """Forget the chunks at `positions`, so they are embedded again if they are added back"""
+        if len(positions):
+            self.positions[positions] = 0
+            self._dirty = True
@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger("EMBEDDINGS")
+
+QUERY, DOCUMENTS = 0, 1  # priorities, lower is served first
+
+
+class EmbeddingRequest:
+    def __init__(self, texts: List[str], priority: int):
+        self.texts = texts
+        self.priority = priority
+        self.future: Future = Future()
+        self.vectors: List[List[float] | None] = [None] * len(texts)
+        self.taken = 0  # texts handed to a batch so far
+        self.remaining = len(texts)  # texts not embedded yet
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    Long-lived embedding model shared by retrieval and ingestion.
+
+    The model (and its process pool, if any) is loaded once. A dispatcher thread gathers texts from concurrent callers
+    into micro-batches of up to `max_batch_size`, waiting at most `max_latency` seconds for a batch to fill.
+    Queries are always placed first, and large ingestion requests are split across batches, so a query never
+    waits for more than one micro-batch of an ingest.
+    """
+
+    def __init__(self, model_name: str, device: str, processes: int = 1, max_batch_size: int = 64, max_latency: float = 0.005):
+        """
+        :param model_name: The Huggingface model to use for embeddings
+        :param device: Torch device to run the model on
+        :param processes: Number of worker processes, 1 encodes in the dispatcher thread
+        :param max_batch_size: Maximum number of texts encoded together
+        :param max_latency: Seconds the first queued text waits for others to fill its batch
+        """
+        self.model = SentenceTransformer(model_name, device=device)
+        self.pool = self.model.start_multi_process_pool(target_devices=[device] * processes) if processes > 1 else None
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._pending: List[EmbeddingRequest] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._texts = 0
+        self._batches = 0
+        self._thread = threading.Thread(target=self._run, name="embedding-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        if self.pool is not None:
+            vectors = self.model.encode_multi_process(texts, self.pool, normalize_embeddings=True)
+        else:
+            vectors = self.model.encode(texts, normalize_embeddings=True, batch_size=self.max_batch_size)
+        return vectors.tolist()
+
+    def _submit(self, texts: List[str], priority: int) -> List[List[float]]:
+        if not texts:
+            return []
+        request = EmbeddingRequest(texts, priority)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The embedding engine is closed")
+            self._pending.append(request)
+            self._pending.sort(key=lambda r: (r.priority, r.enqueued_at))
+            self._cond.notify()
+        return request.future.result()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed document chunks, served after any pending queries"""
+        return self._submit(list(texts), DOCUMENTS)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a search query, served ahead of any ingestion"""
+        return self._submit([text], QUERY)[0]
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "texts": self._texts,
+                "batches": self._batches,
+                "avg_batch_size": round(self._texts / self._batches, 2) if self._batches else 0.0,
+                "pending": sum(request.remaining for request in self._pending),
+            }
+
+    def close(self):
+        """Stop the dispatcher and the process pool, requests still queued fail"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        with self._cond:
+            unserved, self._pending = self._pending, []
+        for request in unserved:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("The embedding engine was closed"))
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+    def _next_batch(self) -> List[tuple[EmbeddingRequest, int, int]] | None:
+        """Blocks for pending texts, returns (request, start, end) slices making up the next batch"""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            deadline = self._pending[0].enqueued_at + self.max_latency
+            while sum(len(r.texts) - r.taken for r in self._pending) < self.max_batch_size and (timeout := deadline - time.perf_counter()) > 0:
+                self._cond.wait(timeout=timeout)
+
+            batch, size = [], 0
+            for request in self._pending:
+                if size >= self.max_batch_size:
+                    break
+                take = min(len(request.texts) - request.taken, self.max_batch_size - size)
+                if take:
+                    batch.append((request, request.taken, request.taken + take))
+                    request.taken += take
+                    size += take
+            self._pending = [request for request in self._pending if request.taken < len(request.texts)]
+            return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            texts = [text for request, start, end in batch for text in request.texts[start:end]]
+            try:
+                vectors = self._encode(texts)
+            except Exception as e:
+                logger.error(f"Embedding a batch of {len(texts)} texts failed with {e}")
+                failed = [request for request, _, _ in batch]
+                with self._cond:
+                    self._pending = [request for request in self._pending if request not in failed]
+                for request in failed:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            offset = 0
+            for request, start, end in batch:
+                request.vectors[start:end] = vectors[offset : offset + end - start]
+                offset += end - start
+                request.remaining -= end - start
+                if request.remaining == 0 and not request.future.done():
+                    request.future.set_result(request.vectors)
+            with self._cond:
+                self._texts += len(texts)
+                self._batches += 1
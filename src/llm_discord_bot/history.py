@@ -0,0 +1,89 @@
+from collections import OrderedDict, deque
+from typing import Iterable
+
+from llm_discord_bot.utils import remove_id
+
+
+class HistoryEntry:
+    def __init__(self, message_id: int, author: str, content: str):
+        self.message_id = message_id
+        self.author = author
+        self.content = remove_id(content)
+
+    def __str__(self):
+        return f"{self.author}: {self.content}"
+
+
+class ChannelHistory:
+    """
+    Per-channel ring buffers of recent, already cleaned messages, fed from gateway events.
+
+    Only the `max_channels` most recently active channels are kept. A channel counts as warm once its buffer is full
+    or it was seeded from discord's history, until then callers should fetch the history once and `seed` it.
+    """
+
+    def __init__(self, lines: int, max_channels: int = 500):
+        """
+        :param lines: Number of messages kept per channel
+        :param max_channels: Number of channels kept before the least recently used one is evicted
+        """
+        self.lines = lines
+        self.max_channels = max_channels
+        self._channels: OrderedDict[int, deque[HistoryEntry]] = OrderedDict()
+        self._warm: set[int] = set()
+
+    def _buffer(self, channel_id: int) -> deque[HistoryEntry]:
+        if channel_id in self._channels:
+            self._channels.move_to_end(channel_id)
+        else:
+            self._channels[channel_id] = deque(maxlen=self.lines)
+            while len(self._channels) > self.max_channels:
+                evicted, _ = self._channels.popitem(last=False)
+                self._warm.discard(evicted)
+        return self._channels[channel_id]
+
+    def append(self, channel_id: int, message_id: int, author: str, content: str):
+        """Add a new message to the end of a channel's history"""
+        buffer = self._buffer(channel_id)
+        buffer.append(HistoryEntry(message_id, author, content))
+        if len(buffer) == buffer.maxlen:
+            self._warm.add(channel_id)
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        """Replace the content of a buffered message, messages that are not buffered are ignored"""
+        for entry in self._channels.get(channel_id, ()):
+            if entry.message_id == message_id:
+                entry.content = remove_id(content)
+                return
+
+    def delete(self, channel_id: int, message_id: int):
+        """Drop a buffered message, the channel turns cold since the buffer is now missing its oldest message"""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for entry in buffer:
+            if entry.message_id == message_id:
+                buffer.remove(entry)
+                self._warm.discard(channel_id)
+                return
+
+    def seed(self, channel_id: int, entries: Iterable[tuple[int, str, str]]):
+        """
+        Fill a channel's buffer from fetched history, keeping any messages that arrived while fetching
+
+        :param channel_id: Discord channel id
+        :param entries: (message id, author name, raw content) tuples, oldest first
+        """
+        buffer = self._buffer(channel_id)
+        fetched = [HistoryEntry(*entry) for entry in entries]
+        fetched_ids = {entry.message_id for entry in fetched}
+        newer = [entry for entry in buffer if entry.message_id not in fetched_ids]
+        buffer.clear()
+        buffer.extend(fetched + newer)
+        self._warm.add(channel_id)
+
+    def get(self, channel_id: int) -> list[str] | None:
+        """Formatted history lines of a channel oldest first, or None if the channel is cold"""
+        if channel_id not in self._warm:
+            return None
+        return [str(entry) for entry in self._buffer(channel_id)]
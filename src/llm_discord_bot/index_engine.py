@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+from math import sqrt
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from llm_discord_bot.constants import ANN_DIR, INDEX_CONFIG
+from llm_discord_bot.segments import SegmentedIndex
+
+logger = logging.getLogger("INDEX_ENGINE")
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+class IndexConfig:
+    def __init__(
+        self,
+        index_type: str = "flat",
+        nlist: int = 0,
+        nprobe: int = 16,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+        pq_m: int = 16,
+        pq_bits: int = 8,
+        train_size: int = 100_000,
+        min_train_size: int = 10_000,
+    ):
+        """
+        :param index_type: One of flat, hnsw, ivf_flat or ivf_pq
+        :param nlist: Number of IVF clusters, 0 picks 4 * sqrt(number of vectors)
+        :param nprobe: Number of IVF clusters searched per query, higher is slower with better recall
+        :param hnsw_m: Number of neighbours per HNSW node
+        :param ef_construction: HNSW candidate list size while building
+        :param ef_search: HNSW candidate list size while searching, higher is slower with better recall
+        :param pq_m: Number of PQ sub-quantizers, must divide the embedding dimension
+        :param pq_bits: Bits per PQ sub-quantizer code
+        :param train_size: Maximum number of vectors sampled to train IVF indexes
+        :param min_train_size: Below this many vectors the index stays flat
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type `{index_type}`, valid types are {INDEX_TYPES}")
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.pq_m = pq_m
+        self.pq_bits = pq_bits
+        self.train_size = train_size
+        self.min_train_size = min_train_size
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+    @classmethod
+    def load(cls, database_path: Path) -> "IndexConfig":
+        """
+        Index settings of a database. `INDEX_TYPE`, `INDEX_NPROBE` and `INDEX_EF_SEARCH` override the settings stored
+        with the database, and the result is stored back so the database keeps its type on the next start.
+
+        :param database_path: Database directory
+        """
+        config_file = database_path / INDEX_CONFIG
+        settings = {}
+        if config_file.exists():
+            with open(config_file, "r", encoding="utf-8") as f:
+                settings = json.load(f)
+        for key, env, cast in (("index_type", "INDEX_TYPE", str), ("nprobe", "INDEX_NPROBE", int), ("ef_search", "INDEX_EF_SEARCH", int)):
+            if os.getenv(env):
+                settings[key] = cast(os.getenv(env))
+        config = cls(**settings)
+        with open(config_file, "w", encoding="utf-8") as f:
+            json.dump(config.to_dict(), f, indent=4)
+        return config
+
+
+class IndexEngine:
+    """
+    Builds the in-memory search index of a database from its flat vectors.
+
+    The segments on disk always hold flat, exact vectors. On load they are turned into the configured approximate
+    index (trained on a sample), which is cached in the database's `ann` directory so later starts only add the
+    vectors merged since.
+    """
+
+    def __init__(self, database_path: Path):
+        """
+        :param database_path: Database directory
+        """
+        self.ann_path = database_path / ANN_DIR
+        self.config = IndexConfig.load(database_path)
+
+    @property
+    def approximate(self) -> bool:
+        return self.config.index_type != "flat"
+
+    @staticmethod
+    def is_flat(index) -> bool:
+        """Whether a loaded index is still exact, also when it hides removed vectors or is memory mapped"""
+        if isinstance(index, FilteredIndex):
+            index = index.index
+        return isinstance(index, (faiss.IndexFlat, SegmentedIndex))
+
+    def _build(self, vectors: np.ndarray) -> faiss.Index:
+        """Create, train and fill an index of the configured type"""
+        n, d = vectors.shape
+        nlist = self.config.nlist or max(1, int(4 * sqrt(n)))
+        nlist = min(nlist, max(1, n // 39))  # faiss wants roughly 39 training points per cluster
+        if self.config.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(d, self.config.hnsw_m)
+            index.hnsw.efConstruction = self.config.ef_construction
+        elif self.config.index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, nlist)
+        else:
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, self.config.pq_m, self.config.pq_bits)
+        if not index.is_trained:
+            sample = vectors
+            if n > self.config.train_size:
+                sample = vectors[np.random.default_rng(0).choice(n, self.config.train_size, replace=False)]
+            logger.info(f"Training {self.config.index_type} index with {nlist=} on {len(sample)} vectors")
+            index.train(sample)
+        index.add(vectors)
+        self._set_search_params(index)
+        return index
+
+    def _set_search_params(self, index: faiss.Index):
+        if self.config.index_type == "hnsw":
+            index.hnsw.efSearch = self.config.ef_search
+        elif self.config.index_type in ("ivf_flat", "ivf_pq"):
+            ivf = faiss.extract_index_ivf(index)
+            ivf.nprobe = self.config.nprobe
+            ivf.make_direct_map()  # lets MMR search reconstruct the retrieved vectors
+
+    def _read_cache(self, store: FAISS) -> faiss.Index | None:
+        """Cached index covering a prefix of `store`'s vectors, if it was built with the current settings"""
+        try:
+            with open(self.ann_path / "config.json", "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        if cached["config"] != self.config.to_dict() or cached["ntotal"] > store.index.ntotal:
+            return None
+        index = faiss.read_index(str(self.ann_path / "index.faiss"))
+        if cached["ntotal"] < store.index.ntotal:
+            index.add(store.index.reconstruct_n(cached["ntotal"], store.index.ntotal - cached["ntotal"]))
+        self._set_search_params(index)
+        return index
+
+    def _write_cache(self, index: faiss.Index):
+        self.ann_path.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(index, str(self.ann_path / "index.faiss.tmp"))
+        os.replace(self.ann_path / "index.faiss.tmp", self.ann_path / "index.faiss")
+        with open(self.ann_path / "config.json", "w", encoding="utf-8") as f:
+            json.dump({"config": self.config.to_dict(), "ntotal": index.ntotal}, f, indent=4)
+
+    def prepare(self, store: FAISS | None) -> FAISS | None:
+        """
+        Swap a loaded flat store's index for the configured type, migrating it if there is no cached index yet
+
+        :param store: Store loaded from the flat segments
+        """
+        if store is None or not self.approximate or store.index.ntotal < self.config.min_train_size:
+            return store
+        index = self._read_cache(store)
+        if index is None:
+            logger.info(f"Migrating flat index of {store.index.ntotal} vectors to {self.config.index_type}")
+            index = self._build(store.index.reconstruct_n(0, store.index.ntotal))
+            self._write_cache(index)
+        if isinstance(store.index, FilteredIndex):  # keep hiding the removed vectors
+            store.index.index = index
+        else:
+            store.index = index
+        return store
+
+    def add(self, target: FAISS, source: FAISS):
+        """
+        Add the vectors and documents of a flat store to `target`, whatever its index type.
+        A flat target is migrated once it has grown past `min_train_size`.
+
+        :param target: The loaded store
+        :param source: Flat store holding only the new vectors
+        """
+        offset = target.index.ntotal
+        target.index.add(source.index.reconstruct_n(0, source.index.ntotal))
+        target.docstore.add({doc_id: source.docstore.search(doc_id) for doc_id in source.index_to_docstore_id.values()})
+        for i, doc_id in source.index_to_docstore_id.items():
+            target.index_to_docstore_id[offset + i] = doc_id
+        if self.approximate and self.is_flat(target.index) and target.index.ntotal >= self.config.min_train_size:
+            self.prepare(target)
+
+
+class FilteredIndex:
+    """
+    Wraps any index to hide the vectors of removed sources from searches. Positions stay stable, so the docstore
+    mapping and cached approximate indexes remain valid, the vectors are dropped from disk by the next compaction.
+    """
+
+    def __init__(self, index):
+        """
+        :param index: Faiss index or `SegmentedIndex` to filter
+        """
+        self.index = index
+        self.hidden = np.empty(0, dtype=np.int64)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def hide(self, positions: np.ndarray):
+        self.hidden = np.union1d(self.hidden, positions)
+
+    def search(self, x: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        ntotal = self.index.ntotal
+        fetch = min(2 * k, ntotal) or k
+        while True:  # fetch more neighbours until every query has k visible ones
+            distances, ids = self.index.search(x, fetch)
+            visible = (ids >= 0) & ~np.isin(ids, self.hidden)
+            if fetch >= ntotal or visible.sum(axis=1).min() >= k:
+                break
+            fetch = min(4 * fetch, ntotal)
+        descending = self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        out_distances = np.full((len(x), k), -np.inf if descending else np.inf, dtype=np.float32)
+        out_ids = np.full((len(x), k), -1, dtype=np.int64)
+        for row in range(len(x)):
+            kept = np.flatnonzero(visible[row])[:k]
+            out_distances[row, : len(kept)], out_ids[row, : len(kept)] = distances[row, kept], ids[row, kept]
+        return out_distances, out_ids
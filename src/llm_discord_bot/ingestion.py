@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from langchain_core.documents import Document
+
+from llm_discord_bot.constants import INGEST_COALESCE_WINDOW, INGEST_COALESCE_BYTES
+from llm_discord_bot.metrics import metrics
+
+logger = logging.getLogger("INGEST")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+JOBS_FILE = "jobs.json"
+
+
+class IngestJob:
+    def __init__(
+        self,
+        job_id: int,
+        kind: str,
+        name: str,
+        namespace: str | None = None,
+        size: float = 0,
+        channel_id: int | None = None,
+        params: dict | None = None,
+        status: str = QUEUED,
+        created: float | None = None,
+        started: float | None = None,
+        finished: float | None = None,
+        error: str | None = None,
+    ):
+        """
+        :param job_id: Unique, increasing job id
+        :param kind: `documents` for uploaded files or `dataset` for Huggingface datasets
+        :param name: The filename or name of the dataset
+        :param namespace: Namespace the data is added to, the llm's default namespace if None
+        :param size: The size of the data in bytes, 0 if unknown until loaded
+        :param channel_id: Discord channel to report to once the job is finished
+        :param params: Extra arguments of the job, e.g. the split and column of a dataset
+        """
+        self.job_id = job_id
+        self.kind = kind
+        self.name = name
+        self.namespace = namespace
+        self.size = size
+        self.channel_id = channel_id
+        self.params = params or {}
+        self.status = status
+        self.created = created or time.time()
+        self.started = started
+        self.finished = finished
+        self.error = error
+        self.done_chunks = 0
+        self.total_chunks = 0
+        self.deduplicated = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "name": self.name,
+            "namespace": self.namespace,
+            "size": self.size,
+            "channel_id": self.channel_id,
+            "params": self.params,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+        }
+
+    def summary(self) -> dict:
+        """Job state including its progress, as reported to the bot"""
+        return self.to_dict() | {"progress": self.progress, "eta": self.eta, "deduplicated": self.deduplicated}
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the job's chunks that have been embedded"""
+        if self.status == DONE:
+            return 1.0
+        return self.done_chunks / self.total_chunks if self.total_chunks else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds until the running job is finished, extrapolated from its embedding progress"""
+        if self.status != RUNNING or not self.done_chunks:
+            return None
+        return (time.time() - self.started) * (self.total_chunks - self.done_chunks) / self.done_chunks
+
+
+class IngestQueue:
+    """
+    Persistent queue of files and datasets waiting to be merged into the database, served by a background worker.
+
+    Uploads that arrive within `coalesce_window` seconds of each other are merged together, so they share one
+    embedding pass and one index write. Queued jobs and their documents are stored in `jobs_path` and resumed on restart.
+    """
+
+    def __init__(self, llm, jobs_path: Path, coalesce_window: float = INGEST_COALESCE_WINDOW, keep_finished: int = 20):
+        """
+        :param llm: LlmRag instance the jobs are merged into
+        :param jobs_path: Directory for the job list and queued documents
+        :param coalesce_window: Seconds to wait for more uploads before merging the first queued one
+        :param keep_finished: Number of finished jobs to keep for `/jobs`
+        """
+        self.llm = llm
+        self.jobs_path = jobs_path
+        self.jobs_path.mkdir(parents=True, exist_ok=True)
+        self.coalesce_window = coalesce_window
+        self.keep_finished = keep_finished
+        self.on_finished: Optional[Callable[[IngestJob], None]] = None
+        self._cond = threading.Condition()
+        self._jobs: List[IngestJob] = []
+        self._next_id = 1
+        self._bytes_done = 0.0
+        self._busy_time = 0.0
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="ingest-worker", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        jobs_file = self.jobs_path / JOBS_FILE
+        if not jobs_file.exists():
+            return
+        with open(jobs_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        self._next_id = state["next_id"]
+        self._jobs = [IngestJob(**job) for job in state["jobs"]]
+        for job in self._jobs:
+            if job.status == RUNNING:  # interrupted by a restart, nothing was written for it yet
+                job.status, job.started = QUEUED, None
+        queued = sum(job.status == QUEUED for job in self._jobs)
+        if queued:
+            logger.info(f"Resuming {queued} queued ingestion jobs")
+
+    def _save(self):
+        """Atomically write the job list, caller must hold the lock"""
+        finished = [job for job in self._jobs if job.status in (DONE, FAILED)]
+        for job in finished[: -self.keep_finished or None]:
+            self._jobs.remove(job)
+        tmp_file = self.jobs_path / (JOBS_FILE + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"next_id": self._next_id, "jobs": [job.to_dict() for job in self._jobs]}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.jobs_path / JOBS_FILE)
+
+    def _payload_file(self, job: IngestJob) -> Path:
+        return self.jobs_path / f"{job.job_id}.json"
+
+    def _submit(self, job_kwargs: dict, documents: List[Document] | None = None) -> IngestJob:
+        with self._cond:
+            job = IngestJob(job_id=self._next_id, **job_kwargs)
+            self._next_id += 1
+            if documents is not None:
+                with open(self._payload_file(job), "w", encoding="utf-8") as f:
+                    json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents], f, ensure_ascii=False)
+            self._jobs.append(job)
+            self._save()
+            self._cond.notify()
+        logger.info(f"Queued ingestion job {job.job_id} for {job.name}")
+        return job
+
+    def submit_documents(self, namespace: str, name: str, size: float, documents: List[Document], channel_id: int | None = None) -> IngestJob:
+        """
+        Queue a file for merging into the database
+
+        :param namespace: Namespace to add the file to
+        :param name: The filename
+        :param size: The size of the file in bytes
+        :param documents: The file's content as a list of Langchain Document(s)
+        :param channel_id: Discord channel to report to once the job is finished
+        """
+        return self._submit(dict(kind="documents", name=name, namespace=namespace, size=size, channel_id=channel_id), documents)
+
+    def submit_dataset(self, namespace: str, dataset: str, split: str, column: str, channel_id: int | None = None) -> IngestJob:
+        """
+        Queue a Huggingface dataset for merging into the database
+
+        :param namespace: Namespace to add the dataset to
+        :param dataset: Huggingface dataset path
+        :param split: Dataset split name to use
+        :param column: Dataset column name to use
+        :param channel_id: Discord channel to report to once the job is finished
+        """
+        return self._submit(dict(kind="dataset", name=dataset, namespace=namespace, channel_id=channel_id, params={"split": split, "column": column}))
+
+    def is_pending(self, namespace: str, name: str | None = None) -> bool:
+        """Whether a queued or running job is ingesting `name`, or anything if None, into `namespace`"""
+        with self._cond:
+            return any(self._namespace(job) == namespace and name in (None, job.name) and job.status in (QUEUED, RUNNING) for job in self._jobs)
+
+    def _namespace(self, job: IngestJob) -> str:
+        return job.namespace or self.llm.default_namespace
+
+    def jobs(self) -> List[IngestJob]:
+        """Queued, running and recently finished jobs, oldest first"""
+        with self._cond:
+            return list(self._jobs)
+
+    def stats(self, namespace: str | None = None) -> dict:
+        """
+        Ingestion throughput and the estimated time until the queue is empty
+
+        :param namespace: Only count the jobs of this namespace, the estimate is until its last job is done
+        """
+        with self._cond:
+            throughput = self._bytes_done / self._busy_time if self._busy_time else 0.0
+            jobs = [job for job in self._jobs if namespace is None or self._namespace(job) == namespace]
+            eta, waiting = 0.0, 0.0  # jobs are served in order, so jobs of other namespaces ahead are waited for
+            for job in self._jobs:
+                if job.status == RUNNING:
+                    waiting += job.eta or 0.0
+                elif job.status == QUEUED and throughput:
+                    waiting += job.size / throughput
+                if job.status in (QUEUED, RUNNING) and (namespace is None or self._namespace(job) == namespace):
+                    eta = waiting
+            return {
+                "queued": sum(job.status == QUEUED for job in jobs),
+                "running": sum(job.status == RUNNING for job in jobs),
+                "bytes_per_second": round(throughput, 1),
+                "eta_seconds": round(eta, 1),
+            }
+
+    def _next_batch(self) -> List[IngestJob]:
+        """Blocks until a job is queued, returns it together with any uploads it can be merged with"""
+        with self._cond:
+            while not (queued := [job for job in self._jobs if job.status == QUEUED]):
+                self._cond.wait()
+            first = queued[0]
+            if first.kind == "dataset":
+                return [first]
+            # wait for uploads arriving shortly after the first one
+            while (remaining := first.created + self.coalesce_window - time.time()) > 0:
+                self._cond.wait(timeout=remaining)
+            batch, size = [], 0.0
+            for job in self._jobs:
+                if (
+                    job.status == QUEUED
+                    and job.kind == "documents"
+                    and self._namespace(job) == self._namespace(first)
+                    and (not batch or size + job.size <= INGEST_COALESCE_BYTES)
+                ):
+                    batch.append(job)
+                    size += job.size
+            return batch
+
+    def _set_progress(self, batch: List[IngestJob], done: int, total: int):
+        for job in batch:
+            job.done_chunks, job.total_chunks = done, total
+
+    def _add_deduplicated(self, batch: List[IngestJob], count: int):
+        for job in batch:
+            job.deduplicated += count
+
+    def _process(self, batch: List[IngestJob]):
+        progress = partial(self._set_progress, batch)
+        deduplicated = partial(self._add_deduplicated, batch)
+        namespace = self._namespace(batch[0])
+        if batch[0].kind == "dataset":
+            job = batch[0]
+            error = self.llm.merge_dataset_to_db(namespace, huggingface_dataset=job.name, progress=progress, deduplicated=deduplicated, **job.params)
+            if error:
+                raise ValueError(error)
+            job.size = self.llm.database_entries(namespace).get(job.name, {}).get("size", 0) * 1e6
+        else:
+            sources = []
+            for job in batch:
+                with open(self._payload_file(job), "r", encoding="utf-8") as f:
+                    sources.append((job.name, job.size, [Document(**doc) for doc in json.load(f)]))
+            self.llm.merge_many_to_db(namespace, sources, progress, deduplicated)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            t_start = time.time()
+            with self._cond:
+                for job in batch:
+                    job.status, job.started = RUNNING, t_start
+                self._save()
+
+            error = None
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Ingesting {', '.join(job.name for job in batch)} failed with {e}")
+                error = str(e)
+
+            t_end = time.time()
+            with self._cond:
+                for job in batch:
+                    job.status, job.finished, job.error = (FAILED if error else DONE), t_end, error
+                    self._payload_file(job).unlink(missing_ok=True)
+                if not error:
+                    self._bytes_done += sum(job.size for job in batch)
+                    self._busy_time += t_end - t_start
+                self._save()
+            logger.info(f"Finished ingestion of {len(batch)} job(s) in {t_end - t_start:.1f}s")
+            metrics.observe("ingest_job", t_end - t_start)
+            for job in batch:
+                metrics.observe("ingest_queue_wait", t_start - job.created)
+            metrics.inc("ingest_jobs", len(batch), status=FAILED if error else DONE)
+            if self.on_finished is not None:
+                for job in batch:
+                    self.on_finished(job)
@@ -1,220 +1,597 @@
+import asyncio
 import logging
 import os
-import shutil
+import re
 import json
-from sys import platform
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pandas import set_option
 from dotenv import load_dotenv
-from typing import List
-from torch import bfloat16, cuda
-from transformers import AutoTokenizer, pipeline, AutoModelForCausalLM
-from datasets import load_dataset
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import AsyncIterator, Callable, List, Optional
+from torch import cuda
 from langchain.docstore.document import Document
 from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-
-from llm_discord_bot.constants import RAG_PROMPT, PROMPT, MARKDOWN_SEPARATORS, DEFAULT_INDEX, DATASET_LIST
+from langchain_core.embeddings import Embeddings
+
+from llm_discord_bot.constants import (
+    DATASET_LIST,
+    EMBEDDING_BATCH_SIZE,
+    JOBS_DIR,
+    CHECKPOINT_DIR,
+    DATASET_BATCH_ROWS,
+    DATASET_CHECKPOINT_ROWS,
+    SPLIT_BATCH_DOCS,
+    SPLIT_PROCESSES,
+    MMR_LAMBDA,
+    NAMESPACE_MEMORY_BYTES,
+)
+from llm_discord_bot.ingestion import IngestQueue
+from llm_discord_bot.backends import DEFAULT_MODELS, load_backend
+from llm_discord_bot.context_packing import ContextPacker
+from llm_discord_bot.dedup import chunk_hashes
+from llm_discord_bot.embeddings import EmbeddingEngine
+from llm_discord_bot.metrics import metrics
+from llm_discord_bot.namespaces import Namespace, NamespaceManager
+from llm_discord_bot.prefix_cache import prompt_prefix
+from llm_discord_bot.response_cache import ResponseCache
+from llm_discord_bot.scheduler import GenerationScheduler
+from llm_discord_bot.splitting import DocumentSplitter
+from llm_discord_bot.utils import namespace_name
 
 # region logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("LLM_RAG")
 # endregion
 
-set_option("display.max_colwidth", None)
+ProgressCallback = Callable[[int, int], None]
+DedupCallback = Callable[[int], None]
+
 load_dotenv()
 
 
 # region classes
+class PendingChunks:
+    """
+    Chunks embedded by a merge that are not written to disk yet. They only become part of the loaded index once their
+    segment is written, so a merge that fails midway leaves the namespace as it is on disk.
+    """
+
+    def __init__(self):
+        self.store: FAISS | None = None
+        self.documents: List[Document] = []
+        self.hashes: List[np.ndarray] = []
+        self.skipped: List[Document] = []  # duplicates of stored chunks, referenced once the merge is written
+        self.skipped_hashes: List[np.ndarray] = []
+        self._known: set[int] = set()
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Boolean mask of the hashes of chunks embedded by this merge"""
+        return np.fromiter((int(h) in self._known for h in hashes), dtype=bool, count=len(hashes))
+
+    def add(self, store: FAISS, documents: List[Document], hashes: np.ndarray):
+        if self.store is None:
+            self.store = store
+        else:
+            self.store.merge_from(store)
+        self.documents.extend(documents)
+        self.hashes.append(hashes)
+        self._known.update(int(h) for h in hashes)
+
+    def skip(self, documents: List[Document], hashes: np.ndarray):
+        self.skipped.extend(documents)
+        self.skipped_hashes.append(hashes)
+
+
 class LlmRag:
     def __init__(
         self,
         llm_model_name: str,
         embedding_model_name: str = "thenlper/gte-small",
+        max_batch_size: int = 8,
     ):
+        t_start = time.time()
         self.embedding_model_name = embedding_model_name
-        self.embedding_model = self._initialize_embedding_model(embedding_model_name)
-        self.database_path, self.loaded_index, self.db_entries = self._initialize_database(embedding_model=self.embedding_model)
-        self.llm_model_name = llm_model_name or "meta-llama/Llama-3.2-3B-Instruct"
-        self.llm = self._initialize_llm(model_name=llm_model_name)
+        self.backend_name = os.getenv("LLM_BACKEND") or "transformers"
+        if self.backend_name not in DEFAULT_MODELS:
+            raise ValueError(f"Unknown llm backend `{self.backend_name}`, valid backends are {tuple(DEFAULT_MODELS)}")
+        self.llm_model_name = llm_model_name or DEFAULT_MODELS[self.backend_name]
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-loader") as pool:
+            # the llm does not depend on the embedding model or database, so it is loaded alongside them
+            llm_future = pool.submit(load_backend, self.backend_name, self.llm_model_name, max_batch_size)
+            self.embedding_model = self._initialize_embedding_model(embedding_model_name)
+            self.splitter = DocumentSplitter(embedding_model_name, chunk_size=512, processes=int(os.getenv("SPLIT_PROCESSES") or SPLIT_PROCESSES))
+            self.database_path, self.namespaces = self._initialize_database(embedding_model=self.embedding_model)
+            with self.namespaces.use(self.default_namespace):
+                logger.info(f"Loaded embedding model and database in {time.time() - t_start:.1f}s")
+            self.response_cache = ResponseCache.from_env()
+            self.backend = llm_future.result()
+        logger.info(f"Loaded llm with the {self.backend_name} backend in {time.time() - t_start:.1f}s")
+        self.context_packer = ContextPacker(self._count_tokens, token_budget=int(os.getenv("CONTEXT_TOKENS") or 2048))
+        self.ingest_queue = IngestQueue(self, self.database_path / JOBS_DIR)
+        self.scheduler = GenerationScheduler(
+            generate_fn=self.backend.generate, count_tokens=self._count_tokens, max_batch_size=min(max_batch_size, self.backend.max_batch_size)
+        )
+        # full prompts and answers hold user content and are large, they are only logged when asked for
+        self.log_prompts = os.getenv("LOG_PROMPTS", "").lower() in ("1", "true", "yes")
+        metrics.gauge("generation_queue_depth", lambda: self.scheduler.queue_depth)
+        metrics.gauge("ingest_queued_jobs", lambda: self.ingest_queue.stats()["queued"])
+        metrics.gauge("namespaces_loaded_bytes", lambda: self.namespaces.stats()["memory_bytes"])
 
     @staticmethod
     def _initialize_embedding_model(model_name):
         """
-        Load Huggingface embedding model
+        Load Huggingface embedding model, kept warm for the lifetime of the bot
 
         :param model_name: THe Huggingface model to use for embeddings
         """
         logger.info(f"Loading embedding {model_name=}")
         device = "cuda" if cuda.is_available() else "cpu"
-        return HuggingFaceEmbeddings(
-            model_name=model_name, multi_process=True, model_kwargs={"device": device}, encode_kwargs={"normalize_embeddings": True}
-        )
+        return EmbeddingEngine(model_name=model_name, device=device, processes=int(os.getenv("EMBEDDING_PROCESSES") or 1))
 
-    @staticmethod
-    def _initialize_database(
-        embedding_model: HuggingFaceEmbeddings,
-    ) -> (Path, FAISS, dict[str]):
+    @property
+    def default_namespace(self) -> str:
+        """Namespace of the guild set by `DISCORD_GUILD_ID`, which inherits a database from before namespaces existed"""
+        guild_id = os.getenv("DISCORD_GUILD_ID")
+        return namespace_name(int(guild_id)) if guild_id else "default"
+
+    def _initialize_database(self, embedding_model: Embeddings) -> (Path, NamespaceManager):
         """
-        Load database if it exists, else create a new one
+        Create the database directory, the namespaces in it are loaded on first use
 
         :param embedding_model: Huggingface model to convert raw data to vectors
         """
         index_path = Path(os.getenv("INDEX_PATH") or os.path.expanduser("~") / Path("index"))
         index_path.mkdir(parents=True, exist_ok=True)
-        loaded_index, db_entries = None, {}
+        namespaces = NamespaceManager(
+            index_path,
+            embedding_model,
+            default_namespace=self.default_namespace,
+            memory_budget=float(os.getenv("NAMESPACE_MEMORY") or NAMESPACE_MEMORY_BYTES / 1e6) * 1e6,
+            mmap=os.getenv("INDEX_MMAP", "").lower() in ("1", "true", "yes"),
+        )
+        return index_path, namespaces
 
-        if os.path.exists(index_path / Path(DEFAULT_INDEX + ".faiss")):  #
-            logger.info(f"Loading index from {index_path}")
-            loaded_index = FAISS.load_local(
-                folder_path=str(index_path), embeddings=embedding_model, allow_dangerous_deserialization=True
-            )  # ensures we trust the index source
-        else:
-            logger.info(f"No local index found in {index_path / Path(DEFAULT_INDEX + '.faiss')}")
+    def merge_dataset_to_db(
+        self,
+        namespace: str,
+        huggingface_dataset: str,
+        split: str,
+        column: str,
+        progress: Optional[ProgressCallback] = None,
+        streaming: bool = True,
+        deduplicated: Optional[DedupCallback] = None,
+    ):
+        """
+        Adds Huggingface dataset to database in fixed-size batches of rows, checkpointing the index as it goes.
+        Only one batch is held in memory at a time, and an interrupted merge resumes from its last checkpoint.
+
+        :param namespace: Namespace to add the dataset to
+        :param huggingface_dataset: Huggingface dataset path
+        :param split: Dataset split name to use
+        :param column: Dataset column name to use
+        :param progress: Called with the number of merged and total rows after each batch, total is 0 if unknown
+        :param streaming: Stream rows from the hub instead of downloading the whole split first
+        :param deduplicated: Called with the number of chunks skipped because they are already stored
+        """
+        from datasets import load_dataset  # slow to import and only needed here
+
+        logger.info(f"Loading dataset `{huggingface_dataset}` on {split=} with {column=}")
+        ds = load_dataset(path=huggingface_dataset, split=split, streaming=streaming, **({} if streaming else {"num_proc": 8}))
+        first_row = next(iter(ds), None)
+        if first_row is None or column not in first_row:
+            return f"Column `{column}` not in `{huggingface_dataset}`, valid columns are {first_row.keys() if first_row else []}"
 
-        if os.path.exists(index_path / Path(DATASET_LIST)):  # list of datasets in the index
-            with open(index_path / Path(DATASET_LIST), "r") as f:
-                db_entries = json.load(f)
+        with self.namespaces.use(namespace) as ns:
+            self._merge_dataset(ns, ds, huggingface_dataset, split, column, progress, deduplicated)
 
-        if loaded_index is not None and len(db_entries) == 0:
-            logger.warning("Unknown datasets in the database, will not be able to track them going forward")
+    def _merge_dataset(
+        self,
+        ns: Namespace,
+        ds,
+        huggingface_dataset: str,
+        split: str,
+        column: str,
+        progress: Optional[ProgressCallback],
+        deduplicated: Optional[DedupCallback],
+    ):
+        """
+        Merge a loaded dataset into a namespace, which stays loaded until the merge is done.
+        Merging a dataset that is already stored only embeds its changed chunks and then removes the outdated ones.
+        """
+        checkpoint_file = ns.path / CHECKPOINT_DIR / (re.sub(r"[^\w.-]", "_", f"{huggingface_dataset}-{split}-{column}") + ".json")
+        checkpoint = {"rows": 0, "bytes": 0}
+        if checkpoint_file.exists():
+            with open(checkpoint_file, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            logger.info(f"Resuming `{huggingface_dataset}` from row {checkpoint['rows']}")
+            ds = ds.skip(checkpoint["rows"])
+        # chunks seen before a restart are unknown, so outdated chunks are only removed by an uninterrupted merge
+        replacing = not checkpoint_file.exists() and (huggingface_dataset in ns.db_entries or huggingface_dataset in ns.sources)
+        seen = []
+        split_info = ds.info.splits.get(split) if ds.info.splits else None
+        total_rows = split_info.num_examples if split_info else 0
+
+        def row_batches():
+            """(rows, bytes) of each batch of rows with its documents, split ahead of the embedding below"""
+            for batch in ds.iter(batch_size=DATASET_BATCH_ROWS):
+                texts = [text for text in batch[column] if text]
+                metadata = {"title": huggingface_dataset, "source": huggingface_dataset}
+                yield (
+                    (len(batch[column]), sum(len(text.encode("utf-8")) for text in texts)),
+                    [Document(page_content=text, metadata=metadata) for text in texts],
+                )
+
+        rows, data_size, last_checkpoint = checkpoint["rows"], checkpoint["bytes"], checkpoint["rows"]
+        pending = PendingChunks()  # chunks added since the last checkpoint, written as one segment
+        for (batch_rows, batch_bytes), docs_processed in self.splitter.split_batches(row_batches()):
+            rows += batch_rows
+            data_size += batch_bytes
+            if replacing:
+                seen.append(chunk_hashes([doc.page_content for doc in docs_processed]))
+            self._add_to_index(ns, docs_processed, pending, deduplicated=deduplicated)
+            if rows - last_checkpoint >= DATASET_CHECKPOINT_ROWS:
+                self._write_pending(ns, pending)
+                pending = PendingChunks()
+                self._write_json(checkpoint_file, {"rows": rows, "bytes": data_size})
+                last_checkpoint = rows
+            if progress is not None:
+                progress(rows, total_rows)
+
+        self._write_pending(ns, pending)
+        if replacing:
+            with metrics.timer("ingest_remove"):
+                removed = ns.remove_source(huggingface_dataset, keep=np.unique(np.concatenate(seen)) if seen else None)
+            logger.info(f"Removed {removed} outdated chunks of `{huggingface_dataset}` from namespace {ns.name}")
+        ns.db_entries[huggingface_dataset] = {"size": round(data_size / 1e6, 2), "split": split, "column": column}  # size in MB
+        self._write_json(ns.path / DATASET_LIST, ns.db_entries)
+        ns.update_size()
+        checkpoint_file.unlink(missing_ok=True)
+        logger.info(f"Merged {rows} rows of `{huggingface_dataset}` into namespace {ns.name}")
+
+    def merge_to_db(
+        self,
+        namespace: str,
+        data_name: str,
+        data_size: float,
+        data: List[Document],
+        progress: Optional[ProgressCallback] = None,
+        deduplicated: Optional[DedupCallback] = None,
+    ):
+        """
+        Merges the file or dataset into the database
 
-        return index_path, loaded_index, db_entries
+        :param namespace: Namespace to add the data to
+        :param data_name: The filename or name of the dataset
+        :param data_size: The size of the data in bytes
+        :param data: The data as a list of Langchain Document(s)
+        :param progress: Called with the number of merged and total documents after each batch
+        :param deduplicated: Called with the number of chunks skipped because they are already stored
+        """
+        self.merge_many_to_db(namespace, [(data_name, data_size, data)], progress, deduplicated)
 
-    def _initialize_llm(self, model_name):
+    def merge_many_to_db(
+        self,
+        namespace: str,
+        sources: List[tuple[str, float, List[Document]]],
+        progress: Optional[ProgressCallback] = None,
+        deduplicated: Optional[DedupCallback] = None,
+    ):
+        """
+        Merges several files or datasets into the database with a single index write. Documents are split in
+        batches, each batch is embedded while the following ones are being split.
+        A source that is already stored is replaced, only its changed chunks are embedded.
+
+        :param namespace: Namespace to add the data to
+        :param sources: (name, size in bytes, documents) of each file or dataset
+        :param progress: Called with the number of merged and total documents after each batch
+        :param deduplicated: Called with the number of chunks skipped because they are already stored
+        """
+        names = ", ".join(name for name, _, _ in sources)
+        logger.info(f"Merging {names} ({sum(size for _, size, _ in sources)} bytes) into namespace {namespace}")
+        for name, _, docs in sources:
+            for doc in docs:
+                doc.metadata["source"] = name
+        documents = [doc for _, _, docs in sources for doc in docs]
+        batches = ((len(batch), batch) for batch in (documents[i : i + SPLIT_BATCH_DOCS] for i in range(0, len(documents), SPLIT_BATCH_DOCS)))
+
+        logger.info(f"Creating vector store of {names}")
+        with self.namespaces.use(namespace) as ns:
+            replacing = {name for name, _, _ in sources if name in ns.db_entries or name in ns.sources}
+            seen = {name: [] for name in replacing}
+            pending, merged = PendingChunks(), 0
+            for batch_size, docs_processed in self.splitter.split_batches(batches):
+                for name in replacing:
+                    seen[name].append(chunk_hashes([doc.page_content for doc in docs_processed if doc.metadata["source"] == name]))
+                self._add_to_index(ns, docs_processed, pending, deduplicated=deduplicated)
+                merged += batch_size
+                if progress is not None:
+                    progress(merged, len(documents))
+            self._write_pending(ns, pending)
+            for name in replacing:  # uploading a file again updates it
+                with metrics.timer("ingest_remove"):
+                    removed = ns.remove_source(name, keep=np.unique(np.concatenate(seen[name])) if seen[name] else None)
+                logger.info(f"Removed {removed} outdated chunks of {name} from namespace {namespace}")
+            for name, size, _ in sources:
+                ns.db_entries[name] = {"size": round(size / 1e6, 2)}  # store in MB
+            self._write_json(ns.path / DATASET_LIST, ns.db_entries)
+            ns.update_size()
+
+    def _add_to_index(
+        self,
+        ns: Namespace,
+        documents: List[Document],
+        pending: PendingChunks,
+        progress: Optional[ProgressCallback] = None,
+        deduplicated: Optional[DedupCallback] = None,
+    ):
+        """
+        Embed split documents into the pending chunks of a merge, chunks that are already stored or embedded by the
+        same merge are skipped before embedding
+
+        :param ns: Namespace the documents are merged into
+        :param documents: Split documents to embed
+        :param pending: Chunks of the merge not written yet, see `_write_pending`
+        :param progress: Called with the number of embedded and total chunks after each embedding batch
+        :param deduplicated: Called with the number of chunks skipped because they are already stored
+        """
+        if not documents:
+            return
+        with metrics.timer("ingest_dedup"):
+            hashes = chunk_hashes([doc.page_content for doc in documents])
+            with ns.lock:
+                known = ns.chunk_hashes.contains(hashes)
+            known |= pending.contains(hashes)
+        metrics.inc("ingest_chunks_deduplicated", int(known.sum()))
+        if known.any():
+            logger.info(f"Skipping {known.sum()} of {len(documents)} chunks already stored in namespace {ns.name}")
+            pending.skip([doc for doc, skip in zip(documents, known) if skip], hashes[known])
+            documents, hashes = [doc for doc, skip in zip(documents, known) if not skip], hashes[~known]
+            if deduplicated is not None:
+                deduplicated(int(known.sum()))
+        if documents:
+            pending.add(self._embed_documents(documents, progress), documents, hashes)
+
+    def _write_pending(self, ns: Namespace, pending: PendingChunks):
         """
-        Quantize model, load it, and apply default and rag chat templates
+        Write the pending chunks of a merge as a segment and only then add them to the loaded index, so memory never
+        holds chunks that a restart would lose
 
-        :param model_name: Huggingface name of the model
+        :param ns: Namespace the chunks are merged into
+        :param pending: Chunks embedded since the last write
         """
-        logger.info("Initializing bitsandbytesconfig...")
-        if platform == "darwin":
-            # bitsandbytes not yet supported for mac
-            # https://github.com/bitsandbytes-foundation/bitsandbytes/issues/252
-            bnb_config = None
-        else:
-            from transformers import BitsAndBytesConfig
-
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=bfloat16,
-            )
-
-        logger.info(f"Loading model from {model_name=}")
-        model = AutoModelForCausalLM.from_pretrained(model_name, quantization_config=bnb_config)
-        logger.info(f"Loading tokenizer from {model_name=}")
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.rag_prompt = tokenizer.apply_chat_template(RAG_PROMPT, tokenize=False, add_generation_prompt=True)
-        self.prompt = tokenizer.apply_chat_template(PROMPT, tokenize=False, add_generation_prompt=True)
-
-        return pipeline(
-            task="text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            do_sample=True,
-            max_new_tokens=500,
-            temperature=0.2,
-            repetition_penalty=1.1,
-            return_full_text=False,
-        )
+        if pending.store is not None:
+            with metrics.timer("ingest_write"):
+                ns.segment_store.append(pending.store)
+        with ns.lock, metrics.timer("ingest_index"):
+            if pending.store is not None:
+                ns.track(pending.documents, np.concatenate(pending.hashes), 0 if ns.loaded_index is None else ns.loaded_index.index.ntotal)
+                if ns.loaded_index is None:
+                    ns.loaded_index = pending.store
+                else:
+                    ns.index_engine.add(ns.loaded_index, pending.store)
+            if pending.skipped:
+                ns.reference(pending.skipped, np.concatenate(pending.skipped_hashes))
+        if pending.store is not None and self.response_cache is not None:
+            self.response_cache.invalidate()
 
     @staticmethod
-    def split_documents(chunk_size: int, documents: List[Document], tokenizer_name: str) -> List[Document]:
-        """
-        Split documents into chunks of maximum size `chunk_size` tokens and return a list of documents
-
-        :param chunk_size: Maximum chunk size in tokens
-        :param documents: The loaded data to split
-        :param tokenizer_name: Pretrained model for tokenizing
-        """
-        logger.info(f"Initializing text splitter with {tokenizer_name=}...")
-        text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
-            AutoTokenizer.from_pretrained(tokenizer_name),
-            chunk_size=chunk_size,
-            chunk_overlap=int(chunk_size / 10),
-            add_start_index=True,
-            strip_whitespace=True,
-            separators=MARKDOWN_SEPARATORS,
+    def _write_json(path: Path, data):
+        """Write json to a temporary file first and swap it in, so readers never see a partial file"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+    def _embed_documents(self, documents: List[Document], progress: Optional[ProgressCallback] = None) -> FAISS:
+        """
+        Embed documents in batches, reporting progress after each batch, and build a vector store from them
+
+        :param documents: Split documents to embed
+        :param progress: Called with the number of embedded and total chunks after each batch
+        """
+        texts = [doc.page_content for doc in documents]
+        embeddings = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[start : start + EMBEDDING_BATCH_SIZE]
+            with metrics.timer("ingest_embed"):
+                embeddings.extend(self.embedding_model.embed_documents(batch))
+            metrics.inc("ingest_chunks_embedded", len(batch))
+            if progress is not None:
+                progress(len(embeddings), len(texts))
+        return FAISS.from_embeddings(
+            list(zip(texts, embeddings)),
+            self.embedding_model,
+            metadatas=[doc.metadata for doc in documents],
+            distance_strategy=DistanceStrategy.COSINE,
         )
 
-        logger.info("Processing docs in knowledge base...")
-        docs_processed = text_splitter.split_documents(documents)
+    def drop_database(self, namespace: str):
+        """
+        Deletes the index and dataset list of a namespace, pending ingestion jobs and index settings are kept
 
-        # Remove duplicates
-        unique_texts = {}
-        docs_processed_unique = []
-        for doc in docs_processed:
-            if doc.page_content not in unique_texts:
-                unique_texts[doc.page_content] = True
-                docs_processed_unique.append(doc)
+        :param namespace: Namespace to wipe
+        """
+        with self.namespaces.use(namespace) as ns:
+            ns.drop()
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
 
-        return docs_processed_unique
+    def remove_source(self, namespace: str, source: str) -> int | None:
+        """
+        Removes one file or dataset from a namespace, the cost is proportional to the size of that source only
 
-    def merge_dataset_to_db(self, huggingface_dataset: str, split: str, column: str):
+        :param namespace: Namespace to remove the source from
+        :param source: The filename or name of the dataset
+        :return: Number of chunks removed, None if the namespace has no such source
+        """
+        with self.namespaces.use(namespace) as ns:
+            if source not in ns.db_entries and source not in ns.sources:
+                return None
+            removed = self._remove_source(ns, source)
+        logger.info(f"Removed {removed} chunks of {source} from namespace {namespace}")
+        return removed
+
+    def _remove_source(self, ns: Namespace, source: str) -> int:
+        removed = ns.remove_source(source)
+        if ns.db_entries.pop(source, None) is not None:
+            self._write_json(ns.path / DATASET_LIST, ns.db_entries)
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
+        return removed
+
+    def database_entries(self, namespace: str) -> dict:
         """
-        Adds Huggingface dataset to database
+        Datasets and files in a namespace with their size in mB, datasets also with the split and column they were loaded from
 
-        :param huggingface_dataset: Huggingface dataset path
-        :param split: Dataset split name to use
-        :param column: Dataset column name to use
+        :param namespace: Namespace to list
         """
-        logger.info(f"Loading dataset `{huggingface_dataset}` on {split=} with {column=}")
-        ds = load_dataset(path=huggingface_dataset, split=split, num_proc=8)
-        if column not in ds[0]:
-            return f"Column `{column}` not in `{huggingface_dataset}`, valid columns are {ds[0].keys()}"
-        loaded_ds = [Document(page_content=doc[column], metadata={"title": huggingface_dataset}) for doc in ds]
-        self.merge_to_db(huggingface_dataset, ds.dataset_size, loaded_ds)
+        with self.namespaces.use(namespace) as ns:
+            return dict(ns.db_entries)
+
+    def info(self) -> dict:
+        """Models in use and generation and cache statistics"""
+        cache = self.response_cache
+        return {
+            "llm_model_name": self.llm_model_name,
+            "llm_backend": self.backend_name,
+            "embedding_model_name": self.embedding_model_name,
+            "generation": self.scheduler.stats(),
+            "namespaces": self.namespaces.stats(),
+            "response_cache": None if cache is None else {"hit_rate": cache.hit_rate, "hits": cache.hits, "misses": cache.misses},
+        }
+
+    def close(self):
+        """Stop the generation worker and the embedding and splitting worker pools"""
+        self.scheduler.close()
+        self.embedding_model.close()
+        self.splitter.close()
+
+    def _count_tokens(self, text: str) -> int:
+        """Number of tokens in `text` according to the llm's tokenizer"""
+        return self.backend.count_tokens(text)
+
+    def build_prompt(
+        self,
+        query: str,
+        context: str,
+        identity: str,
+        num_retrieved_docs: int = 30,
+        num_docs_final: int = 5,
+        rag: bool = False,
+        query_vector: List[float] | None = None,
+        namespace: str | None = None,
+    ) -> tuple[str | None, List[Document] | str | None]:
+        """
+        Retrieve documents and format the prompt for the llm
 
-    def merge_to_db(self, data_name: str, data_size: float, data: List[Document]):
+        :param query: Query for the llm
+        :param context: Discord channel history
+        :param identity: llm configured identity
+        :param num_retrieved_docs: Maximum number of docs to retrieve from the RAG database
+        :param num_docs_final: Maximum number of docs presented as context to the llm
+        :param rag: Whether to add database information into the prompt
+        :param query_vector: Embedding of the query if it was already computed
+        :param namespace: Namespace to retrieve documents from, the default namespace if None
+        :return: The prompt and documents placed in it, or no prompt and a message to reply with instead
         """
-        Merges the file or dataset into the database
+        relevant_docs = None
+        if rag:
+            with self.namespaces.use(namespace or self.default_namespace) as ns:
+                if ns.loaded_index is None:
+                    logger.error(f"Did not provide any datasets to initialize the index of namespace {ns.name}")
+                    return None, "Couldn't reply with RAG: Database is empty.\nPopulate the database with Huggingface datasets or upload documents"
+                if not query:
+                    logger.warning("Empty query, cannot query database")
+                else:
+                    logger.info(f"Retrieving documents from namespace {ns.name}" + (f" using {query=}" if self.log_prompts else ""))
+                    if query_vector is None:
+                        with metrics.timer("query_embed"):
+                            query_vector = self.embedding_model.embed_query(query)
+                    with ns.lock, metrics.timer("search"):  # the index may have been wiped since the check above
+                        relevant_docs = (
+                            ns.loaded_index.max_marginal_relevance_search_by_vector(
+                                query_vector, k=min(2 * num_docs_final, num_retrieved_docs), fetch_k=num_retrieved_docs, lambda_mult=MMR_LAMBDA
+                            )
+                            if ns.loaded_index is not None
+                            else []
+                        )
+
+            # Build the final prompt, near duplicate chunks were dropped by the MMR search above
+            with metrics.timer("pack_context"):
+                context, relevant_docs = self.context_packer.pack(context, relevant_docs if query else None, num_docs_final)
+            template = self.backend.rag_prompt
+        else:
+            template = self.backend.prompt
+        self.backend.register_prefix(prompt_prefix(template, identity))
+        prompt = template.format(identity=identity, query=query, context=context)
 
-        :param data_name: The filename or name of the dataset
-        :param data_size: The size of the data in bytes
-        :param data: The data as a list of Langchain Document(s)
+        if self.log_prompts:
+            logger.info(f"PROMPT:\n{prompt}")
+        return prompt, relevant_docs
+
+    def _prepare(
+        self, query: str, context: str, identity: str, num_retrieved_docs: int, num_docs_final: int, rag: bool, namespace: str | None
+    ) -> tuple[str | None, List[Document] | str | None, tuple | None, str | None]:
         """
-        logger.info(f"Merging {data_name=} {data_size=} into the database")
-        docs_processed = self.split_documents(chunk_size=512, documents=data, tokenizer_name=self.embedding_model_name)
+        Look the query up in the response cache, if enabled, and build the prompt unless the answer is cached
 
-        logger.info(f"Creating vector store of {data_name}")
-        new_index_store = FAISS.from_documents(docs_processed, self.embedding_model, distance_strategy=DistanceStrategy.COSINE)
-        if self.loaded_index is not None:
-            self.loaded_index.merge_from(new_index_store)
-            self.loaded_index.save_local(self.database_path)
-        else:
-            new_index_store.save_local(self.database_path)
-            self.loaded_index = new_index_store
-        self.db_entries[data_name] = round(data_size / 1e6, 2)  # store in MB
-        with open(self.database_path / Path(DATASET_LIST), "w", encoding="utf-8") as f:
-            json.dump(self.db_entries, f, ensure_ascii=False, indent=4)
-
-    def drop_database(self):
-        """Deletes the index and dataset list"""
-        for filename in os.listdir(self.database_path):
-            file_path = os.path.join(self.database_path, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    logger.info(f"Deleting file {file_path}")
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    logger.info(f"Deleting directory {file_path}")
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                logger.info(f"Failed to delete {file_path}. Reason: {e}")
-        self.loaded_index = None
-        for data in self.db_entries.keys():
-            logger.info(f"Deleting {data}")
-        self.db_entries = None
+        :return: The prompt, retrieved documents, key for caching the answer and the cached answer if there is one
+        """
+        query_vector = cache_key = None
+        if self.response_cache is not None and query:
+            with metrics.timer("query_embed"):
+                query_vector = self.embedding_model.embed_query(query)
+            with metrics.timer("cache_lookup"):
+                cache_key, cached, top_docs = self._cache_lookup(query_vector, identity, num_docs_final, rag, namespace)
+            if cached is not None:
+                logger.info("Answering from the response cache")
+                metrics.inc("responses", path="cached")
+                return None, top_docs, cache_key, cached
+        with metrics.timer("prepare"):
+            prompt, relevant_docs = self.build_prompt(query, context, identity, num_retrieved_docs, num_docs_final, rag, query_vector, namespace)
+        metrics.inc("responses", path="generated" if prompt is not None else "error")
+        return prompt, relevant_docs, cache_key if prompt is not None else None, None
+
+    def _cache_lookup(
+        self, query_vector: List[float], identity: str, num_docs_final: int, rag: bool, namespace: str | None
+    ) -> tuple[tuple | None, str | None, List[Document] | None]:
+        """
+        Look a query up in the response cache by its embedding and, with RAG, the ids of its `num_docs_final` most
+        similar documents. Those only take a plain similarity search, not the MMR search and context packing of a prompt.
+
+        :return: Key for caching the answer, None if the database is empty, and the cached answer with its documents if there is one
+        """
+        if not rag:
+            cache_key = (query_vector, rag, identity, ())
+            return cache_key, self.response_cache.get(*cache_key), None
+        with self.namespaces.use(namespace or self.default_namespace) as ns, ns.lock:
+            if ns.loaded_index is None:
+                return None, None, None
+            _, positions = ns.loaded_index.index.search(np.asarray([query_vector], dtype=np.float32), num_docs_final)
+            cache_key = (query_vector, rag, identity, tuple(ns.loaded_index.index_to_docstore_id[i] for i in positions[0] if i >= 0))
+            cached = self.response_cache.get(*cache_key)
+            return cache_key, cached, None if cached is None else [ns.loaded_index.docstore.search(doc_id) for doc_id in cache_key[3]]
+
+    def _cache_answer(self, cache_key: tuple | None, answer: str, max_new_tokens: int | None):
+        if cache_key is not None and max_new_tokens is None:  # a shortened answer is not served to full requests
+            self.response_cache.put(*cache_key, answer)
 
     def response(
-        self, query: str, context: str, identity: str, num_retrieved_docs: int = 30, num_docs_final: int = 5, rag: bool = False
+        self,
+        query: str,
+        context: str,
+        identity: str,
+        num_retrieved_docs: int = 30,
+        num_docs_final: int = 5,
+        rag: bool = False,
+        namespace: str | None = None,
+        max_new_tokens: int | None = None,
     ) -> tuple[str, List[Document] | None]:
         """
-        Generate a llm response
+        Generate a llm response, blocks until the generation scheduler has served the request
 
         :param query: Query for the llm
         :param context: Discord channel history
@@ -222,37 +599,100 @@ class LlmRag:
         :param num_retrieved_docs: Maximum number of docs to retrieve from the RAG database
         :param num_docs_final: Maximum number of docs presented as context to the llm
         :param rag: Whether to add database information into the prompt
+        :param namespace: Namespace to retrieve documents from, the default namespace if None
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
         """
-        relevant_docs = None
-        if rag:
-            if self.loaded_index is None:
-                logger.error("Did not provide any datasets to initialize local index")
-                return "Couldn't reply with RAG: Database is empty.\nPopulate the database with Huggingface datasets or upload documents", None
-            if not query:
-                logger.warning("Empty query, cannot query database")
-            else:
-                logger.info(f"Retrieving documents using {query=}\n")
-                relevant_docs = self.loaded_index.similarity_search(query=query, k=num_retrieved_docs)
-
-                # Build the final prompt
-                context += "\nExtracted documents:\n"
-                for i, doc in enumerate(relevant_docs):
-                    if i < num_docs_final:
-                        if hasattr(doc, 'metadata') and "title" in doc.metadata:
-                            context += f"\n:::Document name: {doc.metadata["title"]}:::\n{doc.page_content}"
-                        else:
-                            context += f"\n{doc.page_content}"
-                    else:
-                        break
-
-            prompt = self.rag_prompt.format(identity=identity, query=query, context=context)
-        else:
-            prompt = self.prompt.format(identity=identity, query=query, context=context)
+        prompt, relevant_docs, cache_key, cached = self._prepare(query, context, identity, num_retrieved_docs, num_docs_final, rag, namespace)
+        if cached is not None:
+            return cached, relevant_docs
+        if prompt is None:
+            return relevant_docs, None
+
+        answer = self.scheduler.submit(prompt, max_new_tokens=max_new_tokens).result()
+        if self.log_prompts:
+            logger.info(f"ANSWER:\n{answer}")
+        self._cache_answer(cache_key, answer, max_new_tokens)
+
+        return answer, relevant_docs
+
+    async def aresponse(
+        self,
+        query: str,
+        context: str,
+        identity: str,
+        num_retrieved_docs: int = 30,
+        num_docs_final: int = 5,
+        rag: bool = False,
+        namespace: str | None = None,
+        max_new_tokens: int | None = None,
+    ) -> tuple[str, List[Document] | None]:
+        """
+        Generate a llm response without blocking the event loop, concurrent calls are batched together by the scheduler
+
+        :param query: Query for the llm
+        :param context: Discord channel history
+        :param identity: llm configured identity
+        :param num_retrieved_docs: Maximum number of docs to retrieve from the RAG database
+        :param num_docs_final: Maximum number of docs presented as context to the llm
+        :param rag: Whether to add database information into the prompt
+        :param namespace: Namespace to retrieve documents from, the default namespace if None
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
+        """
+        prompt, relevant_docs, cache_key, cached = await asyncio.to_thread(
+            self._prepare, query, context, identity, num_retrieved_docs, num_docs_final, rag, namespace
+        )
+        if cached is not None:
+            return cached, relevant_docs
+        if prompt is None:
+            return relevant_docs, None
 
-        logger.info(f"PROMPT:\n{prompt}")
-        answer = self.llm(prompt)[0]["generated_text"]
-        logger.info(f"ANSWER:\n{answer}")
+        answer = await self.scheduler.agenerate(prompt, max_new_tokens)
+        if self.log_prompts:
+            logger.info(f"ANSWER:\n{answer}")
+        self._cache_answer(cache_key, answer, max_new_tokens)
 
         return answer, relevant_docs
 
+    async def astream_response(
+        self,
+        query: str,
+        context: str,
+        identity: str,
+        num_retrieved_docs: int = 30,
+        num_docs_final: int = 5,
+        rag: bool = False,
+        namespace: str | None = None,
+        max_new_tokens: int | None = None,
+    ) -> tuple[AsyncIterator[str], List[Document] | None]:
+        """
+        Like `aresponse`, but returns the answer as an iterator yielding text as soon as the llm generates it
+
+        :param query: Query for the llm
+        :param context: Discord channel history
+        :param identity: llm configured identity
+        :param num_retrieved_docs: Maximum number of docs to retrieve from the RAG database
+        :param num_docs_final: Maximum number of docs presented as context to the llm
+        :param rag: Whether to add database information into the prompt
+        :param namespace: Namespace to retrieve documents from, the default namespace if None
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
+        """
+        prompt, relevant_docs, cache_key, cached = await asyncio.to_thread(
+            self._prepare, query, context, identity, num_retrieved_docs, num_docs_final, rag, namespace
+        )
+        if prompt is None:
+
+            async def complete_answer():
+                yield cached if cached is not None else relevant_docs
+
+            return complete_answer(), None if cached is None else relevant_docs
+
+        async def stream_and_cache():
+            answer = ""
+            async for text in self.scheduler.astream(prompt, max_new_tokens):
+                answer += text
+                yield text
+            self._cache_answer(cache_key, answer, max_new_tokens)
+
+        return stream_and_cache(), relevant_docs
+
     # endregion
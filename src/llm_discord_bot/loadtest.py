@@ -0,0 +1,752 @@
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from functools import partial
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+from table2ascii import Alignment, PresetStyle, table2ascii as t2a
+
+from llm_discord_bot.benchmark import synthetic_corpus, synthetic_words
+from llm_discord_bot.ingestion import IngestQueue
+from llm_discord_bot.metrics import metrics
+from llm_discord_bot.scheduler import GenerationScheduler
+
+logger = logging.getLogger("LOADTEST")
+
+COMMANDS = ("jobs", "dbinfo", "add")
+# discord.py warns once the heartbeat could not be sent for this long, the gateway drops the connection soon after
+HEARTBEAT_BLOCKED_AFTER = 10.0
+TYPING_REFRESH = 5.0
+
+# the mention, upload or command whose handling is running in the current task, replies sent in it are attributed to it
+current_record: contextvars.ContextVar["Record | None"] = contextvars.ContextVar("current_record", default=None)
+
+
+class Record:
+    """Timeline of one simulated message or command, times are `time.perf_counter` values"""
+
+    def __init__(self, kind: str, name: str = ""):
+        self.kind = kind
+        self.name = name
+        self.sent = time.perf_counter()
+        self.first_reply: float | None = None
+        self.done: float | None = None
+        self.finished: float | None = None  # uploads and datasets only, once their ingestion job is done
+        self.error: str | None = None
+
+
+# region fake discord
+class FakeDiscord:
+    """
+    Local stand-in for discord's REST api and gateway. Every call takes `latency` seconds plus up to `jitter`, and each
+    route of a channel allows `rate` calls per `per` seconds like discord's rate limit buckets, calls over it wait.
+    """
+
+    def __init__(self, latency: float, jitter: float, rate: int, per: float, seed: int = 0):
+        """
+        :param latency: Seconds every call takes
+        :param jitter: Maximum random seconds added to every call
+        :param rate: Calls allowed per route and channel within `per` seconds
+        :param per: Length of the rate limit window in seconds
+        :param seed: Seed of the jitter
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.per = per
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1 << 40)
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.dispatch: Callable[["FakeMessage"], None] | None = None
+        self._buckets: dict[tuple, deque] = defaultdict(deque)
+
+    def snowflake(self) -> int:
+        return next(self.ids)
+
+    async def call(self, route: str, channel_id: int | None = None):
+        """
+        Wait like a REST call of `route` would, channel_id None is not rate limited
+
+        :param route: Name of the endpoint, e.g. `send` or `edit`
+        :param channel_id: Channel whose bucket the call counts against
+        """
+        if channel_id is not None:
+            bucket = self._buckets[(route, channel_id)]
+            limited = False
+            while True:
+                now = time.monotonic()
+                while bucket and bucket[0] <= now - self.per:
+                    bucket.popleft()
+                if len(bucket) < self.rate:
+                    break
+                limited = True
+                await asyncio.sleep(bucket[0] + self.per - now)
+            bucket.append(now)
+            if limited:
+                self.rate_limited[route] += 1
+        self.calls[route] += 1
+        await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+
+    def mentioned_in(self, message: "FakeMessage") -> bool:
+        return self in message.mentions
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+
+
+class FakeAttachment:
+    """Text file attached to a message, downloading it goes through the fake CDN"""
+
+    def __init__(self, discord: FakeDiscord, filename: str, data: bytes, content_type: str = "text/plain; charset=utf-8"):
+        self.discord = discord
+        self.filename = filename
+        self.data = data
+        self.size = len(data)
+        self.content_type = content_type
+
+    async def read(self) -> bytes:
+        await self.discord.call("cdn")
+        return self.data
+
+    async def save(self, fp) -> int:
+        await self.discord.call("cdn")
+        await asyncio.to_thread(Path(fp).write_bytes, self.data)
+        return self.size
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        message_id: int,
+        channel: "FakeChannel",
+        author: FakeUser,
+        content: str = "",
+        mentions: List[FakeUser] | None = None,
+        attachments: List[FakeAttachment] | None = None,
+    ):
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.mentions = mentions or []
+        self.attachments = attachments or []
+
+    async def edit(self, content: str | None = None, **kwargs) -> "FakeMessage":
+        await self.channel.discord.call("edit", self.channel.id)
+        if content is not None:
+            self.content = content
+        return self
+
+
+class FakeTyping:
+    """Typing indicator, refreshed every few seconds while entered like discord.py's"""
+
+    def __init__(self, channel: "FakeChannel"):
+        self.channel = channel
+        self._task: asyncio.Task | None = None
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(TYPING_REFRESH)
+            await self.channel.discord.call("typing", self.channel.id)
+
+    async def __aenter__(self):
+        await self.channel.discord.call("typing", self.channel.id)
+        self._task = asyncio.create_task(self._refresh())
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+
+
+class FakeChannel:
+    """Text channel keeping its recent messages, sent messages are echoed through the gateway like discord does"""
+
+    def __init__(self, discord: FakeDiscord, channel_id: int, guild: FakeGuild, bot_user: FakeUser, keep: int = 200):
+        self.discord = discord
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel-{channel_id}"
+        self.bot_user = bot_user
+        self.messages: deque[FakeMessage] = deque(maxlen=keep)
+
+    def post(self, message: FakeMessage):
+        """A message arrived in the channel"""
+        self.messages.append(message)
+
+    async def send(self, content: str | None = None, embed=None, **kwargs) -> FakeMessage:
+        await self.discord.call("send", self.id)
+        text = content if content is not None else getattr(embed, "description", "") or ""
+        message = FakeMessage(self.discord.snowflake(), self, self.bot_user, text)
+        record = current_record.get()
+        if record is not None and record.first_reply is None:
+            record.first_reply = time.perf_counter()
+        if self.discord.dispatch is not None:
+            self.discord.dispatch(message)
+        else:
+            self.post(message)
+        return message
+
+    def typing(self) -> FakeTyping:
+        return FakeTyping(self)
+
+    async def history(self, limit: int = 100, before: FakeMessage | None = None):
+        await self.discord.call("history", self.id)
+        older = [message for message in self.messages if before is None or message.id < before.id]
+        for message in reversed(older[-limit:] if limit else []):
+            yield message
+
+
+class FakeContext:
+    """Context of a slash command, deferred and answered through the interaction's follow-up webhook"""
+
+    def __init__(self, channel: FakeChannel, author: FakeUser):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+
+    async def defer(self, **kwargs):
+        await self.channel.discord.call("defer")
+
+    async def send(self, content: str | None = None, embed=None, **kwargs) -> FakeMessage:
+        await self.channel.discord.call("followup")
+        record = current_record.get()
+        if record is not None and record.first_reply is None:
+            record.first_reply = time.perf_counter()
+        return FakeMessage(self.channel.discord.snowflake(), self.channel, self.channel.bot_user, content or "")
+
+
+# endregion
+
+
+# region modeled llm
+class ModeledLlm:
+    """
+    Stands in for LlmRag with sleeps where the models would run, so the bot can be loaded without a GPU.
+    Prompts still go through the real `GenerationScheduler` and uploads through the real `IngestQueue`,
+    so batching, queuing and the job reports behave like they do in production.
+    """
+
+    def __init__(self, args: argparse.Namespace, jobs_path: Path):
+        """
+        :param args: Parsed command line, see the `model` options of `parse_args`
+        :param jobs_path: Directory for the ingestion queue's job list
+        """
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.words = synthetic_words(2000, args.seed)
+        self.default_namespace = "default"
+        self._entries: dict[str, dict[str, dict]] = defaultdict(dict)
+        self._lock = threading.Lock()
+        self.scheduler = GenerationScheduler(self._generate, count_tokens=lambda text: len(text.split()), max_batch_size=args.max_batch_size)
+        self.scheduler.start()
+        self.ingest_queue = IngestQueue(self, jobs_path)
+
+    def _work(self, seconds: float):
+        """Spend `seconds`, the `--gil-share` part of it busy in Python, which holds the GIL like tokenizers and samplers do"""
+        busy = seconds * self.args.gil_share
+        deadline = time.perf_counter() + busy
+        while time.perf_counter() < deadline:
+            pass
+        time.sleep(seconds - busy)
+
+    def _generate(self, prompts: List[str], callbacks: list, max_new_tokens: list) -> List[str]:
+        with metrics.timer("prefill"):
+            self._work(self.args.prefill_ms * sum(len(prompt) // 4 for prompt in prompts) / 1000)
+        lengths = [min(self.rng.randint(*self.args.answer_tokens), limit or self.args.answer_tokens[1]) for limit in max_new_tokens]
+        answers = [""] * len(prompts)
+        step = self.args.decode_ms / 1000 * (1 + self.args.batch_slowdown * (len(prompts) - 1))
+        t_decode = time.perf_counter()
+        for i in range(max(lengths)):
+            self._work(step)
+            for j, callback in enumerate(callbacks):
+                if i < lengths[j]:
+                    word = self.rng.choice(self.words) + " "
+                    answers[j] += word
+                    if callback is not None:
+                        callback(word)
+        metrics.observe("decode", time.perf_counter() - t_decode)
+        return answers
+
+    async def _prompt(self, query: str, context: str, identity: str, rag: bool) -> str:
+        if rag:
+            with metrics.timer("search"):
+                await asyncio.to_thread(self._work, self.args.retrieval_ms / 1000)
+        return f"{identity}\n{context}\n{query}"
+
+    async def aresponse(self, query: str, context: str, identity: str, rag: bool = False, **kwargs) -> tuple[str, None]:
+        prompt = await self._prompt(query, context, identity, rag)
+        return await self.scheduler.agenerate(prompt), None
+
+    async def astream_response(self, query: str, context: str, identity: str, rag: bool = False, **kwargs):
+        prompt = await self._prompt(query, context, identity, rag)
+        return self.scheduler.astream(prompt), None
+
+    def _ingest(self, namespace: str, sources: List[tuple[str, float]], progress=None):
+        size = sum(size for _, size in sources)
+        chunks = max(1, int(size / 1000))
+        for i in range(10):
+            self._work(size / self.args.ingest_bytes_per_second / 10)
+            if progress is not None:
+                progress(chunks * (i + 1) // 10, chunks)
+        with self._lock:
+            for name, size in sources:
+                self._entries[namespace][name] = {"size": round(size / 1e6, 2)}
+
+    def merge_many_to_db(self, namespace: str, sources: list, progress=None, deduplicated=None):
+        self._ingest(namespace, [(name, size) for name, size, _ in sources], progress)
+
+    def merge_dataset_to_db(self, namespace: str, huggingface_dataset: str, split: str, column: str, progress=None, deduplicated=None, **kwargs):
+        self._ingest(namespace, [(huggingface_dataset, self.args.dataset_bytes)], progress)
+        with self._lock:
+            self._entries[namespace][huggingface_dataset].update(split=split, column=column)
+
+    def database_entries(self, namespace: str) -> dict:
+        with self._lock:
+            return dict(self._entries[namespace])
+
+    def drop_database(self, namespace: str):
+        with self._lock:
+            self._entries.pop(namespace, None)
+
+    def remove_source(self, namespace: str, source: str) -> int | None:
+        with self._lock:
+            entry = self._entries[namespace].pop(source, None)
+        return None if entry is None else int(entry["size"] * 1000)
+
+    def info(self) -> dict:
+        return {
+            "llm_model_name": "modeled",
+            "llm_backend": "modeled",
+            "embedding_model_name": "modeled",
+            "generation": self.scheduler.stats(),
+            "namespaces": {},
+            "response_cache": None,
+        }
+
+    def close(self):
+        self.scheduler.close()
+
+
+def load_modeled_llm(args: argparse.Namespace, jobs_path: Path) -> ModeledLlm:
+    time.sleep(args.load_seconds)
+    return ModeledLlm(args, jobs_path)
+
+
+# endregion
+
+
+def percentiles(seconds: List[float]) -> dict:
+    """Count and percentiles of durations, in milliseconds"""
+    if not seconds:
+        return {"count": 0}
+    values = np.array(seconds) * 1000
+    summary = {"count": len(values)}
+    for p in (50, 95, 99):
+        summary[f"p{p}_ms"] = round(float(np.percentile(values, p)), 1)
+    summary["max_ms"] = round(float(values.max()), 1)
+    return summary
+
+
+class LoadTest:
+    """
+    Drives a bot with simulated traffic for `args.duration` seconds: Poisson arrivals of mentions, plain chatter,
+    uploads and slash commands, plus bursts of mentions, spread over fake guilds and channels.
+    Meanwhile measures the event loop's lag and how late a gateway heartbeat sent from another thread would run.
+    """
+
+    def __init__(self, args: argparse.Namespace, bot, discord: FakeDiscord):
+        """
+        :param args: Parsed command line
+        :param bot: The bot under test, its llm client already attached
+        :param discord: Fake discord the bot is connected to
+        """
+        self.args = args
+        self.bot = bot
+        self.discord = discord
+        self.rng = random.Random(args.seed)
+        self.words = synthetic_words(2000, args.seed + 1)
+        self.corpus = synthetic_corpus(20, args.upload_bytes, args.seed)
+        self.bot_user = bot.user
+        self.users = [FakeUser(discord.snowflake(), f"user-{i}") for i in range(args.users)]
+        self.channels: List[FakeChannel] = []
+        for g in range(args.guilds):
+            guild = FakeGuild(discord.snowflake(), f"guild-{g}")
+            self.channels += [FakeChannel(discord, discord.snowflake(), guild, self.bot_user) for _ in range(args.channels)]
+        for channel in self.channels:  # some history for the first mention in a channel to fetch
+            for _ in range(10):
+                channel.post(FakeMessage(discord.snowflake(), channel, self.rng.choice(self.users), self._sentence()))
+        self.records: List[Record] = []
+        self.uploads: dict[str, Record] = {}
+        self.errors = Counter()
+        self.loop_lag: List[float] = []
+        self.heartbeat_delay: List[float] = []
+        self._tasks: set[asyncio.Task] = set()
+        self._stop = threading.Event()
+
+    def get_channel(self, channel_id: int) -> FakeChannel | None:
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+    def _sentence(self) -> str:
+        return " ".join(self.rng.choices(self.words, k=self.rng.randint(3, 25)))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def job_finished(self, job: dict):
+        """Called from the ingestion worker before the bot reports a job"""
+        record = self.uploads.get(job["name"])
+        if record is not None:
+            record.finished = time.perf_counter()
+            record.error = job["error"]
+
+    # region traffic
+    async def _handle(self, record: Record | None, handler):
+        current_record.set(record)  # the task runs in a copy of the context, this does not leak into others
+        try:
+            await handler()
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            logger.warning(f"Handling {record.kind if record else 'gateway event'} raised {type(e).__name__}: {e}")
+            if record is not None:
+                record.error = str(e)
+        finally:
+            if record is not None:
+                record.done = time.perf_counter()
+
+    def dispatch(self, message: FakeMessage):
+        """Deliver a message through the gateway, discord.py runs every event handler in its own task"""
+        message.channel.post(message)
+        if message.author == self.bot_user:
+            self._spawn(self._handle(None, lambda: self.bot.on_message(message)))
+            return
+        record = Record("upload" if message.attachments else ("mention" if self.bot_user in message.mentions else "chatter"))
+        if message.attachments:
+            record.name = message.attachments[0].filename
+            self.uploads[record.name] = record
+        self.records.append(record)
+        self._spawn(self._handle(record, lambda: self.bot.on_message(message)))
+
+    def mention(self, channel: FakeChannel | None = None):
+        channel = channel or self.rng.choice(self.channels)
+        content = f"<@{self.bot_user.id}> {self._sentence()}?"
+        self.dispatch(FakeMessage(self.discord.snowflake(), channel, self.rng.choice(self.users), content, mentions=[self.bot_user]))
+
+    def chatter(self):
+        channel = self.rng.choice(self.channels)
+        self.dispatch(FakeMessage(self.discord.snowflake(), channel, self.rng.choice(self.users), self._sentence()))
+
+    def upload(self):
+        channel = self.rng.choice(self.channels)
+        doc = self.rng.choice(self.corpus)
+        attachment = FakeAttachment(self.discord, f"upload-{self.discord.snowflake()}.md", doc.page_content.encode("utf-8"))
+        self.dispatch(FakeMessage(self.discord.snowflake(), channel, self.rng.choice(self.users), attachments=[attachment]))
+
+    def command(self):
+        name = self.rng.choice(self.args.commands)
+        context = FakeContext(self.rng.choice(self.channels), self.rng.choice(self.users))
+        cog = self.bot.get_cog("llm")
+        record = Record("command", name)
+        self.records.append(record)
+        if name == "jobs":
+            handler = partial(cog.list_jobs.callback, cog, context)
+        elif name == "dbinfo":
+            handler = partial(cog.get_database_size.callback, cog, context)
+        else:
+            dataset = f"synthetic/dataset-{self.discord.snowflake()}"
+            self.uploads[dataset] = record
+            handler = partial(cog.add_dataset.callback, cog, context, dataset)
+        self._spawn(self._handle(record, handler))
+
+    async def _arrivals(self, rate: float, fire: Callable[[], None], deadline: float):
+        """Call `fire` at exponentially distributed intervals averaging `rate` per second"""
+        if rate <= 0:
+            return
+        while (wait := self.rng.expovariate(rate)) < deadline - time.perf_counter():
+            await asyncio.sleep(wait)
+            fire()
+
+    async def _bursts(self, deadline: float):
+        """Every `burst_interval` seconds, mention the bot `burst_size` times at once in a handful of channels"""
+        if self.args.burst_size <= 0:
+            return
+        while self.args.burst_interval < deadline - time.perf_counter():
+            await asyncio.sleep(self.args.burst_interval)
+            channels = self.rng.sample(self.channels, min(len(self.channels), 3))
+            for _ in range(self.args.burst_size):
+                self.mention(self.rng.choice(channels))
+
+    # endregion
+
+    # region monitors
+    async def _watch_loop(self, interval: float = 0.05):
+        """Lag of the event loop, how much later than asked a sleep wakes up"""
+        while not self._stop.is_set():
+            t_start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - t_start - interval)
+
+    def _watch_heartbeat(self, loop: asyncio.AbstractEventLoop):
+        """
+        Runs in a thread like discord.py's KeepAliveHandler, which hands each heartbeat to the event loop and
+        waits for it to be sent. The gateway closes the connection if heartbeats stay away for too long.
+        """
+        while not self._stop.wait(self.args.heartbeat_interval):
+            t_start = time.perf_counter()
+            future = asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop)
+            while True:
+                try:
+                    future.result(timeout=HEARTBEAT_BLOCKED_AFTER)
+                    break
+                except TimeoutError:
+                    logger.warning(f"Heartbeat blocked for more than {time.perf_counter() - t_start:.0f} seconds")
+            self.heartbeat_delay.append(time.perf_counter() - t_start)
+
+    # endregion
+
+    async def run(self) -> dict:
+        loop = asyncio.get_running_loop()
+        heartbeat = threading.Thread(target=self._watch_heartbeat, args=(loop,), name="heartbeat", daemon=True)
+        heartbeat.start()
+        watcher = asyncio.create_task(self._watch_loop())
+        t_start = time.perf_counter()
+        deadline = t_start + self.args.duration
+        logger.warning(f"Simulating {self.args.duration}s of traffic in {len(self.channels)} channels")
+        await asyncio.gather(
+            self._arrivals(self.args.mention_rate, self.mention, deadline),
+            self._arrivals(self.args.chatter_rate, self.chatter, deadline),
+            self._arrivals(self.args.upload_rate, self.upload, deadline),
+            self._arrivals(self.args.command_rate if self.args.commands else 0, self.command, deadline),
+            self._bursts(deadline),
+        )
+        await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+        t_end = time.perf_counter()
+
+        # replies and ingestion jobs still in flight are given `drain` seconds to finish
+        drain_deadline = t_end + self.args.drain
+        while self._tasks and time.perf_counter() < drain_deadline:
+            await asyncio.wait(list(self._tasks), timeout=drain_deadline - time.perf_counter())
+        while any(record.finished is None and record.error is None for record in self.uploads.values()) and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.1)
+        self._stop.set()
+        await watcher
+        heartbeat.join()
+        for task in list(self._tasks):
+            task.cancel()
+        return self.report(t_end - t_start)
+
+    def report(self, duration: float) -> dict:
+        by_kind = defaultdict(list)
+        for record in self.records:
+            by_kind[record.kind].append(record)
+        mentions = by_kind["mention"]
+        answered = [record for record in mentions if record.done is not None and record.error is None]
+        uploads = by_kind["upload"] + [record for record in by_kind["command"] if record.name == "add"]
+        commands = {}
+        for name in self.args.commands:
+            records = [record for record in by_kind["command"] if record.name == name]
+            commands[name] = percentiles([record.done - record.sent for record in records if record.done is not None and record.error is None])
+            commands[name]["failed"] = sum(record.error is not None for record in records)
+        return {
+            "duration": round(duration, 1),
+            "mentions": {
+                "sent": len(mentions),
+                "answered": len(answered),
+                "failed": sum(record.error is not None for record in mentions),
+                "unfinished": sum(record.done is None for record in mentions),
+                "per_second": round(len(answered) / duration, 2),
+                "first_reply": percentiles([record.first_reply - record.sent for record in answered if record.first_reply is not None]),
+                "reply": percentiles([record.done - record.sent for record in answered]),
+            },
+            "chatter": percentiles([record.done - record.sent for record in by_kind["chatter"] if record.done is not None]),
+            "commands": commands,
+            "uploads": {
+                "sent": len(uploads),
+                "acknowledged": percentiles([record.first_reply - record.sent for record in uploads if record.first_reply is not None]),
+                "ingested": percentiles([record.finished - record.sent for record in uploads if record.finished is not None]),
+                "failed": sum(record.error is not None for record in uploads),
+            },
+            "event_loop_lag": percentiles(self.loop_lag),
+            "heartbeat_delay": percentiles(self.heartbeat_delay) | {"blocked": sum(d > HEARTBEAT_BLOCKED_AFTER for d in self.heartbeat_delay)},
+            "discord": {"calls": dict(self.discord.calls), "rate_limited": dict(self.discord.rate_limited)},
+            "errors": dict(self.errors),
+            **{key: value for key, value in metrics.snapshot().items() if key != "gauges"},
+        }
+
+
+def print_report(report: dict):
+    rows = [
+        ("mention first reply", report["mentions"]["first_reply"]),
+        ("mention reply", report["mentions"]["reply"]),
+        ("chatter", report["chatter"]),
+        ("upload acknowledged", report["uploads"]["acknowledged"]),
+        ("upload ingested", report["uploads"]["ingested"]),
+        *((f"/{name}", summary) for name, summary in report["commands"].items()),
+        ("event loop lag", report["event_loop_lag"]),
+        ("heartbeat delay", report["heartbeat_delay"]),
+    ]
+    body = [[name, s["count"], *(s.get(key, "-") for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))] for name, s in rows]
+    print(
+        t2a(
+            header=["Latency", "Count", "p50 ms", "p95 ms", "p99 ms", "Max ms"],
+            body=body,
+            style=PresetStyle.thin_compact,
+            alignments=[Alignment.LEFT] + [Alignment.RIGHT] * 5,
+        )
+    )
+    mentions = report["mentions"]
+    print(
+        f"Mentions: {mentions['sent']} sent, {mentions['answered']} answered ({mentions['per_second']}/s), "
+        f"{mentions['failed']} failed, {mentions['unfinished']} unfinished"
+    )
+    print(f"Heartbeats blocked for more than {HEARTBEAT_BLOCKED_AFTER:.0f}s: {report['heartbeat_delay']['blocked']}")
+    shed = sum(value for name, value in report["counters"].items() if name.startswith("replies_shed"))
+    print(f"Replies shed: {shed}, degraded: {report['counters'].get('replies_degraded', 0)}")
+    print(f"Rate limited discord calls: {sum(report['discord']['rate_limited'].values())} of {sum(report['discord']['calls'].values())}")
+    if report["errors"]:
+        print(f"Errors: {report['errors']}")
+
+
+def make_llm(args: argparse.Namespace, work_dir: Path):
+    from llm_discord_bot.client import LocalLlmClient, RemoteLlmClient
+
+    if args.llm == "remote":
+        return RemoteLlmClient(args.server)
+    if args.llm == "local":
+        return LocalLlmClient()
+    return LocalLlmClient(load_llm=lambda: load_modeled_llm(args, work_dir / "jobs"))
+
+
+async def simulate(args: argparse.Namespace, work_dir: Path) -> dict:
+    from llm_discord_bot.bot import Bot  # imported after the guild id is set, the cogs read it on import
+
+    discord = FakeDiscord(args.latency, args.jitter, args.rate_limit, args.rate_period, args.seed)
+    bot = Bot(llm=make_llm(args, work_dir), config_file=args.config)
+    bot.llm_config = {**bot.llm_config, "stream_responses": not args.no_stream}
+    bot.rag = args.rag
+    bot._connection.user = FakeUser(discord.snowflake(), "ldbot", bot=True)
+    await bot._async_setup_hook()
+    await bot.load_extension("llm_discord_bot.cogs.llmrag_cog")
+
+    test = LoadTest(args, bot, discord)
+    discord.dispatch = test.dispatch
+    bot.get_channel = test.get_channel
+    report_finished = bot.llm.on_finished
+    bot.llm.on_finished = lambda job: (test.job_finished(job), report_finished(job))
+    bot.llm.start()
+    try:
+        return await test.run()
+    finally:
+        await bot.llm.close()
+        bot.pdf_extractor.close()
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="ldbot-loadtest", description="Simulated discord traffic against the bot, without connecting to discord")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of traffic to simulate")
+    parser.add_argument("--drain", type=float, default=120, help="Seconds to wait for replies and jobs still in flight afterwards")
+    parser.add_argument("--output", type=Path, help="Write the report as JSON to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+
+    traffic = parser.add_argument_group("traffic")
+    traffic.add_argument("--guilds", type=int, default=2)
+    traffic.add_argument("--channels", type=int, default=5, help="Channels per guild")
+    traffic.add_argument("--users", type=int, default=50)
+    traffic.add_argument("--mention-rate", type=float, default=1.0, help="Mentions of the bot per second")
+    traffic.add_argument("--chatter-rate", type=float, default=2.0, help="Messages per second that do not concern the bot")
+    traffic.add_argument("--upload-rate", type=float, default=0.1, help="Text file uploads per second")
+    traffic.add_argument("--upload-bytes", type=int, default=50_000, help="Approximate size of each upload")
+    traffic.add_argument("--command-rate", type=float, default=0.2, help="Slash commands per second")
+    traffic.add_argument("--commands", default="jobs,dbinfo", help=f"Comma separated commands to run, any of {', '.join(COMMANDS)}")
+    traffic.add_argument("--burst-size", type=int, default=20, help="Mentions sent at once in each burst, 0 for no bursts")
+    traffic.add_argument("--burst-interval", type=float, default=20, help="Seconds between bursts")
+
+    bot = parser.add_argument_group("bot")
+    bot.add_argument("--config", default=os.getenv("CONFIG_FILE"), help="Config file of the bot, the defaults if not given")
+    bot.add_argument("--rag", action="store_true", help="Answer with retrieval, like after `/rag`")
+    bot.add_argument("--no-stream", action="store_true", help="Reply once the answer is complete instead of streaming it")
+    bot.add_argument("--heartbeat-interval", type=float, default=1.0, help="Seconds between simulated gateway heartbeats")
+
+    discord = parser.add_argument_group("discord")
+    discord.add_argument("--latency", type=float, default=0.08, help="Seconds each REST call takes")
+    discord.add_argument("--jitter", type=float, default=0.04, help="Maximum random seconds added to each REST call")
+    discord.add_argument("--rate-limit", type=int, default=5, help="Calls allowed per route and channel within --rate-period")
+    discord.add_argument("--rate-period", type=float, default=5.0)
+
+    llm = parser.add_argument_group("llm")
+    llm.add_argument(
+        "--llm", choices=("modeled", "local", "remote"), default="modeled", help="Latency-modeled stand-in, real models, or `ldbot-server`"
+    )
+    llm.add_argument("--server", default=os.getenv("LLM_SERVER_URL"), help="Url of the inference server for --llm remote")
+    llm.add_argument("--load-seconds", type=float, default=0.0, help="Time the modeled llm takes to load")
+    llm.add_argument("--prefill-ms", type=float, default=0.2, help="Modeled prefill time per prompt token")
+    llm.add_argument("--decode-ms", type=float, default=30.0, help="Modeled time of one decoding step")
+    llm.add_argument("--batch-slowdown", type=float, default=0.05, help="Relative slowdown of a decoding step per extra prompt in the batch")
+    llm.add_argument("--answer-tokens", default="40,200", help="Range of modeled answer lengths in tokens")
+    llm.add_argument("--max-batch-size", type=int, default=8)
+    llm.add_argument("--retrieval-ms", type=float, default=25.0, help="Modeled embedding and search time with --rag")
+    llm.add_argument("--ingest-bytes-per-second", type=float, default=2e6, help="Modeled ingestion speed")
+    llm.add_argument("--dataset-bytes", type=float, default=20e6, help="Modeled size of datasets added with /add")
+    llm.add_argument("--gil-share", type=float, default=0.0, help="Part of the modeled work spent in Python holding the GIL")
+    args = parser.parse_args(argv)
+    args.commands = [name for name in args.commands.split(",") if name]
+    unknown = set(args.commands) - set(COMMANDS)
+    if unknown:
+        parser.error(f"Unknown commands {sorted(unknown)}")
+    args.answer_tokens = tuple(int(n) for n in args.answer_tokens.split(","))
+    if args.llm == "remote" and args.server is None:
+        parser.error("--server or LLM_SERVER_URL is required for --llm remote")
+    return args
+
+
+def main(argv: List[str] | None = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    os.environ.setdefault("DISCORD_GUILD_ID", "0")
+    with tempfile.TemporaryDirectory(prefix="ldbot-loadtest-") as work_dir:
+        report = asyncio.run(simulate(args, Path(work_dir)))
+    report["config"] = {key: (str(value) if isinstance(value, Path) else value) for key, value in vars(args).items() if key != "output"}
+    print_report(report)
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        logger.warning(f"Wrote report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+
+from aiohttp import web
+
+logger = logging.getLogger("METRICS")
+
+# upper bounds in seconds, from a cache hit or index search up to ingesting a large dataset
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+PREFIX = "ldbot"
+
+
+class Histogram:
+    """Durations of one stage, counted in fixed buckets so observing is cheap and the memory use constant"""
+
+    def __init__(self, buckets: tuple = STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the `q` quantile, interpolated within its bucket"""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """
+    Counters, gauges and per-stage duration histograms of the request and ingestion pipelines, thread safe.
+    Exported in the Prometheus text format by `render` and as a dict for `/stats` by `snapshot`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: dict[str, Histogram] = {}
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Record how long one pass through a stage took
+
+        :param stage: Name of the stage, e.g. `search` or `decode`
+        :param seconds: Duration of the pass
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Time the enclosed block as one pass through `stage`, also if it raises"""
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t_start)
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        """
+        Increase a counter
+
+        :param name: Name of the counter without the `_total` suffix
+        :param amount: Amount to add
+        :param labels: Labels telling apart counters of the same name, e.g. status="done"
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        """
+        Register a gauge, read whenever the metrics are exported
+
+        :param name: Name of the gauge
+        :param read: Returns the current value
+        """
+        with self._lock:
+            self._gauges[name] = read
+
+    def _read_gauges(self) -> dict[str, float]:
+        values = {}
+        for name, read in list(self._gauges.items()):
+            try:
+                values[name] = float(read())
+            except Exception as e:
+                logger.warning(f"Could not read gauge {name}: {e}")
+        return values
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    def snapshot(self) -> dict:
+        """Count, mean, quantiles and max of every stage in seconds, and the counters and gauges"""
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": h.count,
+                    "avg": h.sum / h.count if h.count else 0.0,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "max": h.max,
+                }
+                for stage, h in self._stages.items()
+            }
+            counters = {name + self._labels(labels): value for (name, labels), value in self._counters.items()}
+        return {"stages": stages, "counters": counters, "gauges": self._read_gauges()}
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            if self._stages:
+                lines.append(f"# HELP {PREFIX}_stage_seconds Time spent in each stage of the request and ingestion pipelines")
+                lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+            for stage, h in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                    typed.add(name)
+                lines.append(f"{PREFIX}_{name}_total{self._labels(labels)} {value}")
+        for name, value in sorted(self._read_gauges().items()):
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """aiohttp handler serving `render`"""
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+
+# shared by everything running in this process
+metrics = Metrics()
+
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    """
+    Serve the metrics of this process on http://host:port/metrics for Prometheus to scrape
+
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :return: The runner, call its `cleanup` to stop serving
+    """
+    app = web.Application()
+    app.add_routes([web.get("/metrics", metrics.handle)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from llm_discord_bot.constants import (
+    ANN_DIR,
+    CHECKPOINT_DIR,
+    DATASET_LIST,
+    DEFAULT_INDEX,
+    INDEX_CONFIG,
+    MANIFEST,
+    NAMESPACE_DIR,
+    NAMESPACE_MEMORY_BYTES,
+    SEGMENT_DIR,
+)
+from llm_discord_bot.chunk_store import position_ranges, range_positions
+from llm_discord_bot.dedup import ChunkHashes
+from llm_discord_bot.index_engine import FilteredIndex, IndexEngine
+from llm_discord_bot.segments import SegmentStore, source_of, source_ranges
+
+logger = logging.getLogger("NAMESPACES")
+
+# entries of a database directory, moved into a namespace when upgrading from the single global database
+DATABASE_FILES = (MANIFEST, SEGMENT_DIR, ANN_DIR, INDEX_CONFIG, CHECKPOINT_DIR, DATASET_LIST, DEFAULT_INDEX + ".faiss", DEFAULT_INDEX + ".pkl")
+
+
+class Namespace:
+    """
+    One knowledge base: a database directory with its segments, search index and list of sources.
+
+    `sources` maps each source to the positions of its chunks in the loaded index, so a source can be removed
+    without touching the others. `chunk_hashes` holds the content hash at each position, so chunks that are already
+    stored are not embedded again. A chunk stored for one source and skipped for another is handed over to the other
+    source when the first is removed.
+    """
+
+    def __init__(self, name: str, path: Path, embedding_model: Embeddings, mmap: bool = False):
+        """
+        :param name: Namespace name
+        :param path: Database directory
+        :param embedding_model: Huggingface model to convert raw data to vectors
+        :param mmap: Memory map the segments instead of loading them
+        """
+        self.name = name
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.users = 0
+        self.segment_store = SegmentStore(path, embedding_model, mmap=mmap)
+        self.index_engine = IndexEngine(path)
+        self.loaded_index = self.index_engine.prepare(self._load_index(embedding_model))
+        self.sources, deleted = self.segment_store.layout()
+        self.chunk_hashes = ChunkHashes(self.segment_store.hashes())
+        if len(deleted):
+            self._hide(deleted)
+            self.chunk_hashes.remove(deleted)
+        self.db_entries = {}
+        if (path / DATASET_LIST).exists():  # list of datasets in the index
+            with open(path / DATASET_LIST, "r") as f:
+                entries = json.load(f)
+            # older versions only stored the size of each source
+            self.db_entries = {name: entry if isinstance(entry, dict) else {"size": entry} for name, entry in entries.items()}
+        if self.loaded_index is not None and len(self.db_entries) == 0:
+            logger.warning(f"Unknown datasets in namespace {name}, will not be able to track them going forward")
+        self.size = 0
+        self.update_size()
+
+    def _load_index(self, embedding_model: Embeddings) -> FAISS | None:
+        """
+        Load the database if it exists. An index saved as a single file by older versions is converted into the
+        segment layout once.
+        """
+        if self.segment_store.exists:
+            logger.info(f"Loading index from {self.path}")
+            return self.segment_store.load()
+        if (self.path / (DEFAULT_INDEX + ".faiss")).exists():
+            logger.info(f"Converting single file index in {self.path} to segments")
+            loaded_index = FAISS.load_local(
+                folder_path=str(self.path), embeddings=embedding_model, allow_dangerous_deserialization=True
+            )  # ensures we trust the index source
+            self.segment_store.append(loaded_index)
+            for suffix in (".faiss", ".pkl"):
+                os.remove(self.path / (DEFAULT_INDEX + suffix))
+            return loaded_index
+        logger.info(f"No local index found in {self.path}")
+        return None
+
+    def _hide(self, positions: np.ndarray):
+        """Hide vectors from searches, caller must hold the lock unless the namespace is still loading"""
+        if not isinstance(self.loaded_index.index, FilteredIndex):
+            self.loaded_index.index = FilteredIndex(self.loaded_index.index)
+        self.loaded_index.index.hide(positions)
+
+    def track(self, documents: List[Document], hashes: np.ndarray, offset: int):
+        """
+        Record the positions of documents just added to the loaded index, caller must hold the lock
+
+        :param documents: Split documents in the order they were added
+        :param hashes: Content hashes of the documents
+        :param offset: Position of the first document
+        """
+        for source, ranges in source_ranges((doc.metadata for doc in documents), offset).items():
+            self.sources.setdefault(source, []).extend(ranges)
+        self.chunk_hashes.add(hashes)
+
+    def reference(self, documents: List[Document], hashes: np.ndarray):
+        """
+        Record documents skipped because their chunks are already stored, caller must hold the lock
+
+        :param documents: Split documents that were not added
+        :param hashes: Content hashes of the documents
+        """
+        names = np.array([source_of(doc.metadata) for doc in documents], dtype=object)
+        for source in set(names):
+            own = self.chunk_hashes.positions[range_positions(self.sources.get(source, []))]
+            shared = np.setdiff1d(hashes[names == source], own)
+            if len(shared):  # stored for another source
+                self.segment_store.add_references(source, shared)
+
+    def remove_source(self, source: str, keep: np.ndarray | None = None) -> int:
+        """
+        Remove the chunks of a file or dataset from searches and mark them as deleted on disk, the dataset list is left to the caller.
+        Chunks another source shares are handed over to it instead.
+
+        :param source: Name of the file or dataset
+        :param keep: Sorted content hashes of chunks to keep, e.g. those still in a re-ingested source
+        :return: Number of chunks removed
+        """
+        with self.lock:
+            positions = range_positions(self.sources.pop(source, []))
+            hashes = self.chunk_hashes.positions[positions]
+            if keep is not None:
+                kept = np.isin(hashes, keep)
+                if kept.any():
+                    self.sources[source] = position_ranges(positions[kept])
+                positions, hashes = positions[~kept], hashes[~kept]
+            heirs = self.segment_store.heirs(source, hashes)
+            for heir in set(heirs) - {None}:
+                taken = positions[np.array([other == heir for other in heirs], dtype=bool)]
+                self.sources[heir] = position_ranges(np.union1d(range_positions(self.sources.get(heir, [])), taken))
+            positions = positions[np.array([heir is None for heir in heirs], dtype=bool)]
+            if len(positions) and self.loaded_index is not None:
+                self._hide(positions)
+                self.chunk_hashes.remove(positions)
+        self.segment_store.remove_source(source, keep)
+        return len(positions)
+
+    def update_size(self):
+        """Estimate the memory used by the namespace from the size of its segments on disk, called after it changed"""
+        segment_path = self.path / SEGMENT_DIR
+        self.size = sum(file.stat().st_size for file in segment_path.rglob("*") if file.is_file()) if segment_path.exists() else 0
+
+    def drop(self):
+        """Deletes the index and dataset list once a running compaction has finished, index settings are kept"""
+        with self.lock:
+            self.segment_store.wait()
+            for entry in self.path.iterdir():
+                if entry.name == INDEX_CONFIG:
+                    continue
+                try:
+                    if entry.is_dir() and not entry.is_symlink():
+                        logger.info(f"Deleting directory {entry}")
+                        shutil.rmtree(entry)
+                    else:
+                        logger.info(f"Deleting file {entry}")
+                        entry.unlink()
+                except Exception as e:
+                    logger.info(f"Failed to delete {entry}. Reason: {e}")
+            self.loaded_index = None
+            self.sources = {}
+            self.chunk_hashes = ChunkHashes()
+            self.segment_store.reset()
+        for data in self.db_entries.keys():
+            logger.info(f"Deleting {data} from namespace {self.name}")
+        self.db_entries = {}
+        self.size = 0
+
+
+class NamespaceManager:
+    """
+    Loads the knowledge base of each namespace on first use and keeps the most recently used ones in memory.
+
+    Once the loaded namespaces are estimated to use more than `memory_budget` bytes the least recently used ones
+    that are not in use are unloaded, they are loaded again from disk the next time they are needed.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        embedding_model: Embeddings,
+        default_namespace: str,
+        memory_budget: float = NAMESPACE_MEMORY_BYTES,
+        mmap: bool = False,
+    ):
+        """
+        :param root: Database directory, namespaces are stored in its `namespaces` subdirectory
+        :param embedding_model: Huggingface model to convert raw data to vectors
+        :param default_namespace: Namespace a database from before namespaces existed is moved into
+        :param memory_budget: Estimated bytes of loaded namespaces kept in memory
+        :param mmap: Memory map the segments instead of loading them
+        """
+        self.root = root
+        self.namespace_path = root / NAMESPACE_DIR
+        self.embedding_model = embedding_model
+        self.memory_budget = memory_budget
+        self.mmap = mmap
+        self._lock = threading.Lock()
+        self._loaded: OrderedDict[str, Namespace] = OrderedDict()
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._upgrade(default_namespace)
+
+    def _upgrade(self, default_namespace: str):
+        """Move the single global database of older versions into `default_namespace`"""
+        legacy = [self.root / name for name in DATABASE_FILES if (self.root / name).exists()]
+        if not legacy:
+            return
+        target = self.path(default_namespace)
+        logger.info(f"Moving the database in {self.root} into namespace {default_namespace}")
+        target.mkdir(parents=True, exist_ok=True)
+        for entry in legacy:
+            os.replace(entry, target / entry.name)
+
+    def path(self, name: str) -> Path:
+        return self.namespace_path / re.sub(r"[^\w.-]", "_", name)
+
+    def names(self) -> list[str]:
+        """Namespaces stored on disk"""
+        return sorted(entry.name for entry in self.namespace_path.iterdir() if entry.is_dir()) if self.namespace_path.exists() else []
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[Namespace]:
+        """
+        Load a namespace if needed and keep it loaded while the context is open
+
+        :param name: Namespace name
+        """
+        namespace = self._acquire(name)
+        try:
+            yield namespace
+        finally:
+            with self._lock:
+                namespace.users -= 1
+                self._evict()
+
+    def _acquire(self, name: str) -> Namespace:
+        with self._lock:
+            if name in self._loaded:
+                return self._pin(name)
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:  # other namespaces stay usable while this one loads
+            with self._lock:
+                if name in self._loaded:
+                    return self._pin(name)
+            namespace = Namespace(name, self.path(name), self.embedding_model, mmap=self.mmap)
+            with self._lock:
+                self._loaded[name] = namespace
+                pinned = self._pin(name)
+                self._evict()
+            logger.info(f"Loaded namespace {name} ({round(namespace.size / 1e6, 2)} mB)")
+            return pinned
+
+    def _pin(self, name: str) -> Namespace:
+        """Mark a loaded namespace as used, caller must hold the lock"""
+        self._loaded.move_to_end(name)
+        namespace = self._loaded[name]
+        namespace.users += 1
+        return namespace
+
+    def _evict(self):
+        """
+        Unload least recently used namespaces that are not in use until the rest fits the budget, caller must hold the lock.
+        Namespaces still compacting their segments stay loaded, a store loaded again meanwhile would remove the segment
+        being written as a leftover and its manifest would drop the compacted segments.
+        """
+        total = sum(namespace.size for namespace in self._loaded.values())
+        for name, namespace in list(self._loaded.items()):
+            if total <= self.memory_budget:
+                break
+            if namespace.users == 0 and not namespace.segment_store.compacting:
+                del self._loaded[name]
+                total -= namespace.size
+                logger.info(f"Unloaded namespace {name} to stay within the memory budget")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"loaded": len(self._loaded), "memory_bytes": sum(namespace.size for namespace in self._loaded.values())}
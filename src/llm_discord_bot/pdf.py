@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from discord import Attachment
+from langchain_core.documents import Document
+
+from llm_discord_bot.metrics import metrics
+
+logger = logging.getLogger("PDF")
+
+
+def _page_count(path: str) -> int:
+    from pypdf import PdfReader  # imported in the worker processes only
+
+    return len(PdfReader(path).pages)
+
+
+def _page_texts(path: str, start: int, end: int) -> List[str]:
+    """Text of pages `start` up to `end`, only these pages are parsed"""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+
+class PdfExtractor:
+    """
+    Extracts the text of PDF attachments off the event loop. Each attachment is saved to its own temporary file,
+    and ranges of its pages are parsed in parallel by worker processes that read the file themselves, so the
+    file is never held in memory as a whole and concurrent uploads cannot overwrite each other.
+    """
+
+    def __init__(self, processes: int = 2, pages_per_task: int = 16):
+        """
+        :param processes: Number of worker processes, 1 parses in a thread of the bot process
+        :param pages_per_task: Number of pages parsed by a worker at a time
+        """
+        self.processes = processes
+        self.pages_per_task = pages_per_task
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _get_pool(self) -> ProcessPoolExecutor | None:
+        # created on the first PDF, spawned since forking the running bot is unsafe
+        if self._pool is None and self.processes > 1:
+            self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def extract(self, attachment: Attachment) -> List[Document]:
+        """
+        Pages of a PDF attachment as documents, empty pages are skipped.
+        All pages are returned at once since a file is submitted as one ingestion job, so it is replaced as a whole
+        when uploaded again. The text of a file is therefore held in memory while it is queued.
+
+        :param attachment: Discord attachment of the PDF
+        """
+        t_start = time.perf_counter()
+        fd, path = tempfile.mkstemp(prefix="ldbot-", suffix=".pdf")
+        os.close(fd)
+        try:
+            await attachment.save(fp=path)
+            loop, pool = asyncio.get_running_loop(), self._get_pool()
+            pages = await loop.run_in_executor(pool, _page_count, path)
+            ranges = [(start, min(start + self.pages_per_task, pages)) for start in range(0, pages, self.pages_per_task)]
+            results = await asyncio.gather(*(loop.run_in_executor(pool, _page_texts, path, start, end) for start, end in ranges))
+        finally:
+            os.remove(path)
+        metrics.observe("pdf_extract", time.perf_counter() - t_start)
+        metrics.inc("pdf_pages", pages)
+        logger.info(f"Extracted {pages} pages of {attachment.filename} in {len(ranges)} parts")
+        texts = [text for result in results for text in result]
+        return [Document(page_content=text, metadata={"title": attachment.filename, "page": page}) for page, text in enumerate(texts) if text.strip()]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,90 @@
+import copy
+import logging
+import threading
+from collections import OrderedDict
+
+from torch import no_grad, tensor
+
+logger = logging.getLogger("PREFIX_CACHE")
+
+PER_REQUEST_FIELDS = ("{context}", "{query}")
+
+
+def prompt_prefix(template: str, identity: str) -> str:
+    """
+    The part of a chat template up to the line of its first per-request field, with the identity filled in.
+    Cut after a line break, where tokenizers split the text anyway, rather than right before the field.
+    """
+    end = min(template.index(field) for field in PER_REQUEST_FIELDS if field in template)
+    return template[: template.rfind("\n", 0, end) + 1].format(identity=identity)
+
+
+class PrefixCache:
+    """
+    Key/value caches of the fixed start of each prompt, the chat template and identity up to the channel history.
+
+    Prompts starting with a known prefix only need their own context and question encoded, the prefix's
+    keys/values are copied in from here. A prefix is only used where the prompt's tokens start with the prefix's
+    tokens, so a prompt is never encoded differently than without the cache. Prefixes are keyed by their text,
+    so a changed identity gets its own entry and the least recently used prefixes are dropped beyond `max_prefixes`.
+    """
+
+    def __init__(self, model, tokenizer, max_prefixes: int = 4):
+        """
+        :param model: Causal language model the caches are computed with
+        :param tokenizer: Tokenizer of the model
+        :param max_prefixes: Number of prefixes kept
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_prefixes = max_prefixes
+        self._prefixes: OrderedDict[str, tuple[list[int], object] | None] = OrderedDict()
+        self._token_ids: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, prefix: str):
+        """Make a prefix known, its cache is computed the first time a prompt using it is generated"""
+        with self._lock:
+            if prefix not in self._prefixes:
+                self._prefixes[prefix] = None
+                self._token_ids[prefix] = self.tokenizer.encode(prefix, add_special_tokens=False)
+            self._prefixes.move_to_end(prefix)
+            while len(self._prefixes) > self.max_prefixes:
+                dropped, _ = self._prefixes.popitem(last=False)
+                del self._token_ids[dropped]
+
+    def match(self, prompt: str, ids: list[int]) -> str | None:
+        """
+        Longest known prefix of `prompt` whose tokens start the prompt's tokens, a tokenizer may merge the text
+        on both sides of a prefix into one token
+
+        :param prompt: Fully formatted prompt
+        :param ids: Token ids of the prompt
+        """
+        with self._lock:
+            matches = [prefix for prefix, prefix_ids in self._token_ids.items() if prompt.startswith(prefix) and ids[: len(prefix_ids)] == prefix_ids]
+        return max(matches, key=len, default=None)
+
+    def get(self, prefix: str, batch_size: int) -> tuple[list[int], object]:
+        """
+        Token ids of a prefix and a copy of its key/value cache repeated for a batch
+
+        :param prefix: A registered prefix
+        :param batch_size: Number of prompts the cache will be used for
+        """
+        with self._lock:
+            entry = self._prefixes.get(prefix)
+        if entry is None:
+            ids = self.tokenizer.encode(prefix, add_special_tokens=False)
+            with no_grad():
+                past = self.model(input_ids=tensor([ids], device=self.model.device), use_cache=True).past_key_values
+            entry = (ids, past)
+            logger.info(f"Cached keys/values of a {len(ids)} token prompt prefix")
+            with self._lock:
+                if prefix in self._prefixes:
+                    self._prefixes[prefix] = entry
+        ids, past = entry
+        past = copy.deepcopy(past)  # generate extends the cache in place
+        if batch_size > 1:
+            past.batch_repeat_interleave(batch_size)
+        return ids, past
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+logger = logging.getLogger("PROFILING")
+
+# leaf frames of threads waiting for work, left out of the hotspots
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ThreadProfile:
+    """Stacks of every thread sampled at a fixed interval, stored folded as `thread;outer;...;inner` with their counts"""
+
+    def __init__(self, stacks: Counter, ticks: int, seconds: float):
+        """
+        :param stacks: Number of samples of each (thread, frames outermost first) stack
+        :param ticks: Number of times all threads were sampled
+        :param seconds: Length of the capture
+        """
+        self.stacks = stacks
+        self.ticks = ticks
+        self.seconds = seconds
+
+    def folded(self) -> str:
+        """Folded stacks as read by flamegraph.pl, inferno and speedscope"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def threads(self) -> dict[str, float]:
+        """Share of the capture each thread was busy, in percent"""
+        busy = Counter()
+        for stack, count in self.stacks.items():
+            busy[stack[0]] += count
+        return {thread: round(100 * count / self.ticks, 1) for thread, count in busy.most_common()}
+
+    def hotspots(self, top: int = 10) -> List[tuple[str, float, float]]:
+        """
+        Functions that busy threads spent the most time in
+
+        :param top: Number of functions to return
+        :return: Function, percent of the capture spent in the function itself and percent spent in it or its callees
+        """
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                total[frame] += count
+        return [(frame, round(100 * count / self.ticks, 1), round(100 * total[frame] / self.ticks, 1)) for frame, count in own.most_common(top)]
+
+
+def sample_threads(seconds: float, interval: float, stop: threading.Event) -> ThreadProfile:
+    """
+    Sample the stacks of all other threads of this process, e.g. the event loop, generation and ingestion threads
+
+    :param seconds: How long to sample for
+    :param interval: Seconds between two samples
+    :param stop: Ends sampling early once set
+    """
+    own = threading.get_ident()
+    stacks, ticks = Counter(), 0
+    t_start = time.perf_counter()
+    deadline = t_start + seconds
+    while not stop.is_set() and time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks[tuple(reversed(frames))] += 1
+        ticks += 1
+        stop.wait(interval)
+    return ThreadProfile(stacks, max(ticks, 1), time.perf_counter() - t_start)
+
+
+def torch_operator_profile():
+    """Profiler recording the torch operators run inside it, on the GPU too if there is one"""
+    from torch import cuda  # torch is heavy to import and only needed for this
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if cuda.is_available() else [])
+    return profile(activities=activities, record_shapes=True)
+
+
+class Profiler:
+    """
+    Captures profiles of the running process on demand, one at a time, and writes them to `directory`.
+
+    Threads are sampled from Python, so nothing has to be installed and the process keeps running, but time spent in
+    worker processes (splitting, embedding, PDF parsing) is only seen as the threads waiting on them.
+    """
+
+    def __init__(self, directory: Path, interval: float = 0.01):
+        """
+        :param directory: Where flamegraphs and traces are written
+        :param interval: Seconds between two samples of the threads
+        """
+        self.directory = directory
+        self.interval = interval
+        self._stop: threading.Event | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None
+
+    def stop(self) -> bool:
+        """End the running capture early, returns whether there was one"""
+        if self._stop is None:
+            return False
+        self._stop.set()
+        return True
+
+    async def capture(self, seconds: float, scheduler=None) -> dict | None:
+        """
+        Sample all threads for `seconds` or until stopped, and write the result as a flamegraph
+
+        :param seconds: Length of the capture
+        :param scheduler: Generation scheduler whose next batch is run under the torch profiler, None to skip it
+        :return: Summary with the hotspots and written files, None if a capture is already running
+        """
+        if self._stop is not None:
+            return None
+        self._stop = threading.Event()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        operator_profile, batch_done = None, None
+        if scheduler is not None:
+            operator_profile = torch_operator_profile()
+            batch_done = scheduler.run_next_batch_in(operator_profile)
+        logger.info(f"Profiling for {seconds}s")
+        try:
+            profile = await asyncio.to_thread(sample_threads, seconds, self.interval, self._stop)
+        finally:
+            self._stop = None
+
+        files = [self.directory / f"profile-{stamp}.folded"]
+        await asyncio.to_thread(files[0].write_text, profile.folded(), encoding="utf-8")
+        summary = {
+            "seconds": round(profile.seconds, 1),
+            "samples": profile.ticks,
+            "threads": profile.threads(),
+            "hotspots": profile.hotspots(),
+            "operators": None,
+        }
+        if batch_done is not None and batch_done.cancel():
+            logger.info("No generation ran while profiling, skipping the operator profile")
+        elif batch_done is not None:
+            await asyncio.wrap_future(batch_done)  # a batch that started in time is finished
+            summary["operators"] = await asyncio.to_thread(self._write_operators, operator_profile, stamp, files)
+        summary["files"] = [str(path) for path in files]
+        logger.info(f"Wrote profile to {', '.join(summary['files'])}")
+        return summary
+
+    def _write_operators(self, operator_profile, stamp: str, files: List[Path]) -> List[tuple[str, float, int]]:
+        """Write the operator trace and table, returns the operators with the most own CPU time in ms and their calls"""
+        files.append(self.directory / f"torch-{stamp}.json")
+        operator_profile.export_chrome_trace(str(files[-1]))
+        averages = operator_profile.key_averages()
+        files.append(self.directory / f"torch-{stamp}.txt")
+        files[-1].write_text(averages.table(sort_by="self_cpu_time_total", row_limit=50), encoding="utf-8")
+        top = sorted(averages, key=lambda event: event.self_cpu_time_total, reverse=True)[:10]
+        return [(event.key, round(event.self_cpu_time_total / 1000, 1), event.count) for event in top]
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+
+class CachedResponse:
+    def __init__(self, vector: np.ndarray, answer: str):
+        self.vector = vector
+        self.answer = answer
+        self.created = time.monotonic()
+        self.size = vector.nbytes + len(answer.encode("utf-8"))
+
+
+class ResponseCache:
+    """
+    LRU cache of generated answers, matched on query embedding similarity.
+
+    A cached answer is only reused if the new query is at least `threshold` cosine-similar to the cached one and
+    was asked with the same RAG mode and identity and retrieved the same documents. Entries expire after `ttl`
+    seconds, and the least recently used entries are evicted once `max_entries` or `max_bytes` is exceeded.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1000, max_bytes: int = 64_000_000):
+        """
+        :param threshold: Minimum cosine similarity of two query embeddings to share an answer
+        :param ttl: Seconds an answer stays valid
+        :param max_entries: Maximum number of cached answers
+        :param max_bytes: Maximum memory used by cached answers and their embeddings
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache | None":
+        """Cache configured by `RESPONSE_CACHE*` environment variables, None unless `RESPONSE_CACHE` is enabled"""
+        if os.getenv("RESPONSE_CACHE", "").lower() not in ("1", "true", "yes"):
+            return None
+        return cls(
+            threshold=float(os.getenv("RESPONSE_CACHE_THRESHOLD") or 0.95),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL") or 3600),
+            max_entries=int(os.getenv("RESPONSE_CACHE_ENTRIES") or 1000),
+        )
+
+    def _remove(self, key: tuple):
+        self._bytes -= self._entries.pop(key).size
+
+    def get(self, vector: List[float], rag: bool, identity: str, retrieved: tuple[str, ...]) -> str | None:
+        """
+        Cached answer of the most similar earlier query with the same mode, identity and documents
+
+        :param vector: Normalized embedding of the query
+        :param rag: Whether RAG was used
+        :param identity: llm configured identity
+        :param retrieved: Docstore ids of the documents most similar to the query
+        """
+        scope = (rag, identity, retrieved)
+        query = np.asarray(vector, dtype=np.float32)
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if now - entry.created > self.ttl:
+                    self._remove(key)
+                elif key[:3] == scope and (score := float(entry.vector @ query)) >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key].answer
+
+    def put(self, vector: List[float], rag: bool, identity: str, retrieved: tuple[str, ...], answer: str):
+        """
+        Cache an answer, evicting the least recently used answers if the cache is full
+
+        :param vector: Normalized embedding of the query
+        :param rag: Whether RAG was used
+        :param identity: llm configured identity
+        :param retrieved: Docstore ids of the documents most similar to the query
+        :param answer: Generated answer
+        """
+        entry = CachedResponse(np.asarray(vector, dtype=np.float32), answer)
+        key = (rag, identity, retrieved, entry.vector.tobytes())
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self):
+        """Drop every cached answer, called whenever the database changes"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import AbstractContextManager, nullcontext
+from typing import AsyncIterator, Callable, List, Optional
+
+from llm_discord_bot.metrics import metrics
+
+TokenCallback = Callable[[str], None]
+
+logger = logging.getLogger("SCHEDULER")
+
+
+class GenerationRequest:
+    def __init__(self, prompt: str, on_text: Optional[TokenCallback] = None, max_new_tokens: Optional[int] = None):
+        self.prompt = prompt
+        self.on_text = on_text
+        self.max_new_tokens = max_new_tokens
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class GenerationScheduler:
+    """
+    Gathers pending prompts into batches and runs them on a single worker thread.
+
+    As soon as a batch finishes every request that arrived in the meantime is pulled into the next batch,
+    so concurrent mentions share one pass through the model instead of queuing behind each other.
+    """
+
+    def __init__(
+        self,
+        generate_fn: Callable[[List[str], List[Optional[TokenCallback]], List[Optional[int]]], List[str]],
+        count_tokens: Callable[[str], int],
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+    ):
+        """
+        :param generate_fn: Generates one answer per prompt for a list of prompts, feeding new text to the matching callback if one is set,
+            with at most the matching number of new tokens if one is set
+        :param count_tokens: Counts the tokens of a generated answer, used for throughput stats
+        :param max_batch_size: Maximum number of prompts generated together
+        :param max_wait: Seconds to wait for more prompts after the first one arrives on an idle scheduler
+        """
+        self.generate_fn = generate_fn
+        self.count_tokens = count_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: queue.Queue[GenerationRequest | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._tokens = 0
+        self._queue_wait = 0.0
+        self._generation_time = 0.0
+        self._next_context: tuple[AbstractContextManager, Future] | None = None
+
+    def start(self):
+        """Starts the worker thread, safe to call more than once"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stops the worker thread once all queued requests have been served"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, prompt: str, on_text: Optional[TokenCallback] = None, max_new_tokens: Optional[int] = None) -> Future:
+        """
+        Queue a prompt for generation
+
+        :param prompt: Fully formatted prompt
+        :param on_text: Called from the worker thread with each new piece of text as it is generated
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
+        :return: Future resolving to the generated answer
+        """
+        self.start()
+        request = GenerationRequest(prompt, on_text, max_new_tokens)
+        self._queue.put(request)
+        return request.future
+
+    async def agenerate(self, prompt: str, max_new_tokens: Optional[int] = None) -> str:
+        """
+        Queue a prompt for generation and wait for the answer without blocking the event loop
+
+        :param prompt: Fully formatted prompt
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
+        """
+        return await asyncio.wrap_future(self.submit(prompt, max_new_tokens=max_new_tokens))
+
+    async def astream(self, prompt: str, max_new_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Queue a prompt for generation and yield the answer piece by piece as it is generated
+
+        :param prompt: Fully formatted prompt
+        :param max_new_tokens: Limit of the answer's length in tokens, the backend's default if None
+        """
+        loop = asyncio.get_running_loop()
+        pieces: asyncio.Queue[str | None] = asyncio.Queue()
+        future = self.submit(prompt, on_text=lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text), max_new_tokens=max_new_tokens)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(pieces.put_nowait, None))
+        while (text := await pieces.get()) is not None:
+            yield text
+        future.result()  # surface generation errors to the caller
+
+    def run_next_batch_in(self, context: AbstractContextManager) -> Future:
+        """
+        Generate the next batch inside `context`, e.g. a profiler
+
+        :param context: Entered on the worker thread around the generation
+        :return: Future resolving once that batch has finished, cancel it to drop the context if no batch has started yet
+        """
+        future = Future()
+        with self._lock:
+            self._next_context = (context, future)
+        return future
+
+    def _batch_context(self) -> tuple[AbstractContextManager, Future | None]:
+        with self._lock:
+            next_context, self._next_context = self._next_context, None
+        if next_context is None or not next_context[1].set_running_or_notify_cancel():
+            return nullcontext(), None
+        return next_context
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """Throughput and latency counters since startup"""
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "batches": self._batches,
+                "queue_depth": self.queue_depth,
+                "avg_batch_size": round(self._requests / self._batches, 2) if self._batches else 0.0,
+                "avg_queue_wait": round(self._queue_wait / self._requests, 3) if self._requests else 0.0,
+                "tokens_per_second": round(self._tokens / self._generation_time, 2) if self._generation_time else 0.0,
+            }
+
+    def _collect_batch(self, first: GenerationRequest) -> tuple[List[GenerationRequest], bool]:
+        """Pulls everything already queued (up to the batch size) behind `first`, returns the batch and whether to stop"""
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect_batch(first)
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            t_start = time.perf_counter()
+            context, context_done = self._batch_context()
+            try:
+                with context:
+                    answers = self.generate_fn(
+                        [request.prompt for request in batch], [request.on_text for request in batch], [request.max_new_tokens for request in batch]
+                    )
+            except Exception as e:
+                logger.error(f"Generation of a batch of {len(batch)} failed with {e}")
+                metrics.inc("generation_failures", len(batch))
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finally:
+                if context_done is not None:
+                    context_done.set_result(None)
+            elapsed = time.perf_counter() - t_start
+
+            tokens = sum(self.count_tokens(answer) for answer in answers)
+            waits = [t_start - request.enqueued_at for request in batch]
+            with self._lock:
+                self._requests += len(batch)
+                self._batches += 1
+                self._tokens += tokens
+                self._queue_wait += sum(waits)
+                self._generation_time += elapsed
+            metrics.observe("generate_batch", elapsed)
+            for wait in waits:
+                metrics.observe("queue_wait", wait)
+            metrics.inc("generated_tokens", tokens)
+            metrics.inc("generation_batches")
+            metrics.inc("generation_requests", len(batch))
+            logger.info(
+                f"Generated batch of {len(batch)} in {elapsed:.2f}s, {tokens / elapsed if elapsed else 0:.1f} tokens/s, "
+                f"max queue wait {max(waits):.2f}s, {self.queue_depth} still queued"
+            )
+            for request, answer in zip(batch, answers):
+                request.future.set_result(answer)
@@ -0,0 +1,502 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Iterable
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from llm_discord_bot.chunk_store import (
+    OFFSETS_FILE,
+    ChunkFile,
+    ChunkStore,
+    PositionIds,
+    concat_chunks,
+    has_chunks,
+    position_ranges,
+    range_positions,
+    read_chunks,
+    write_chunks,
+)
+from llm_discord_bot.constants import ANN_DIR, SEGMENT_DIR, MANIFEST, COMPACT_SEGMENTS, COMPACT_MIN_CHUNKS, COMPACT_SIZE_RATIO
+from llm_discord_bot.dedup import HASHES_FILE, chunk_hashes
+
+logger = logging.getLogger("SEGMENTS")
+
+INDEX_FILE = "index.faiss"
+LEGACY_DOCSTORE_FILE = "index.pkl"
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def source_of(metadata: dict) -> str | None:
+    """Name of the file or dataset a chunk was split from, chunks of older versions only carry their title"""
+    return metadata.get("source", metadata.get("title"))
+
+
+def source_ranges(metadatas: Iterable[dict], offset: int = 0) -> dict[str, list[list[int]]]:
+    """
+    Positions of the chunks of each source as [start, end) ranges, chunks of one source are mostly consecutive
+
+    :param metadatas: Metadata of the chunks, in vector order
+    :param offset: Position of the first chunk
+    """
+    ranges = {}
+    for position, metadata in enumerate(metadatas, offset):
+        source = source_of(metadata)
+        if source is None:
+            continue
+        runs = ranges.setdefault(source, [])
+        if runs and runs[-1][1] == position:
+            runs[-1][1] = position + 1
+        else:
+            runs.append([position, position + 1])
+    return ranges
+
+
+class SegmentedIndex:
+    """
+    Flat index over the read-only, memory mapped indexes of several segments plus an in-memory index for vectors
+    added after loading. Searched as one index with consecutive ids, only the pages of vectors touched are resident.
+    """
+
+    def __init__(self, shards: list[faiss.Index]):
+        """
+        :param shards: Memory mapped flat indexes of the segments, in vector order
+        """
+        self.shards = shards
+        self.d = shards[0].d
+        self.metric_type = shards[0].metric_type
+        self.is_trained = True
+        self.tail = faiss.IndexFlat(self.d, self.metric_type)  # mapped indexes cannot be added to
+
+    @property
+    def indexes(self) -> list[faiss.Index]:
+        return self.shards + [self.tail]
+
+    @property
+    def ntotal(self) -> int:
+        return sum(index.ntotal for index in self.indexes)
+
+    def add(self, x: np.ndarray):
+        self.tail.add(x)
+
+    def search(self, x: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        distances, ids, offset = [], [], 0
+        for index in self.indexes:
+            if index.ntotal:
+                shard_distances, shard_ids = index.search(x, min(k, index.ntotal))
+                distances.append(shard_distances)
+                ids.append(np.where(shard_ids >= 0, shard_ids + offset, -1))
+            offset += index.ntotal
+        descending = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        distances = np.hstack(distances) if distances else np.empty((len(x), 0), dtype=np.float32)
+        ids = np.hstack(ids) if ids else np.empty((len(x), 0), dtype=np.int64)
+        order = np.argsort(-distances if descending else distances, axis=1, kind="stable")[:, :k]
+        distances, ids = np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+        if ids.shape[1] < k:  # fewer vectors than requested, padded like faiss does
+            missing = k - ids.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, missing)), constant_values=-np.inf if descending else np.inf)
+            ids = np.pad(ids, ((0, 0), (0, missing)), constant_values=-1)
+        return distances, ids
+
+    def _locate(self, i: int) -> tuple[faiss.Index, int]:
+        for index in self.indexes:
+            if i < index.ntotal:
+                return index, i
+            i -= index.ntotal
+        raise IndexError(i)
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        index, i = self._locate(int(i))
+        return index.reconstruct(i)
+
+    def reconstruct_n(self, i0: int, n: int) -> np.ndarray:
+        vectors, offset = [], 0
+        for index in self.indexes:
+            start, end = max(i0 - offset, 0), min(i0 + n - offset, index.ntotal)
+            if start < end:
+                vectors.append(index.reconstruct_n(start, end - start))
+            offset += index.ntotal
+        return np.vstack(vectors) if vectors else np.empty((0, self.d), dtype=np.float32)
+
+
+class SegmentStore:
+    """
+    Append-only on-disk layout of a FAISS index.
+
+    Every merge is written once as an immutable segment directory, holding the vectors and the chunks as JSON lines
+    with their byte offsets, and a small manifest lists the live segments.
+    The manifest is only ever replaced atomically after its segments are fully written, so a crash mid-write leaves
+    the previous manifest, and therefore the previous index, intact. Once `compact_segments` consecutive segments are
+    of similar size they are merged into one in the background, so each chunk is only rewritten once per size tier
+    and the first, usually by far largest, segment is never rewritten.
+
+    Each segment also stores the content hash of every chunk, see `ChunkHashes`.
+    The manifest maps each source to the rows of its chunks in every segment. Removing a source only marks its
+    rows as deleted, they are hidden from searches and dropped from disk when their segment is next compacted.
+    It also lists, by content hash, the chunks each source shares with others but did not store itself because they
+    were duplicates. Those rows are handed over to a source sharing them instead of being deleted.
+
+    With `mmap` the segments are not read into memory on load: vectors are memory mapped read-only and chunks are read
+    from disk only when a search returns them.
+    """
+
+    def __init__(self, path: Path, embedding_model: Embeddings, compact_segments: int = COMPACT_SEGMENTS, mmap: bool = False):
+        """
+        :param path: Index directory, segments are stored in its `segments` subdirectory
+        :param embedding_model: Huggingface model the segments were embedded with
+        :param compact_segments: Number of similarly sized segments that triggers a background compaction
+        :param mmap: Memory map the segments instead of loading them
+        """
+        self.path = path
+        self.segment_path = path / SEGMENT_DIR
+        self.embedding_model = embedding_model
+        self.compact_segments = compact_segments
+        self.mmap = mmap
+        self._lock = threading.Lock()
+        self._compaction: threading.Thread | None = None
+        self.segments, self._next_id, self.sources, self.deleted, self.references = self._read_manifest()
+
+    @property
+    def exists(self) -> bool:
+        return (self.path / MANIFEST).exists()
+
+    def _read_manifest(
+        self,
+    ) -> tuple[list[str], int, dict[str, dict[str, list[list[int]]]], dict[str, list[list[int]]], dict[str, list[int]]]:
+        if not self.exists:
+            return [], 0, {}, {}, {}
+        with open(self.path / MANIFEST, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return manifest["segments"], manifest["next_id"], manifest.get("sources", {}), manifest.get("deleted", {}), manifest.get("references", {})
+
+    def _write_manifest(self):
+        """Atomically replace the manifest, caller must hold the lock"""
+        tmp_file = self.path / (MANIFEST + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            manifest = {
+                "segments": self.segments,
+                "next_id": self._next_id,
+                "sources": self.sources,
+                "deleted": self.deleted,
+                "references": self.references,
+            }
+            json.dump(manifest, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path / MANIFEST)
+
+    def _write_segment(self, index: faiss.Index, write_chunks_to) -> str:
+        """
+        Write a new segment directory and return its name, the segment is not live until it is in the manifest
+
+        :param index: Flat index of the segment's vectors
+        :param write_chunks_to: Writes the segment's chunks into the directory it is called with
+        """
+        with self._lock:
+            name = f"seg-{self._next_id:06d}"
+            self._next_id += 1
+        tmp_dir = self.segment_path / (name + ".tmp")
+        tmp_dir.mkdir(parents=True)
+        faiss.write_index(index, str(tmp_dir / INDEX_FILE))
+        write_chunks_to(tmp_dir)
+        for file in tmp_dir.iterdir():
+            with open(file, "rb") as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_dir, self.segment_path / name)
+        return name
+
+    @staticmethod
+    def _store_chunks(store: FAISS):
+        """(docstore id, document) pairs of a store, in vector order"""
+        for i in range(store.index.ntotal):
+            doc_id = store.index_to_docstore_id[i]
+            yield doc_id, store.docstore.search(doc_id)
+
+    def _write_contents(self, path: Path, store: FAISS, documents: list):
+        write_chunks(path, self._store_chunks(store))
+        self._write_hashes(path, chunk_hashes([doc.page_content for doc in documents]))
+
+    @staticmethod
+    def _write_hashes(path: Path, hashes: np.ndarray):
+        with open(path / (HASHES_FILE + ".tmp"), "wb") as f:
+            np.save(f, hashes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path / (HASHES_FILE + ".tmp"), path / HASHES_FILE)
+
+    def hashes(self) -> np.ndarray:
+        """Content hashes of the chunks in the store returned by `load`, segments of older versions are hashed once"""
+        with self._lock:
+            segments = list(self.segments)
+        hashes = [self._segment_hashes(self.segment_path / name) for name in segments]
+        return np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+    def _segment_hashes(self, segment: Path) -> np.ndarray:
+        if not (segment / HASHES_FILE).exists():
+            logger.info(f"Hashing the chunks of {segment}")
+            self._write_hashes(segment, chunk_hashes([doc.page_content for doc in read_chunks(segment)]))
+        return np.load(segment / HASHES_FILE)
+
+    def _upgrade(self, segment: Path):
+        """Move the chunks of a segment written by an older version out of its pickled docstore"""
+        logger.info(f"Writing chunks of {segment} to an offset-indexed file")
+        store = FAISS.load_local(folder_path=str(segment), embeddings=self.embedding_model, allow_dangerous_deserialization=True)
+        write_chunks(segment, self._store_chunks(store))
+        os.remove(segment / LEGACY_DOCSTORE_FILE)
+
+    def _load_segment(self, segment: Path) -> FAISS:
+        """Read a segment's vectors and chunks into memory"""
+        documents = read_chunks(segment)
+        return FAISS(
+            self.embedding_model,
+            faiss.read_index(str(segment / INDEX_FILE)),
+            InMemoryDocstore({doc.id: doc for doc in documents}),
+            {i: doc.id for i, doc in enumerate(documents)},
+        )
+
+    def load(self) -> FAISS | None:
+        """Load and merge all live segments, removing leftovers of interrupted writes"""
+        self.segment_path.mkdir(parents=True, exist_ok=True)
+        for leftover in self.segment_path.iterdir():
+            if leftover.name not in self.segments:
+                logger.info(f"Removing unreferenced segment {leftover}")
+                shutil.rmtree(leftover, ignore_errors=True)
+
+        for name in self.segments:
+            if not has_chunks(self.segment_path / name):
+                self._upgrade(self.segment_path / name)
+        unmapped = [name for name in self.segments if name not in self.sources]
+        if unmapped:  # segments written before sources were tracked
+            logger.info(f"Mapping the sources of {len(unmapped)} index segments")
+            with self._lock:
+                for name in unmapped:
+                    self.sources[name] = source_ranges(doc.metadata for doc in read_chunks(self.segment_path / name))
+                self._write_manifest()
+
+        if not self.segments:
+            return None
+        if self.mmap:
+            shards = [faiss.read_index(str(self.segment_path / name / INDEX_FILE), MMAP_FLAGS) for name in self.segments]
+            index = SegmentedIndex(shards)
+            docstore = ChunkStore([ChunkFile(self.segment_path / name) for name in self.segments])
+            logger.info(f"Memory mapped {len(self.segments)} index segments from {self.segment_path}")
+            return FAISS(self.embedding_model, index, docstore, PositionIds(index.ntotal))
+
+        store = None
+        for name in self.segments:
+            segment = self._load_segment(self.segment_path / name)
+            if store is None:
+                store = segment
+            else:
+                store.merge_from(segment)
+        logger.info(f"Loaded {len(self.segments)} index segments from {self.segment_path}")
+        return store
+
+    def append(self, store: FAISS):
+        """
+        Persist newly added vectors as a segment, costing I/O proportional to `store` only
+
+        :param store: Vector store holding only the new vectors
+        """
+        self.segment_path.mkdir(parents=True, exist_ok=True)
+        documents = [doc for _, doc in self._store_chunks(store)]
+        name = self._write_segment(store.index, lambda path: self._write_contents(path, store, documents))
+        sources = source_ranges(doc.metadata for doc in documents)
+        with self._lock:
+            self.segments.append(name)
+            self.sources[name] = sources
+            self._write_manifest()
+            if self._compaction is None and (merging := self._compaction_run()):
+                self._compaction = threading.Thread(target=self._compact, args=(merging,), name="index-compaction", daemon=True)
+                self._compaction.start()
+
+    def _length(self, name: str) -> int:
+        return len(np.load(self.segment_path / name / OFFSETS_FILE, mmap_mode="r")) - 1
+
+    def _compaction_run(self) -> list[str]:
+        """
+        First `compact_segments` consecutive segments after the base segment whose largest is at most
+        `COMPACT_SIZE_RATIO` times the size of their smallest, caller must hold the lock.
+        Segments are kept consecutive so the merged segment takes their place without moving any other chunk.
+        """
+        sizes = [max(self._length(name), COMPACT_MIN_CHUNKS) for name in self.segments]
+        start = 1
+        for end in range(start + 1, len(sizes) + 1):
+            while max(sizes[start:end]) > COMPACT_SIZE_RATIO * min(sizes[start:end]):
+                start += 1
+            if end - start >= self.compact_segments:
+                return self.segments[start:end]
+        return []
+
+    def layout(self) -> tuple[dict[str, list[list[int]]], np.ndarray]:
+        """
+        Positions of each source's chunks and of the deleted chunks in the store returned by `load`,
+        which holds the segments one after another
+        """
+        sources, deleted, offset = {}, [], 0
+        with self._lock:
+            for name in self.segments:
+                for source, ranges in self.sources.get(name, {}).items():
+                    sources.setdefault(source, []).extend([start + offset, end + offset] for start, end in ranges)
+                deleted.append(range_positions(self.deleted.get(name, [])) + offset)
+                offset += self._length(name)
+        return sources, np.concatenate(deleted) if deleted else np.empty(0, dtype=np.int64)
+
+    def add_references(self, source: str, hashes: np.ndarray):
+        """
+        Record chunks of a source that were skipped because another source already stored them
+
+        :param source: Name of the file or dataset
+        :param hashes: Content hashes of the skipped chunks
+        """
+        with self._lock:
+            self.references[source] = np.union1d(np.asarray(self.references.get(source, []), dtype=np.uint64), hashes).tolist()
+            self._write_manifest()
+
+    def heirs(self, source: str, hashes: np.ndarray) -> list[str | None]:
+        """
+        Sources that take over chunks of `source` about to be removed, because they share them
+
+        :param source: Name of the file or dataset being removed
+        :param hashes: Content hashes of the chunks being removed
+        :return: Name of the source inheriting each chunk, None for chunks no other source shares
+        """
+        with self._lock:
+            return self._heirs(source, hashes)
+
+    def _heirs(self, source: str, hashes: np.ndarray) -> list[str | None]:
+        heirs = [None] * len(hashes)
+        for other, shared in self.references.items():
+            if other == source:
+                continue
+            for i in np.flatnonzero(np.isin(hashes, np.asarray(shared, dtype=np.uint64))):
+                heirs[i] = heirs[i] or other
+        return heirs
+
+    def remove_source(self, source: str, keep: np.ndarray | None = None) -> int:
+        """
+        Mark the chunks of a source as deleted, only the manifest is rewritten.
+        Chunks another source shares are handed over to it instead.
+
+        :param source: Name of the file or dataset
+        :param keep: Sorted content hashes of chunks to keep, e.g. those still in a re-ingested source
+        :return: Number of chunks marked as deleted
+        """
+        removed, inherited = 0, {}
+        with self._lock:
+            changed = source in self.references
+            references = np.asarray(self.references.pop(source, []), dtype=np.uint64)
+            if keep is not None and len(shared := np.intersect1d(references, keep)):
+                self.references[source] = shared.tolist()
+            for name, sources in self.sources.items():
+                if source not in sources:
+                    continue
+                changed = True
+                rows = range_positions(sources.pop(source))
+                hashes = np.load(self.segment_path / name / HASHES_FILE, mmap_mode="r")[rows]
+                if keep is not None:
+                    kept = np.isin(hashes, keep)
+                    if kept.any():
+                        sources[source] = position_ranges(rows[kept])
+                    rows, hashes = rows[~kept], hashes[~kept]
+                heirs = self._heirs(source, hashes)
+                for heir in set(heirs) - {None}:
+                    taken = np.array([other == heir for other in heirs], dtype=bool)
+                    sources[heir] = position_ranges(np.union1d(range_positions(sources.get(heir, [])), rows[taken]))
+                    inherited.setdefault(heir, []).append(hashes[taken])
+                rows = rows[np.array([heir is None for heir in heirs], dtype=bool)]
+                if len(rows):
+                    self.deleted[name] = position_ranges(np.union1d(range_positions(self.deleted.get(name, [])), rows))
+                    removed += len(rows)
+            for heir, hashes in inherited.items():  # the heir stores these chunks now
+                shared = np.setdiff1d(np.asarray(self.references[heir], dtype=np.uint64), np.concatenate(hashes))
+                if len(shared):
+                    self.references[heir] = shared.tolist()
+                else:
+                    del self.references[heir]
+            if changed:
+                self._write_manifest()
+        return removed
+
+    def _compact(self, merging: list[str]):
+        """
+        Merge consecutive segments into one, dropping deleted chunks. Segments appended meanwhile stay as they are,
+        sources removed meanwhile are carried over to the merged segment.
+
+        :param merging: Names of the segments, in vector order
+        """
+        with self._lock:
+            deleted = {name: range_positions(self.deleted.get(name, [])) for name in merging}
+        try:
+            logger.info(f"Compacting {len(merging)} index segments")
+            merged, keep, new_rows = None, [], {}
+            for name in merging:  # vectors are copied from the mapped files, chunks are concatenated without decoding
+                segment = faiss.read_index(str(self.segment_path / name / INDEX_FILE), MMAP_FLAGS)
+                if merged is None:
+                    merged = faiss.IndexFlat(segment.d, segment.metric_type)
+                kept = ~np.isin(np.arange(segment.ntotal), deleted[name])
+                new_rows[name] = np.where(kept, merged.ntotal + np.cumsum(kept) - 1, -1)
+                merged.add(segment.reconstruct_n(0, segment.ntotal)[kept])
+                keep.append(kept)
+            paths = [self.segment_path / name for name in merging]
+            hashes = np.concatenate([self._segment_hashes(path)[kept] for path, kept in zip(paths, keep)])
+
+            def write_contents(path: Path):
+                concat_chunks(path, paths, keep)
+                self._write_hashes(path, hashes)
+
+            compacted = self._write_segment(merged, write_contents)
+            with self._lock:
+                if not all(name in self.segments for name in merging):  # the store was reset while compacting
+                    shutil.rmtree(self.segment_path / compacted, ignore_errors=True)
+                    return
+                sources, newly_deleted = {}, []
+                for name in merging:
+                    rows = new_rows[name]
+                    for source, ranges in self.sources.pop(name, {}).items():
+                        moved = rows[range_positions(ranges)]
+                        sources.setdefault(source, []).extend(position_ranges(moved[moved >= 0]))
+                    moved = rows[range_positions(self.deleted.pop(name, []))]
+                    newly_deleted.append(moved[moved >= 0])
+                first = self.segments.index(merging[0])
+                self.segments[first : first + len(merging)] = [compacted]
+                self.sources[compacted] = sources
+                if dropped := position_ranges(np.sort(np.concatenate(newly_deleted))):
+                    self.deleted[compacted] = dropped
+                self._write_manifest()
+            for name in merging:
+                shutil.rmtree(self.segment_path / name, ignore_errors=True)
+            if any(len(rows) for rows in deleted.values()):  # positions moved, a cached approximate index no longer matches
+                shutil.rmtree(self.path / ANN_DIR, ignore_errors=True)
+            logger.info(f"Compacted {len(merging)} index segments into {compacted}")
+        except Exception as e:
+            logger.error(f"Index compaction failed with {e}, keeping the existing segments")
+        finally:
+            with self._lock:
+                self._compaction = None
+
+    @property
+    def compacting(self) -> bool:
+        compaction = self._compaction
+        return compaction is not None and compaction.is_alive()
+
+    def wait(self):
+        """Block until a running compaction has finished"""
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+
+    def reset(self):
+        """Forget all segments, used after the index directory has been wiped"""
+        with self._lock:
+            self.segments = []
+            self.sources = {}
+            self.deleted = {}
+            self.references = {}
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from llm_discord_bot.client import LocalLlmClient, decode_documents, encode_documents
+from llm_discord_bot.constants import SERVER_HOST, SERVER_PORT
+from llm_discord_bot.metrics import metrics
+
+RESPONSE_FIELDS = ("query", "context", "identity", "num_retrieved_docs", "num_docs_final", "rag", "namespace", "max_new_tokens")
+
+
+def _line(data: dict) -> bytes:
+    return (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class LlmServer:
+    """
+    Serves one LlmRag instance over local HTTP, so the model runs in its own process and any number of bots
+    (see `RemoteLlmClient`) can share it. Concurrent requests are batched by the llm's generation scheduler.
+
+    The server accepts connections right away, requests wait until the models have been loaded in the background.
+    """
+
+    def __init__(self, llm: LocalLlmClient):
+        """
+        :param llm: In-process client owning the LlmRag instance
+        """
+        self.llm = llm
+        self.app = web.Application(client_max_size=256 * 1024**2)  # uploaded documents arrive as one request
+        self.app.on_startup.append(self._start)
+        self.app.on_cleanup.append(self._close)
+        self.app.add_routes(
+            [
+                web.post("/response", self.response),
+                web.post("/stream", self.stream),
+                web.get("/status", self.status),
+                web.get("/info", self.info),
+                web.get("/entries", self.entries),
+                web.post("/wipe", self.wipe),
+                web.post("/remove", self.remove_source),
+                web.post("/ingest/documents", self.submit_documents),
+                web.post("/ingest/dataset", self.submit_dataset),
+                web.get("/jobs", self.jobs),
+                web.get("/jobs/pending", self.is_pending),
+                web.get("/metrics", metrics.handle),
+                web.get("/stats", self.stats),
+                web.post("/profile", self.profile),
+                web.post("/profile/stop", self.stop_profile),
+            ]
+        )
+
+    async def _start(self, app: web.Application):
+        self.llm.start()
+
+    async def _close(self, app: web.Application):
+        await self.llm.close()
+
+    @staticmethod
+    async def _response_kwargs(request: web.Request) -> dict:
+        body = await request.json()
+        return {key: body[key] for key in RESPONSE_FIELDS if key in body}
+
+    async def response(self, request: web.Request) -> web.Response:
+        answer, docs = await self.llm.aresponse(**await self._response_kwargs(request))
+        return web.json_response({"answer": answer, "docs": encode_documents(docs)})
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        """Answer as newline delimited JSON, the retrieved documents first and then the text as it is generated"""
+        stream, docs = await self.llm.astream_response(**await self._response_kwargs(request))
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        await response.write(_line({"docs": encode_documents(docs)}))
+        async for text in stream:
+            await response.write(_line({"text": text}))
+        await response.write_eof()
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(metrics.snapshot())
+
+    async def profile(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"profile": await self.llm.profile(body["seconds"], body.get("torch", False))})
+
+    async def stop_profile(self, request: web.Request) -> web.Response:
+        return web.json_response({"stopped": await self.llm.stop_profile()})
+
+    async def status(self, request: web.Request) -> web.Response:
+        return web.json_response(await self.llm.status())
+
+    async def info(self, request: web.Request) -> web.Response:
+        return web.json_response(await self.llm.info())
+
+    async def entries(self, request: web.Request) -> web.Response:
+        return web.json_response(await self.llm.database_entries(request.query["namespace"]))
+
+    async def wipe(self, request: web.Request) -> web.Response:
+        await self.llm.drop_database((await request.json())["namespace"])
+        return web.json_response({})
+
+    async def remove_source(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"removed": await self.llm.remove_source(body["namespace"], body["source"])})
+
+    async def submit_documents(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        job = await self.llm.submit_documents(
+            body["namespace"], body["name"], body["size"], decode_documents(body["documents"]), body.get("channel_id")
+        )
+        return web.json_response(job)
+
+    async def submit_dataset(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        job = await self.llm.submit_dataset(body["namespace"], body["dataset"], body["split"], body["column"], body.get("channel_id"))
+        return web.json_response(job)
+
+    async def jobs(self, request: web.Request) -> web.Response:
+        jobs, stats = await self.llm.jobs(request.query.get("namespace"))
+        return web.json_response({"jobs": jobs, "stats": stats})
+
+    async def is_pending(self, request: web.Request) -> web.Response:
+        return web.json_response({"pending": await self.llm.is_pending(request.query["namespace"], request.query.get("name"))})
+
+
+def main():
+    load_dotenv()
+    if os.getenv("HUGGINGFACE_TOKEN") is None:
+        raise EnvironmentError("Could not find environment variable for `HUGGINGFACE_TOKEN`, exiting")
+    logging.basicConfig(level=logging.INFO)
+
+    server = LlmServer(LocalLlmClient())
+    web.run_app(server.app, host=os.getenv("LLM_SERVER_HOST", SERVER_HOST), port=int(os.getenv("LLM_SERVER_PORT", SERVER_PORT)))
+
+
+if __name__ == "__main__":
+    main()
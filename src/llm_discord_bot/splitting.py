@@ -0,0 +1,107 @@
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Iterator, List, TypeVar
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from transformers import AutoTokenizer
+
+from llm_discord_bot.constants import MARKDOWN_SEPARATORS
+from llm_discord_bot.metrics import metrics
+
+logger = logging.getLogger("SPLITTING")
+
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=4)
+def text_splitter(tokenizer_name: str, chunk_size: int) -> RecursiveCharacterTextSplitter:
+    """Splitter measuring chunks with the tokenizer of `tokenizer_name`, loaded once per process"""
+    logger.info(f"Initializing text splitter with {tokenizer_name=}...")
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        AutoTokenizer.from_pretrained(tokenizer_name),
+        chunk_size=chunk_size,
+        chunk_overlap=int(chunk_size / 10),
+        add_start_index=True,
+        strip_whitespace=True,
+        separators=MARKDOWN_SEPARATORS,
+    )
+
+
+def split_documents(tokenizer_name: str, chunk_size: int, documents: List[Document]) -> List[Document]:
+    """
+    Split documents into chunks of maximum size `chunk_size` tokens, dropping duplicate chunks
+
+    :param tokenizer_name: Pretrained model for tokenizing
+    :param chunk_size: Maximum chunk size in tokens
+    :param documents: The loaded data to split
+    """
+    unique = {}
+    for doc in text_splitter(tokenizer_name, chunk_size).split_documents(documents):
+        unique.setdefault(doc.page_content, doc)
+    return list(unique.values())
+
+
+class DocumentSplitter:
+    """
+    Splits documents with a tokenizer and splitter that are only loaded once.
+
+    With more than one process, batches are split by a pool of worker processes while the caller embeds the
+    batches split before them, so splitting and embedding overlap during ingestion.
+    """
+
+    def __init__(self, tokenizer_name: str, chunk_size: int = 512, processes: int = 1, prefetch: int | None = None):
+        """
+        :param tokenizer_name: Pretrained model for tokenizing, the embedding model
+        :param chunk_size: Maximum chunk size in tokens
+        :param processes: Number of worker processes, 1 splits in the calling thread
+        :param prefetch: Number of batches split ahead of the caller, twice the number of processes by default
+        """
+        self.tokenizer_name = tokenizer_name
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch or 2 * processes
+        # spawned, forking a process holding the models and their threads is unsafe; workers start on first use
+        self.pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) if processes > 1 else None
+
+    def split(self, documents: List[Document]) -> List[Document]:
+        """Split documents in the calling thread"""
+        return split_documents(self.tokenizer_name, self.chunk_size, documents)
+
+    def split_batches(self, batches: Iterable[tuple[T, List[Document]]]) -> Iterator[tuple[T, List[Document]]]:
+        """
+        Split a stream of document batches, in order. The batches are read ahead of the caller by up to `prefetch`.
+
+        :param batches: (key, documents) pairs, the key is handed back with the split documents
+        """
+        if self.pool is None:
+            for key, documents in batches:
+                with metrics.timer("ingest_split"):
+                    chunks = self.split(documents)
+                yield key, chunks
+            return
+
+        in_flight: deque[tuple[T, Future]] = deque()
+        try:
+            for key, documents in batches:
+                in_flight.append((key, self.pool.submit(split_documents, self.tokenizer_name, self.chunk_size, documents)))
+                if len(in_flight) >= self.prefetch:
+                    yield self._result(*in_flight.popleft())
+            while in_flight:
+                yield self._result(*in_flight.popleft())
+        finally:
+            for _, future in in_flight:  # the caller stopped early
+                future.cancel()
+
+    @staticmethod
+    def _result(key: T, future: Future) -> tuple[T, List[Document]]:
+        # only the time spent waiting on the workers, splitting that overlapped with embedding is free
+        with metrics.timer("ingest_split_wait"):
+            return key, future.result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,57 @@
+import time
+
+from discord import Message
+from discord.abc import Messageable
+
+from llm_discord_bot.constants import DISCORD_MESSAGE_LIMIT
+from llm_discord_bot.utils import filter_mentions
+
+
+class StreamingReply:
+    """
+    Progressively edits a discord message while the llm generates text.
+
+    The first piece of text is sent straight away, afterwards edits are throttled to one per `edit_interval`
+    seconds to stay under discord's rate limits. Once a message is full a new one is opened for the rest.
+    """
+
+    def __init__(self, channel: Messageable, edit_interval: float = 1.0):
+        """
+        :param channel: Channel to reply in
+        :param edit_interval: Minimum seconds between two edits of the same message
+        """
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.message: Message | None = None
+        self.text = ""  # text of the message currently being edited
+        self.shown = ""  # text discord currently shows for that message
+        self.last_edit = 0.0
+
+    async def write(self, text: str):
+        """
+        Append generated text, flushing it to discord if the last edit is old enough
+
+        :param text: Newly generated text
+        """
+        self.text += text
+        while len(self.text) > DISCORD_MESSAGE_LIMIT:
+            full, self.text = self.text[:DISCORD_MESSAGE_LIMIT], self.text[DISCORD_MESSAGE_LIMIT:]
+            await self._show(full)
+            self.message, self.shown = None, ""
+        if self.message is None or time.monotonic() - self.last_edit >= self.edit_interval:
+            await self._show(self.text)
+
+    async def close(self):
+        """Flush any text that has not been shown yet"""
+        await self._show(self.text)
+
+    async def _show(self, text: str):
+        content = filter_mentions(text)
+        if not content.strip() or content == self.shown:
+            return
+        if self.message is None:
+            self.message = await self.channel.send(content)
+        else:
+            await self.message.edit(content=content)
+        self.shown = content
+        self.last_edit = time.monotonic()
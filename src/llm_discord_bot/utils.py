@@ -1,5 +1,7 @@
 import re
 
+from llm_discord_bot.constants import DISCORD_MESSAGE_LIMIT
+
 
 def remove_id(text):
     """Removes discord IDs from strings"""
@@ -7,8 +9,8 @@ def remove_id(text):
 
 
 def split_message(message):
-    """Split messages into 1999 character chunks (discord's message limit)"""
-    return [message[i : i + 1999] for i in range(0, len(message), 2000)]
+    """Split messages into 2000 character chunks (discord's message limit)"""
+    return [message[i : i + DISCORD_MESSAGE_LIMIT] for i in range(0, len(message), DISCORD_MESSAGE_LIMIT)]
 
 
 def filter_mentions(text):
@@ -16,3 +18,15 @@ def filter_mentions(text):
     pattern = r"[@]?(\b(here|everyone|channel)\b)"
     filtered_text = re.sub(pattern, "", text)
     return filtered_text
+
+
+def namespace_name(guild_id: int | None, channel_id: int | None = None) -> str:
+    """
+    Name of the knowledge base of a guild, or of one of its channels
+
+    :param guild_id: Discord guild id, None for direct messages
+    :param channel_id: Discord channel id, None to share the guild's knowledge base between its channels
+    """
+    if guild_id is None:
+        return f"dm-{channel_id}"
+    return f"guild-{guild_id}" if channel_id is None else f"guild-{guild_id}-channel-{channel_id}"
@@ -0,0 +1,75 @@
+import asyncio
+
+from llm_discord_bot.admission import ADMITTED, DEGRADED, OVERLOADED, QUEUE_FULL, USER_LIMIT, AdmissionQueue
+
+
+def run(test):
+    """Tickets that wait for a slot need a running event loop"""
+    return asyncio.run(test())
+
+
+def test_queued_replies_are_served_round_robin_over_channels_and_users():
+    async def test():
+        queue = AdmissionQueue(max_active=1, max_queued=10, max_per_user=10, slo=60)
+        active = queue.request(1, 1)
+        first, second = queue.request(1, 1), queue.request(1, 1)
+        other_user, other_channel = queue.request(1, 2), queue.request(2, 3)
+
+        served = []
+        for _ in range(4):
+            queue.release(active)
+            active = next(ticket for ticket in (first, second, other_user, other_channel) if ticket.granted and not ticket.released)
+            served.append(active)
+        return served, [first, other_channel, other_user, second]
+
+    served, expected = run(test)
+
+    assert served == expected
+
+
+def test_user_cap_and_queue_size():
+    async def test():
+        queue = AdmissionQueue(max_active=1, max_queued=2, max_per_user=2, slo=60)
+        held = [queue.request(1, 1), queue.request(1, 1)]
+        capped = queue.request(1, 1)
+        queued = queue.request(1, 2)
+        full = queue.request(1, 3)
+        queue.release(held[1])  # leaves the queue before getting a slot
+        again = queue.request(1, 1)
+        return capped, queued, full, again, queue.queued
+
+    capped, queued, full, again, queued_count = run(test)
+
+    assert capped.decision == USER_LIMIT and capped.shed
+    assert queued.decision == ADMITTED
+    assert full.decision == QUEUE_FULL
+    assert not again.shed
+    assert queued_count == 2
+
+
+def test_estimated_wait_degrades_and_then_sheds_replies():
+    async def test():
+        queue = AdmissionQueue(max_active=1, max_queued=10, max_per_user=10, slo=30, degrade_share=0.5)
+        queue.service_time = 10.0
+        queue.request(1, 0)
+        tickets = [queue.request(1, user) for user in range(1, 5)]
+        return tickets, queue.queued
+
+    tickets, queued = run(test)
+
+    # estimated waits of 10, 20, 30 and 40 seconds
+    assert [ticket.decision for ticket in tickets] == [ADMITTED, DEGRADED, DEGRADED, OVERLOADED]
+    assert queued == 3
+
+
+def test_reply_that_waited_past_the_degrade_threshold_is_degraded():
+    async def test():
+        queue = AdmissionQueue(max_active=1, max_queued=10, max_per_user=10, slo=30, degrade_share=0.5)
+        active = queue.request(1, 1)
+        waiting = queue.request(1, 2)
+        waiting.enqueued -= 20
+        queue.release(active)
+        await waiting.wait()
+        return waiting
+
+    assert run(test).decision == DEGRADED
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from llm_discord_bot.client import LocalLlmClient
+
+
+def fail_loading():
+    raise RuntimeError("out of memory")
+
+
+def test_status_reports_failed_loading():
+    async def run():
+        client = LocalLlmClient(load_llm=fail_loading)
+        client.start()
+        with pytest.raises(RuntimeError):
+            await client._ready()
+        return await client.status()
+
+    status = asyncio.run(run())
+
+    assert not status["ready"]
+    assert status["error"] == "out of memory"
+
+
+def test_status_before_loading():
+    status = asyncio.run(LocalLlmClient(load_llm=fail_loading).status())
+
+    assert (status["ready"], status["error"], status["stage"]) == (False, None, "not started")
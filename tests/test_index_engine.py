@@ -0,0 +1,70 @@
+import json
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+
+from llm_discord_bot.constants import ANN_DIR, INDEX_CONFIG
+from llm_discord_bot.index_engine import FilteredIndex, IndexEngine
+from llm_discord_bot.segments import SegmentedIndex
+
+DIMENSION = 8
+
+
+def vectors(n: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).random((n, DIMENSION), dtype=np.float32)
+
+
+def flat_store(x: np.ndarray, first_id: int = 0) -> FAISS:
+    index = faiss.IndexFlatL2(DIMENSION)
+    index.add(x)
+    ids = {i: str(first_id + i) for i in range(len(x))}
+    docstore = InMemoryDocstore({doc_id: Document(page_content=doc_id) for doc_id in ids.values()})
+    return FAISS(FakeEmbeddings(size=DIMENSION), index, docstore, ids)
+
+
+def hnsw_engine(path, min_train_size: int = 50) -> IndexEngine:
+    with open(path / INDEX_CONFIG, "w", encoding="utf-8") as f:
+        json.dump({"index_type": "hnsw", "min_train_size": min_train_size}, f)
+    return IndexEngine(path)
+
+
+def test_add_migrates_filtered_flat_index(tmp_path):
+    engine = hnsw_engine(tmp_path)
+    target = flat_store(vectors(40, 0))
+    target.index = FilteredIndex(target.index)
+    target.index.hide(np.array([0]))
+
+    engine.add(target, flat_store(vectors(20, 1), first_id=40))
+
+    assert isinstance(target.index, FilteredIndex)
+    assert isinstance(target.index.index, faiss.IndexHNSWFlat)
+    assert target.index.ntotal == 60
+    _, ids = target.index.search(vectors(40, 0)[:1], 5)
+    assert 0 not in ids
+
+
+def test_add_migrates_segmented_index(tmp_path):
+    engine = hnsw_engine(tmp_path)
+    target = flat_store(vectors(40, 0))
+    target.index = SegmentedIndex([target.index])
+
+    engine.add(target, flat_store(vectors(20, 1), first_id=40))
+
+    assert isinstance(target.index, faiss.IndexHNSWFlat)
+    assert target.index.ntotal == 60
+    assert (tmp_path / ANN_DIR / "index.faiss").exists()
+
+
+def test_add_keeps_small_index_flat(tmp_path):
+    engine = hnsw_engine(tmp_path, min_train_size=100)
+    target = flat_store(vectors(40, 0))
+    target.index = FilteredIndex(target.index)
+
+    engine.add(target, flat_store(vectors(20, 1), first_id=40))
+
+    assert IndexEngine.is_flat(target.index)
+    assert target.index.ntotal == 60
@@ -0,0 +1,82 @@
+import hashlib
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+pytest.importorskip("torch")  # llmrag loads the llm backends
+
+from llm_discord_bot.llmrag import LlmRag
+from llm_discord_bot.namespaces import NamespaceManager
+
+DIMENSION = 16
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic vectors derived from the text"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "little")
+        vector = np.random.default_rng(seed).random(DIMENSION)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class Splitter:
+    """Hands documents on unsplit, optionally failing after the first batch"""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+
+    def split_batches(self, batches):
+        for key, documents in batches:
+            yield key, [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+            if self.fail:
+                raise RuntimeError("splitting failed")
+
+
+def llm_rag(path, splitter: Splitter) -> LlmRag:
+    llm = LlmRag.__new__(LlmRag)  # without loading any models
+    llm.embedding_model = HashEmbeddings()
+    llm.response_cache = None
+    llm.splitter = splitter
+    llm.namespaces = NamespaceManager(path, llm.embedding_model, "default")
+    return llm
+
+
+def documents(name, texts):
+    return [Document(page_content=text, metadata={"title": name}) for text in texts]
+
+
+def search(llm, namespace, text):
+    with llm.namespaces.use(namespace) as ns:
+        return [doc.page_content for doc in ns.loaded_index.similarity_search_by_vector(llm.embedding_model.embed_query(text), k=5)]
+
+
+def test_failed_merge_is_persisted_on_retry(tmp_path):
+    llm = llm_rag(tmp_path, Splitter(fail=True))
+    with pytest.raises(RuntimeError):
+        llm.merge_many_to_db("guild", [("a.txt", 10, documents("a.txt", ["first", "second"]))])
+    with llm.namespaces.use("guild") as ns:
+        assert ns.loaded_index is None
+        assert len(ns.chunk_hashes) == 0
+
+    llm.splitter = Splitter()
+    llm.merge_many_to_db("guild", [("a.txt", 10, documents("a.txt", ["first", "second"]))])
+
+    restarted = llm_rag(tmp_path, Splitter())
+    assert sorted(search(restarted, "guild", "first")) == ["first", "second"]
+
+
+def test_removing_a_source_keeps_chunks_it_shares(tmp_path):
+    llm = llm_rag(tmp_path, Splitter())
+    llm.merge_many_to_db("guild", [("s0", 10, documents("s0", ["shared", "only s0"]))])
+    llm.merge_many_to_db("guild", [("s1", 10, documents("s1", ["shared", "only s1"]))])
+
+    llm.remove_source("guild", "s0")
+
+    assert "shared" in search(llm, "guild", "shared")
+    assert "shared" in search(llm_rag(tmp_path, Splitter()), "guild", "shared")
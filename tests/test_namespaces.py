@@ -0,0 +1,23 @@
+import threading
+
+from langchain_core.embeddings import FakeEmbeddings
+
+from llm_discord_bot.namespaces import NamespaceManager
+
+
+def test_compacting_namespace_is_not_evicted(tmp_path):
+    manager = NamespaceManager(tmp_path, FakeEmbeddings(size=8), "default", memory_budget=0)
+    finished = threading.Event()
+    with manager.use("compacting") as ns:
+        ns.size = 1
+        ns.segment_store._compaction = threading.Thread(target=finished.wait, daemon=True)
+        ns.segment_store._compaction.start()
+
+    assert manager.stats()["memory_bytes"] == 1
+
+    finished.set()
+    ns.segment_store.wait()
+    with manager.use("other"):
+        pass
+
+    assert manager.stats()["memory_bytes"] == 0
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from llm_discord_bot.backends import TransformersBackend  # noqa: E402
+from llm_discord_bot.prefix_cache import PrefixCache, prompt_prefix  # noqa: E402
+
+MODEL = "hf-internal-testing/tiny-random-LlamaForCausalLM"
+TEMPLATE = "System: {identity}\n\nContext:\n{context}\n---\nQuestion: {query}\nAnswer:"
+IDENTITY = "You are a helpful assistant"
+
+
+@pytest.fixture(scope="module")
+def backend() -> TransformersBackend:
+    try:
+        model = transformers.AutoModelForCausalLM.from_pretrained(MODEL)
+        tokenizer = transformers.AutoTokenizer.from_pretrained(MODEL)
+    except OSError as e:
+        pytest.skip(f"Cannot load {MODEL}: {e}")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    backend = TransformersBackend.__new__(TransformersBackend)  # without quantizing a full size model
+    backend.llm = SimpleNamespace(model=model, tokenizer=tokenizer)
+    backend.generation_kwargs = dict(do_sample=False, max_new_tokens=8)
+    backend.prefix_cache = PrefixCache(model, tokenizer)
+    return backend
+
+
+@pytest.mark.parametrize("context", ["Document 1: the sky is blue", "\nDocument 1: the sky is blue", ""])
+def test_cached_prefix_keeps_greedy_output(backend, context):
+    prompt = TEMPLATE.format(identity=IDENTITY, context=context, query="What colour is the sky?")
+    uncached = backend.generate([prompt], [None])
+
+    backend.register_prefix(prompt_prefix(TEMPLATE, IDENTITY))
+
+    assert backend.generate([prompt], [None]) == uncached
+
+
+def test_prefix_ends_at_a_line_break():
+    assert prompt_prefix(TEMPLATE, IDENTITY) == f"System: {IDENTITY}\n\nContext:\n"
+
+
+def test_prefix_merged_into_the_prompt_tokens_is_not_used():
+    tokenizer = SimpleNamespace(encode=lambda text, add_special_tokens: [ord(c) for c in text.replace(":\n\n", "#")])
+    cache = PrefixCache(model=None, tokenizer=tokenizer)
+    cache.register("Context:\n")
+
+    assert cache.match("Context:\nabc", tokenizer.encode("Context:\nabc", add_special_tokens=False)) == "Context:\n"
+    assert cache.match("Context:\n\nabc", tokenizer.encode("Context:\n\nabc", add_special_tokens=False)) is None
@@ -0,0 +1,59 @@
+import numpy as np
+
+from llm_discord_bot import response_cache
+from llm_discord_bot.response_cache import ResponseCache
+
+RETRIEVED = ("0", "1")
+
+
+def vector(i: int) -> list[float]:
+    return np.eye(4, dtype=np.float32)[i].tolist()
+
+
+def test_similar_query_with_same_documents_hits():
+    cache = ResponseCache(threshold=0.9)
+    cache.put(vector(0), True, "bot", RETRIEVED, "answer")
+
+    assert cache.get(vector(0), True, "bot", RETRIEVED) == "answer"
+    assert cache.get(vector(1), True, "bot", RETRIEVED) is None
+    assert cache.get(vector(0), True, "bot", ("0", "2")) is None
+    assert cache.get(vector(0), False, "bot", RETRIEVED) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_least_recently_used_answer_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put(vector(0), False, "bot", (), "first")
+    cache.put(vector(1), False, "bot", (), "second")
+    cache.get(vector(0), False, "bot", ())
+
+    cache.put(vector(2), False, "bot", (), "third")
+
+    assert cache.get(vector(0), False, "bot", ()) == "first"
+    assert cache.get(vector(1), False, "bot", ()) is None
+    assert cache.get(vector(2), False, "bot", ()) == "third"
+
+
+def test_expired_answer_is_dropped(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(ttl=60)
+    cache.put(vector(0), False, "bot", (), "answer")
+
+    now[0] += 59
+    assert cache.get(vector(0), False, "bot", ()) == "answer"
+    now[0] += 2
+    assert cache.get(vector(0), False, "bot", ()) is None
+    assert cache._bytes == 0
+
+
+def test_answers_beyond_the_byte_cap_are_evicted():
+    size = np.asarray(vector(0), dtype=np.float32).nbytes + len("x" * 100)
+    cache = ResponseCache(max_bytes=2 * size)
+    for i in range(3):
+        cache.put(vector(i), False, "bot", (), "x" * 100)
+
+    assert cache.get(vector(0), False, "bot", ()) is None
+    assert cache.get(vector(1), False, "bot", ()) is not None
+    assert cache.get(vector(2), False, "bot", ()) is not None
+    assert cache._bytes == 2 * size
@@ -0,0 +1,101 @@
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+
+from llm_discord_bot.constants import COMPACT_MIN_CHUNKS, COMPACT_SIZE_RATIO
+from llm_discord_bot.segments import SegmentStore
+
+DIMENSION = 8
+EMBEDDINGS = FakeEmbeddings(size=DIMENSION)
+
+
+def vectors(n: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).random((n, DIMENSION), dtype=np.float32)
+
+
+def store(source: str, x: np.ndarray) -> FAISS:
+    index = faiss.IndexFlatL2(DIMENSION)
+    index.add(x)
+    ids = {i: f"{source}-{i}" for i in range(len(x))}
+    docstore = InMemoryDocstore({doc_id: Document(page_content=doc_id, metadata={"source": source}) for doc_id in ids.values()})
+    return FAISS(EMBEDDINGS, index, docstore, ids)
+
+
+def contents(loaded: FAISS) -> list[str]:
+    return [loaded.docstore.search(loaded.index_to_docstore_id[i]).page_content for i in range(loaded.index.ntotal)]
+
+
+def append_all(segment_store: SegmentStore, stores: list[FAISS]):
+    for added in stores:
+        segment_store.append(added)
+    segment_store.wait()
+
+
+def test_append_survives_reload(tmp_path):
+    first, second = store("a.txt", vectors(3, 0)), store("b.txt", vectors(2, 1))
+    append_all(SegmentStore(tmp_path, EMBEDDINGS), [first, second])
+
+    reloaded = SegmentStore(tmp_path, EMBEDDINGS)
+    loaded = reloaded.load()
+
+    assert len(reloaded.segments) == 2
+    assert contents(loaded) == contents(first) + contents(second)
+    np.testing.assert_array_equal(loaded.index.reconstruct_n(0, 5), np.vstack([vectors(3, 0), vectors(2, 1)]))
+    assert reloaded.layout()[0] == {"a.txt": [[0, 3]], "b.txt": [[3, 5]]}
+
+
+def test_compaction_leaves_the_base_segment_alone(tmp_path):
+    base = store("base", vectors(COMPACT_SIZE_RATIO * COMPACT_MIN_CHUNKS + 1, 0))
+    small = [store(f"{i}.txt", vectors(2, i + 1)) for i in range(4)]
+    segment_store = SegmentStore(tmp_path, EMBEDDINGS, compact_segments=4)
+    append_all(segment_store, [base] + small[:3])
+    assert len(segment_store.segments) == 4
+
+    append_all(segment_store, small[3:])
+
+    assert len(segment_store.segments) == 2
+    assert segment_store.segments[0] == "seg-000000"
+    loaded = SegmentStore(tmp_path, EMBEDDINGS).load()
+    assert contents(loaded) == sum((contents(added) for added in [base] + small), [])
+
+
+def test_compaction_merges_similar_sizes_only(tmp_path):
+    large = [store(f"large{i}", vectors(COMPACT_SIZE_RATIO * COMPACT_MIN_CHUNKS + 1, i)) for i in range(2)]
+    small = [store(f"{i}.txt", vectors(2, i + 2)) for i in range(3)]
+    segment_store = SegmentStore(tmp_path, EMBEDDINGS, compact_segments=3)
+
+    append_all(segment_store, large + small)
+
+    assert len(segment_store.segments) == 3
+    assert segment_store.segments[:2] == ["seg-000000", "seg-000001"]
+
+
+def test_compaction_drops_deleted_chunks(tmp_path):
+    small = [store(f"{i}.txt", vectors(2, i)) for i in range(4)]
+    segment_store = SegmentStore(tmp_path, EMBEDDINGS, compact_segments=3)
+    append_all(segment_store, small[:3])
+    segment_store.remove_source("2.txt")
+
+    append_all(segment_store, small[3:])
+
+    assert len(segment_store.segments) == 2
+    assert segment_store.deleted == {}
+    loaded = SegmentStore(tmp_path, EMBEDDINGS).load()
+    assert contents(loaded) == contents(small[0]) + contents(small[1]) + contents(small[3])
+    assert segment_store.layout()[0] == {"0.txt": [[0, 2]], "1.txt": [[2, 4]], "3.txt": [[4, 6]]}
+
+
+def test_load_removes_leftovers_of_interrupted_writes(tmp_path):
+    segment_store = SegmentStore(tmp_path, EMBEDDINGS)
+    append_all(segment_store, [store("a.txt", vectors(3, 0))])
+    (segment_store.segment_path / "seg-000001.tmp").mkdir()
+    (segment_store.segment_path / "seg-000001.tmp" / "index.faiss").write_bytes(b"partial")
+    (segment_store.segment_path / "seg-000002").mkdir()
+
+    loaded = SegmentStore(tmp_path, EMBEDDINGS).load()
+
+    assert sorted(path.name for path in segment_store.segment_path.iterdir()) == ["seg-000000"]
+    assert loaded.index.ntotal == 3